@@ -1,5 +1,6 @@
 import asyncio
 import os
+import re
 from logging.config import fileConfig
 
 import alembic_postgresql_enum
@@ -21,6 +22,19 @@ fileConfig(config.config_file_name)  # type: ignore
 target_metadata = Base.metadata
 
 
+# lenses_history partitions are created and dropped by app.maintenance, they
+# aren't in the metadata and autogenerate must not drop them
+PARTITION_NAME = re.compile(r"^lenses_history_(y\d{4}m\d{2}|default)$")
+
+
+def include_name(name, type_, parent_names):
+    if type_ == "table":
+        return not PARTITION_NAME.match(name)
+    if type_ in ("index", "unique_constraint", "foreign_key_constraint"):
+        return not PARTITION_NAME.match(parent_names.get("table_name") or "")
+    return True
+
+
 def get_url():
     return os.getenv("DATABASE_URL")
 
@@ -41,6 +55,7 @@ def run_migrations_offline():
         target_metadata=target_metadata,
         literal_binds=True,
         dialect_opts={"paramstyle": "named"},
+        include_name=include_name,
     )
 
     with context.begin_transaction():
@@ -48,7 +63,11 @@ def run_migrations_offline():
 
 
 def do_run_migrations(connection: Connection) -> None:
-    context.configure(connection=connection, target_metadata=target_metadata)
+    context.configure(
+        connection=connection,
+        target_metadata=target_metadata,
+        include_name=include_name,
+    )
 
     with context.begin_transaction():
         context.run_migrations()
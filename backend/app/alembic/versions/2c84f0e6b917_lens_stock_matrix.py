@@ -0,0 +1,121 @@
+"""Lens stock matrix
+
+Revision ID: 2c84f0e6b917
+Revises: 9d1e7b3c5a60
+Create Date: 2026-10-18 18:22:45.906114-07:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2c84f0e6b917'
+down_revision = '9d1e7b3c5a60'
+branch_labels = None
+depends_on = None
+
+
+# frozen copy of app.models.lenses.STOCK_MATRIX_FUNCTION
+STOCK_MATRIX_FUNCTION = """
+CREATE FUNCTION lens_stock_matrix_apply() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO lens_stock_matrix AS m (lens_type, sphere, cylinder, lenses, quantity, storage_limit, limited_quantity)
+        SELECT lens_type, sphere, cylinder, sum(lenses), sum(quantity), sum(storage_limit), sum(limited_quantity)
+        FROM (
+            SELECT lens_type, sphere, cylinder, 1 AS lenses, quantity AS quantity,
+                coalesce(storage_limit, 0) AS storage_limit,
+                CASE WHEN storage_limit IS NOT NULL THEN quantity ELSE 0 END AS limited_quantity
+            FROM new_rows WHERE deleted_at IS NULL
+        ) AS changes
+        GROUP BY lens_type, sphere, cylinder
+        HAVING sum(lenses) <> 0 OR sum(quantity) <> 0 OR sum(storage_limit) <> 0 OR sum(limited_quantity) <> 0
+        ORDER BY lens_type, sphere, cylinder
+        ON CONFLICT (lens_type, sphere, cylinder) DO UPDATE SET
+            lenses = m.lenses + excluded.lenses,
+            quantity = m.quantity + excluded.quantity,
+            storage_limit = m.storage_limit + excluded.storage_limit,
+            limited_quantity = m.limited_quantity + excluded.limited_quantity;
+    ELSIF TG_OP = 'UPDATE' THEN
+        INSERT INTO lens_stock_matrix AS m (lens_type, sphere, cylinder, lenses, quantity, storage_limit, limited_quantity)
+        SELECT lens_type, sphere, cylinder, sum(lenses), sum(quantity), sum(storage_limit), sum(limited_quantity)
+        FROM (
+            SELECT lens_type, sphere, cylinder, 1 AS lenses, quantity AS quantity,
+                coalesce(storage_limit, 0) AS storage_limit,
+                CASE WHEN storage_limit IS NOT NULL THEN quantity ELSE 0 END AS limited_quantity
+            FROM new_rows WHERE deleted_at IS NULL
+            UNION ALL
+            SELECT lens_type, sphere, cylinder, -1 AS lenses, -quantity AS quantity,
+                -coalesce(storage_limit, 0) AS storage_limit,
+                CASE WHEN storage_limit IS NOT NULL THEN -quantity ELSE 0 END AS limited_quantity
+            FROM old_rows WHERE deleted_at IS NULL
+        ) AS changes
+        GROUP BY lens_type, sphere, cylinder
+        HAVING sum(lenses) <> 0 OR sum(quantity) <> 0 OR sum(storage_limit) <> 0 OR sum(limited_quantity) <> 0
+        ORDER BY lens_type, sphere, cylinder
+        ON CONFLICT (lens_type, sphere, cylinder) DO UPDATE SET
+            lenses = m.lenses + excluded.lenses,
+            quantity = m.quantity + excluded.quantity,
+            storage_limit = m.storage_limit + excluded.storage_limit,
+            limited_quantity = m.limited_quantity + excluded.limited_quantity;
+        DELETE FROM lens_stock_matrix m USING old_rows o
+        WHERE m.lens_type = o.lens_type AND m.sphere = o.sphere AND m.cylinder = o.cylinder AND m.lenses <= 0;
+    ELSE
+        INSERT INTO lens_stock_matrix AS m (lens_type, sphere, cylinder, lenses, quantity, storage_limit, limited_quantity)
+        SELECT lens_type, sphere, cylinder, sum(lenses), sum(quantity), sum(storage_limit), sum(limited_quantity)
+        FROM (
+            SELECT lens_type, sphere, cylinder, -1 AS lenses, -quantity AS quantity,
+                -coalesce(storage_limit, 0) AS storage_limit,
+                CASE WHEN storage_limit IS NOT NULL THEN -quantity ELSE 0 END AS limited_quantity
+            FROM old_rows WHERE deleted_at IS NULL
+        ) AS changes
+        GROUP BY lens_type, sphere, cylinder
+        HAVING sum(lenses) <> 0 OR sum(quantity) <> 0 OR sum(storage_limit) <> 0 OR sum(limited_quantity) <> 0
+        ORDER BY lens_type, sphere, cylinder
+        ON CONFLICT (lens_type, sphere, cylinder) DO UPDATE SET
+            lenses = m.lenses + excluded.lenses,
+            quantity = m.quantity + excluded.quantity,
+            storage_limit = m.storage_limit + excluded.storage_limit,
+            limited_quantity = m.limited_quantity + excluded.limited_quantity;
+        DELETE FROM lens_stock_matrix m USING old_rows o
+        WHERE m.lens_type = o.lens_type AND m.sphere = o.sphere AND m.cylinder = o.cylinder AND m.lenses <= 0;
+    END IF;
+    RETURN NULL;
+END
+$$
+"""
+
+
+def upgrade():
+    op.create_table('lens_stock_matrix',
+    sa.Column('lens_type', sa.String(), nullable=False),
+    sa.Column('sphere', sa.Numeric(precision=4, scale=2), nullable=False),
+    sa.Column('cylinder', sa.Numeric(precision=4, scale=2), nullable=False),
+    sa.Column('lenses', sa.Integer(), nullable=False),
+    sa.Column('quantity', sa.Integer(), nullable=False),
+    sa.Column('storage_limit', sa.Integer(), nullable=False),
+    sa.Column('limited_quantity', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('lens_type', 'sphere', 'cylinder')
+    )
+    op.execute(STOCK_MATRIX_FUNCTION)
+    # writes to lenses wait from here until the backfill commits, so it can't miss any
+    op.execute('CREATE TRIGGER lens_stock_matrix_insert AFTER INSERT ON lenses REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION lens_stock_matrix_apply()')
+    op.execute('CREATE TRIGGER lens_stock_matrix_update AFTER UPDATE ON lenses REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION lens_stock_matrix_apply()')
+    op.execute('CREATE TRIGGER lens_stock_matrix_delete AFTER DELETE ON lenses REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION lens_stock_matrix_apply()')
+    op.execute("""
+        INSERT INTO lens_stock_matrix
+        SELECT lens_type, sphere, cylinder, count(*), sum(quantity), sum(coalesce(storage_limit, 0)),
+            coalesce(sum(quantity) FILTER (WHERE storage_limit IS NOT NULL), 0)
+        FROM lenses WHERE deleted_at IS NULL
+        GROUP BY lens_type, sphere, cylinder
+    """)
+
+
+def downgrade():
+    op.execute('DROP TRIGGER lens_stock_matrix_delete ON lenses')
+    op.execute('DROP TRIGGER lens_stock_matrix_update ON lenses')
+    op.execute('DROP TRIGGER lens_stock_matrix_insert ON lenses')
+    op.execute('DROP FUNCTION lens_stock_matrix_apply()')
+    op.drop_table('lens_stock_matrix')
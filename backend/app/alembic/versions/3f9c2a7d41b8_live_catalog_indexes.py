@@ -0,0 +1,42 @@
+"""Live catalog indexes
+
+Revision ID: 3f9c2a7d41b8
+Revises: 746eaf24501c
+Create Date: 2026-10-17 21:24:51.310428-07:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f9c2a7d41b8'
+down_revision = '746eaf24501c'
+branch_labels = None
+depends_on = None
+
+
+active = sa.text('deleted_at IS NULL')
+
+
+def upgrade():
+    # built concurrently so that the catalog stays writable on big tables
+    with op.get_context().autocommit_block():
+        op.create_index('ix_lenses_active_id', 'lenses', ['id'], unique=False, postgresql_where=active, postgresql_concurrently=True)
+        op.create_index('ix_lenses_active_lens_type', 'lenses', ['lens_type', 'id'], unique=False, postgresql_where=active, postgresql_concurrently=True)
+        op.create_index('ix_lenses_active_sphere_cylinder', 'lenses', ['sphere', 'cylinder'], unique=False, postgresql_where=active, postgresql_concurrently=True)
+        op.create_index('ix_lenses_active_cylinder', 'lenses', ['cylinder'], unique=False, postgresql_where=active, postgresql_concurrently=True)
+        op.create_index('ix_lenses_active_quantity', 'lenses', ['quantity'], unique=False, postgresql_where=active, postgresql_concurrently=True)
+        op.create_index('ix_lenses_active_shortage', 'lenses', [sa.text('(storage_limit - quantity)')], unique=False, postgresql_where=active, postgresql_concurrently=True)
+        op.create_index('ix_lenses_history_lens_id_update_timestamp', 'lenses_history', ['lens_id', 'update_timestamp'], unique=False, postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_lenses_history_lens_id_update_timestamp', table_name='lenses_history', postgresql_concurrently=True)
+        op.drop_index('ix_lenses_active_shortage', table_name='lenses', postgresql_concurrently=True)
+        op.drop_index('ix_lenses_active_quantity', table_name='lenses', postgresql_concurrently=True)
+        op.drop_index('ix_lenses_active_cylinder', table_name='lenses', postgresql_concurrently=True)
+        op.drop_index('ix_lenses_active_sphere_cylinder', table_name='lenses', postgresql_concurrently=True)
+        op.drop_index('ix_lenses_active_lens_type', table_name='lenses', postgresql_concurrently=True)
+        op.drop_index('ix_lenses_active_id', table_name='lenses', postgresql_concurrently=True)
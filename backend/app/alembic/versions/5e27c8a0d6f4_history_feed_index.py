@@ -0,0 +1,34 @@
+"""History feed index
+
+Revision ID: 5e27c8a0d6f4
+Revises: b6d04e1f9a23
+Create Date: 2026-10-18 14:03:52.118466-07:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5e27c8a0d6f4'
+down_revision = 'b6d04e1f9a23'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # partitioned indexes can't be built concurrently, so the parent index is
+    # created empty and each partition's index is built concurrently and attached
+    op.execute('CREATE INDEX ix_lenses_history_update_timestamp_id ON ONLY lenses_history (update_timestamp, id)')
+    partitions = op.get_bind().scalars(sa.text("SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = 'lenses_history'::regclass")).all()
+
+    with op.get_context().autocommit_block():
+        for partition in partitions:
+            op.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {partition}_update_timestamp_id_idx ON {partition} (update_timestamp, id)')
+
+    for partition in partitions:
+        op.execute(f'ALTER INDEX ix_lenses_history_update_timestamp_id ATTACH PARTITION {partition}_update_timestamp_id_idx')
+
+
+def downgrade():
+    op.drop_index('ix_lenses_history_update_timestamp_id', table_name='lenses_history')
@@ -0,0 +1,33 @@
+"""Lens stock status
+
+Revision ID: 7a3f5c1e8d42
+Revises: 2c84f0e6b917
+Create Date: 2026-10-18 20:07:13.662085-07:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7a3f5c1e8d42'
+down_revision = '2c84f0e6b917'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # adding stored generated columns rewrites lenses, writes wait until it's done
+    op.add_column('lenses', sa.Column('shortage', sa.Integer(), sa.Computed('storage_limit - quantity', persisted=True), nullable=True))
+    op.add_column('lenses', sa.Column('fill_ratio', sa.Double(), sa.Computed('CAST(quantity AS double precision) / NULLIF(storage_limit, 0)', persisted=True), nullable=True))
+    with op.get_context().autocommit_block():
+        op.create_index('ix_lenses_reorder', 'lenses', [sa.text('shortage DESC'), 'id'], unique=False, postgresql_where=sa.text('deleted_at IS NULL AND shortage > 0'), postgresql_concurrently=True)
+        op.drop_index('ix_lenses_active_shortage', table_name='lenses', postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.create_index('ix_lenses_active_shortage', 'lenses', [sa.text('(storage_limit - quantity)')], unique=False, postgresql_where=sa.text('deleted_at IS NULL'), postgresql_concurrently=True)
+        op.drop_index('ix_lenses_reorder', table_name='lenses', postgresql_concurrently=True)
+    op.drop_column('lenses', 'fill_ratio')
+    op.drop_column('lenses', 'shortage')
@@ -0,0 +1,94 @@
+"""Partition lenses_history by month
+
+Revision ID: b6d04e1f9a23
+Revises: 3f9c2a7d41b8
+Create Date: 2026-10-18 10:12:37.504821-07:00
+
+"""
+from datetime import date, datetime, timezone
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'b6d04e1f9a23'
+down_revision = '3f9c2a7d41b8'
+branch_labels = None
+depends_on = None
+
+
+# same layout as app.maintenance, which takes over creating partitions from here
+MONTHS_AHEAD = 3
+
+
+def _add_months(month, months):
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def _history_columns():
+    return [
+        sa.Column('id', sa.Integer(), server_default=sa.text("nextval('lenses_history_id_seq'::regclass)"), nullable=False),
+        sa.Column('lens_id', sa.Integer(), nullable=False),
+        sa.Column('update_field', postgresql.ENUM('LENS_TYPE', 'SPHERE', 'CYLINDER', 'UNIT_PRICE', 'QUANTITY', 'STORAGE_LIMIT', 'COMMENT', 'DELETED_AT', name='updatefield', create_type=False), nullable=False),
+        sa.Column('old_value', sa.String(), nullable=True),
+        sa.Column('new_value', sa.String(), nullable=True),
+        sa.Column('update_timestamp', sa.TIMESTAMP(timezone=True), server_default=sa.text('now()'), nullable=False),
+        sa.Column('update_type', postgresql.ENUM('CREATE', 'UPDATE', 'DELETE', name='updatetype', create_type=False), nullable=False),
+        sa.Column('update_notes', sa.String(), nullable=True),
+        sa.Column('update_source', sa.String(), nullable=True),
+        sa.ForeignKeyConstraint(['lens_id'], ['lenses.id'], name='lenses_history_lens_id_fkey'),
+    ]
+
+
+def _rename_old_table(new_name):
+    op.rename_table('lenses_history', new_name)
+    op.execute(f'ALTER INDEX ix_lenses_history_id RENAME TO ix_{new_name}_id')
+    op.execute(f'ALTER INDEX ix_lenses_history_lens_id_update_timestamp RENAME TO ix_{new_name}_lens_id_update_timestamp')
+    op.execute(f'ALTER INDEX lenses_history_pkey RENAME TO {new_name}_pkey')
+    op.execute(f'ALTER TABLE {new_name} RENAME CONSTRAINT lenses_history_lens_id_fkey TO {new_name}_lens_id_fkey')
+    # the id sequence is kept, it must not go away with the old table
+    op.execute('ALTER SEQUENCE lenses_history_id_seq OWNED BY NONE')
+
+
+def _finish_copy(old_name):
+    op.execute(f'INSERT INTO lenses_history SELECT * FROM {old_name}')
+    op.execute(f'DROP TABLE {old_name}')
+    op.execute('ALTER SEQUENCE lenses_history_id_seq OWNED BY lenses_history.id')
+    op.create_index(op.f('ix_lenses_history_id'), 'lenses_history', ['id'], unique=False)
+    op.create_index('ix_lenses_history_lens_id_update_timestamp', 'lenses_history', ['lens_id', 'update_timestamp'], unique=False)
+
+
+def upgrade():
+    # rewrites the table, the catalog can't record history until this commits
+    _rename_old_table('lenses_history_unpartitioned')
+
+    op.create_table('lenses_history',
+    *_history_columns(),
+    sa.PrimaryKeyConstraint('id', 'update_timestamp'),
+    postgresql_partition_by='RANGE (update_timestamp)'
+    )
+    op.execute('CREATE TABLE lenses_history_default PARTITION OF lenses_history DEFAULT')
+
+    first = op.get_bind().scalar(sa.text('SELECT min(update_timestamp) FROM lenses_history_unpartitioned'))
+    current = datetime.now(timezone.utc).date().replace(day=1)
+    month = min(first.astimezone(timezone.utc).date().replace(day=1), current) if first else current
+    while month <= _add_months(current, MONTHS_AHEAD):
+        end = _add_months(month, 1)
+        op.execute(f"CREATE TABLE lenses_history_y{month.year:04d}m{month.month:02d} PARTITION OF lenses_history FOR VALUES FROM ('{month} 00:00:00+00') TO ('{end} 00:00:00+00')")
+        month = end
+
+    _finish_copy('lenses_history_unpartitioned')
+
+
+def downgrade():
+    _rename_old_table('lenses_history_partitioned')
+
+    op.create_table('lenses_history',
+    *_history_columns(),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+    _finish_copy('lenses_history_partitioned')
@@ -0,0 +1,28 @@
+"""History null values
+
+Revision ID: d8a4f1c6e925
+Revises: c5b8e2d7f013
+Create Date: 2026-10-19 10:12:31.540218-07:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd8a4f1c6e925'
+down_revision = 'c5b8e2d7f013'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # missing values were written as the string 'None' by the application and
+    # as NULL by bulk mutations, NULL from now on
+    op.execute("UPDATE lenses_history SET old_value = NULL WHERE old_value = 'None'")
+    op.execute("UPDATE lenses_history SET new_value = NULL WHERE new_value = 'None'")
+
+
+def downgrade():
+    # NULL is read back the same by every version, nothing to undo
+    pass
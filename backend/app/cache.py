@@ -0,0 +1,103 @@
+import json
+import time
+from collections import OrderedDict
+
+from app import metrics
+
+
+class CountCache:
+    """
+    Bounded per-worker cache of list totals, keyed by the normalized filter
+    and whether soft-deleted rows are included. Writes clear the whole cache;
+    the ttl bounds how stale a total can get from writes on other workers.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: OrderedDict[str, tuple[float, int]] = OrderedDict()
+
+    @staticmethod
+    def key(filter, show_deleted: bool) -> str:
+        return json.dumps(
+            [filter or [], show_deleted], sort_keys=True, separators=(",", ":")
+        )
+
+    def get(self, key: str) -> int | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        expires, total = entry
+        if expires < time.monotonic():
+            del self._entries[key]
+            return None
+
+        self._entries.move_to_end(key)
+        return total
+
+    def set(self, key: str, total: int):
+        if self.maxsize <= 0:
+            return
+
+        self._entries[key] = (time.monotonic() + self.ttl, total)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self):
+        self._entries.clear()
+
+
+class ResponseCache:
+    """
+    Bounded per-worker LRU of response bodies, keyed by the catalog version
+    they were read at and the normalized request. Only entries at the current
+    generation are served; moving to a new one drops the older entries.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[tuple, tuple[bytes, dict[str, str]]] = OrderedDict()
+        self._size = 0
+        self._generation = 0
+
+    @staticmethod
+    def key(path: str, query: list[tuple[str, str]]) -> tuple:
+        return (path, tuple(sorted(query)))
+
+    def get(self, generation: int, key: tuple) -> tuple[bytes, dict] | None:
+        self._expire(generation)
+
+        entry = self._entries.get((generation, key))
+        metrics.record_response_cache(entry is not None)
+        if entry is not None:
+            self._entries.move_to_end((generation, key))
+
+        return entry
+
+    def set(self, version: int, key: tuple, body: bytes, headers: dict[str, str]):
+        if version < self._generation or len(body) > self.max_bytes:
+            return
+
+        self._pop((version, key))
+        self._entries[(version, key)] = (body, headers)
+        self._size += len(body)
+        while self._size > self.max_bytes:
+            self._pop(next(iter(self._entries)))
+        metrics.RESPONSE_CACHE_BYTES.set(self._size)
+
+    def _expire(self, generation: int):
+        if generation <= self._generation:
+            return
+
+        self._generation = generation
+        for version, key in list(self._entries):
+            if version < generation:
+                self._pop((version, key))
+        metrics.RESPONSE_CACHE_BYTES.set(self._size)
+
+    def _pop(self, entry_key: tuple):
+        entry = self._entries.pop(entry_key, None)
+        if entry is not None:
+            self._size -= len(entry[0])
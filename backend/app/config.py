@@ -1,13 +1,92 @@
 import logging
+import os
+from decimal import Decimal
 
 from pydantic_settings import BaseSettings
 
 
 class Settings(BaseSettings):
     database_url: str
+    database_replica_urls: list[str] = []
+    # how long a client that just wrote keeps reading from the primary
+    read_your_writes_window: float = 5.0
     echo_sql: bool = False
+    # size the pool so that workers * (pool_size + max_overflow) stays below
+    # the server's max_connections
+    workers: int = 1
+    db_pool_size: int = 5
+    db_max_overflow: int = 10
+    db_pool_timeout: float = 30.0
+    db_pool_recycle: int = -1
+    db_pool_pre_ping: bool = False
+    # asyncpg's own statement cache and SQLAlchemy's prepared statement cache,
+    # both per connection. set both to 0 behind pgbouncer in transaction mode
+    db_statement_cache_size: int = 100
+    db_prepared_statement_cache_size: int = 100
+    db_server_settings: dict[str, str] = {}
+    # open the pools' connections at startup and prepare the hot statements
+    # on them, instead of on the first requests
+    db_warm_up: bool = True
     log_level: int = logging.WARNING
     local_timezone: str = "America/Los_Angeles"
+    default_page_size: int = 25
+    max_page_size: int = 1000
+    count_cache_size: int = 256
+    count_cache_ttl: float = 5.0
+    estimated_count_threshold: int = 100_000
+    bulk_max_rows: int = 50_000
+    filter_cache_size: int = 512
+    export_batch_size: int = 1000
+    # write history from a background task instead of the request's transaction.
+    # a crash can lose rows that are queued but not yet flushed or spooled
+    history_queue: bool = False
+    history_batch_size: int = 500
+    history_flush_interval: float = 1.0
+    history_max_queued: int = 10_000
+    # each worker process spools to its own file in here
+    history_spool_dir: str = os.path.abspath("history_spool")
+    # monthly lenses_history partitions, see app.maintenance
+    history_partitions_ahead: int = 3
+    history_retention_months: int | None = None
+    history_archive_dir: str | None = None
+    # catalog snapshots for as_of reads. the replay margin has to cover the
+    # longest write transaction, whose history rows can predate a snapshot
+    # that doesn't include them yet
+    snapshot_interval: float | None = 24 * 60 * 60
+    snapshot_check_interval: float = 5 * 60
+    snapshot_replay_margin: float = 5 * 60
+    # older snapshots are pruned, as_of reads before then replay more history
+    snapshot_retention: float | None = 30 * 24 * 60 * 60
+    # per-worker cache of GET /lenses responses, kept current by LISTEN/NOTIFY
+    response_cache: bool = False
+    response_cache_max_bytes: int = 64 * 1024 * 1024
+    # the listening connection re-reads the catalog version this often, a
+    # connection that doesn't answer within as long is dropped
+    catalog_check_interval: float = 30.0
+    # SSE change feed. history written up to change_feed_margin seconds before
+    # the latest change seen is still picked up, e.g. from slow transactions
+    change_feed_queue_size: int = 1000
+    change_feed_replay_limit: int = 10_000
+    change_feed_margin: float = 10.0
+    change_feed_keepalive: float = 15.0
+    # responses to POST and PUT requests sent with an Idempotency-Key are
+    # replayed to their retries for idempotency_ttl seconds
+    idempotency_ttl: float = 24 * 60 * 60
+    idempotency_purge_interval: float = 60 * 60
+    # duplicates wait up to idempotency_wait seconds for the first request to
+    # finish. a key claimed idempotency_pending_ttl seconds ago by a request
+    # that never finished is taken over
+    idempotency_wait: float = 30.0
+    idempotency_pending_ttl: float = 5 * 60
+    # production server, see app.server. in-flight requests get
+    # server_graceful_timeout seconds to finish on shutdown
+    server_host: str = "0.0.0.0"
+    server_port: int = 8000
+    server_loop: str = "uvloop"
+    server_http: str = "httptools"
+    server_graceful_timeout: float = 30.0
+    # power steps of the stock matrix grid
+    stock_matrix_step: Decimal = Decimal("0.25")
 
 
 settings = Settings()  # type: ignore
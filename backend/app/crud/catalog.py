@@ -0,0 +1,85 @@
+"""
+the catalog version, a counter bumped after every transaction that writes to
+the catalog or its history commits. it's replicated with the data, so a
+replica never reports a version newer than what it can read. each bump is
+also sent on CATALOG_CHANNEL, see app.notifications
+"""
+
+import asyncio
+import logging
+
+from app.models import CatalogVersion
+from sqlalchemy import String, cast, func, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+logger = logging.getLogger(__name__)
+
+CATALOG_CHANNEL = "catalog_version"
+
+_bumped = (
+    insert(CatalogVersion)
+    .values(id=1, version=1)
+    .on_conflict_do_update(
+        index_elements=[CatalogVersion.id],
+        set_={"version": CatalogVersion.version + 1},
+    )
+    .returning(CatalogVersion.version)
+    .cte("bumped")
+)
+_bump = select(func.pg_notify(CATALOG_CHANNEL, cast(_bumped.c.version, String)))
+
+
+class VersionBumper:
+    """
+    bumps the version in a short transaction of its own. writers that commit
+    while a bump is running share the next one, so each worker has at most one
+    transaction waiting on the row and writers never hold its lock through
+    their own commit
+    """
+
+    def __init__(self):
+        self._running: asyncio.Task | None = None
+        self._queued: asyncio.Task | None = None
+
+    async def bump(self, db_session: AsyncSession):
+        if self._queued is None:
+            self._queued = asyncio.ensure_future(
+                self._bump_after(self._running, db_session.bind)
+            )
+        # the bump goes on for the others sharing it if this request is cancelled
+        await asyncio.shield(self._queued)
+
+    async def _bump_after(self, running: asyncio.Task | None, bind):
+        # the running bump may have read the version before the writers
+        # queued behind it committed
+        if running is not None:
+            await asyncio.wait([running])
+        self._running, self._queued = self._queued, None
+
+        try:
+            async with AsyncSession(bind) as db_session:
+                await db_session.execute(_bump)
+                await db_session.commit()
+        except (OSError, SQLAlchemyError) as e:
+            # the writes are committed, the next bump covers them
+            logger.warning("Could not bump the catalog version: %s", e)
+        finally:
+            if self._running is asyncio.current_task():
+                self._running = None
+
+
+bumper = VersionBumper()
+
+
+async def bump_catalog_version(db_session: AsyncSession):
+    """
+    called once the writes have committed, so no reader sees the new version
+    without them
+    """
+    await bumper.bump(db_session)
+
+
+async def get_catalog_version(db_session: AsyncSession) -> int:
+    return await db_session.scalar(select(CatalogVersion.version)) or 0
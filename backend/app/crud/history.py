@@ -0,0 +1,368 @@
+"""
+writes lenses_history rows. a transaction's rows go out in a single
+INSERT ... SELECT FROM unnest(...), one array parameter per column however many
+rows there are, so the statement is prepared once and reused.
+
+with settings.history_queue the rows are instead handed to a background task
+after the commit and flushed in batches. rows that can't be queued or written
+are appended to a JSONL spool file, one per worker process, which is replayed
+on the next start by whichever worker gets to it first.
+"""
+
+import asyncio
+import collections
+import contextlib
+import json
+import logging
+import os
+import re
+from datetime import datetime, timezone
+from decimal import ROUND_HALF_UP, Decimal
+from typing import AsyncContextManager, Callable, Iterable
+
+from app import metrics
+from app.config import settings
+from app.crud.catalog import bump_catalog_version
+from app.models import Lenses, LensesHistory, UpdateField, UpdateType
+from sqlalchemy import (
+    ARRAY,
+    TIMESTAMP,
+    Integer,
+    String,
+    bindparam,
+    cast,
+    func,
+    insert,
+    select,
+)
+from sqlalchemy.ext.asyncio import AsyncSession
+
+logger = logging.getLogger(__name__)
+
+# "<pid>.jsonl" while a process spools, "<pid>.jsonl.<pid>.replaying" once
+# another process has claimed it for replay
+_SPOOL_NAME = re.compile(r"(\d+)\.jsonl(?:\.(\d+)\.replaying)?")
+
+_COLUMNS = {
+    "lens_id": Integer,
+    "update_field": String,
+    "old_value": String,
+    "new_value": String,
+    "update_type": String,
+    "update_notes": String,
+    "update_source": String,
+    "update_timestamp": TIMESTAMP(timezone=True),
+}
+
+
+# decimal places of the numeric lens columns, postgres keeps exactly this many
+# when it stores a value and when it casts one to text
+_SCALES = {
+    field: Decimal(1).scaleb(-scale)
+    for field in UpdateField
+    if (scale := getattr(Lenses.__table__.c[field.value].type, "scale", None))
+}
+
+
+def _text(value, update_field: UpdateField) -> str | None:
+    if value is None:
+        return None
+    if update_field in _SCALES and isinstance(value, (int, float, Decimal)):
+        # "45.00" whether the value comes from the request or the table,
+        # the same text as the ::text cast in lenses._history_of_changes
+        value = Decimal(str(value)).quantize(_SCALES[update_field], ROUND_HALF_UP)
+        # postgres has no negative zero
+        value += 0
+    return str(value)
+
+
+def history_row(
+    lens_id: int,
+    update_field: UpdateField,
+    old_value,
+    new_value,
+    update_type: UpdateType,
+    update_notes: str | None = None,
+    update_source: str | None = None,
+) -> dict:
+    """
+    values are stored as text, a missing one as NULL like the history written
+    in SQL by lenses._history_of_changes
+    """
+    return {
+        "lens_id": lens_id,
+        "update_field": update_field,
+        "old_value": _text(old_value, update_field),
+        "new_value": _text(new_value, update_field),
+        "update_type": update_type,
+        "update_notes": update_notes,
+        "update_source": update_source,
+        "update_timestamp": None,
+    }
+
+
+def _build_insert():
+    rows = (
+        func.unnest(
+            *(
+                bindparam(column, type_=ARRAY(type_))
+                for column, type_ in _COLUMNS.items()
+            )
+        )
+        .table_valued(*_COLUMNS)
+        .render_derived()
+    )
+
+    return insert(LensesHistory.__table__).from_select(
+        list(_COLUMNS),
+        select(
+            rows.c.lens_id,
+            cast(rows.c.update_field, LensesHistory.update_field.type),
+            rows.c.old_value,
+            rows.c.new_value,
+            cast(rows.c.update_type, LensesHistory.update_type.type),
+            rows.c.update_notes,
+            rows.c.update_source,
+            # rows written in the request's transaction take its timestamp
+            func.coalesce(rows.c.update_timestamp, func.now()),
+        ),
+    )
+
+
+_insert_history = _build_insert()
+
+
+def _columns(rows: list[dict]) -> dict[str, list]:
+    return {
+        "lens_id": [row["lens_id"] for row in rows],
+        "update_field": [row["update_field"].name for row in rows],
+        "old_value": [row["old_value"] for row in rows],
+        "new_value": [row["new_value"] for row in rows],
+        "update_type": [row["update_type"].name for row in rows],
+        "update_notes": [row["update_notes"] for row in rows],
+        "update_source": [row["update_source"] for row in rows],
+        "update_timestamp": [row["update_timestamp"] for row in rows],
+    }
+
+
+async def insert_history(db_session: AsyncSession, rows: list[dict]):
+    if rows:
+        await db_session.execute(_insert_history, _columns(rows))
+
+
+def _record(rows: Iterable[dict]):
+    for update_type, count in collections.Counter(
+        row["update_type"] for row in rows
+    ).items():
+        metrics.record_history_rows(update_type.value, count)
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class HistoryWriter:
+    def __init__(
+        self,
+        queued: bool = False,
+        batch_size: int = 500,
+        flush_interval: float = 1.0,
+        max_queued: int = 10_000,
+        spool_dir: str = "history_spool",
+    ):
+        self.queued = queued
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spool_dir = os.path.abspath(spool_dir)
+        self._queue: asyncio.Queue[dict] = asyncio.Queue(maxsize=max_queued)
+        self._session_factory: Callable[[], AsyncContextManager[AsyncSession]]
+        self._task: asyncio.Task | None = None
+        self._flushing: asyncio.Future | None = None
+        # taken off the queue by _run but not flushed yet
+        self._batch: list[dict] = []
+
+    @property
+    def spool_path(self) -> str:
+        return os.path.join(self.spool_dir, f"{os.getpid()}.jsonl")
+
+    async def before_commit(self, db_session: AsyncSession, rows: list[dict]):
+        if not self.queued or self._task is None:
+            await insert_history(db_session, rows)
+
+    def after_commit(self, rows: list[dict]):
+        if not self.queued or self._task is None:
+            _record(rows)
+            return
+
+        now = datetime.now(timezone.utc)
+        for i, row in enumerate(rows):
+            try:
+                self._queue.put_nowait({**row, "update_timestamp": now})
+            except asyncio.QueueFull:
+                logger.warning("History queue is full, spooling %d rows", len(rows) - i)
+                self._spool([{**row, "update_timestamp": now} for row in rows[i:]])
+                break
+
+    async def start(
+        self, session_factory: Callable[[], AsyncContextManager[AsyncSession]]
+    ):
+        if not self.queued:
+            return
+
+        self._session_factory = session_factory
+        await self._replay_spool()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+
+        self._task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._task
+        self._task = None
+        if self._flushing is not None:
+            await self._flushing
+
+        rows = self._batch + self._drain(self._queue.qsize())
+        self._batch = []
+        if rows:
+            await self._flush(rows)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self._batch.append(await self._queue.get())
+            deadline = loop.time() + self.flush_interval
+            while len(self._batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    self._batch.append(
+                        await asyncio.wait_for(self._queue.get(), timeout)
+                    )
+                except asyncio.TimeoutError:
+                    break
+            self._batch.extend(self._drain(self.batch_size - len(self._batch)))
+            rows, self._batch = self._batch, []
+
+            # stop() must not cancel a batch halfway through its insert
+            self._flushing = asyncio.ensure_future(self._flush(rows))
+            await asyncio.shield(self._flushing)
+
+    def _drain(self, limit: int) -> list[dict]:
+        rows = []
+        while len(rows) < limit and not self._queue.empty():
+            rows.append(self._queue.get_nowait())
+        return rows
+
+    async def _flush(self, rows: list[dict]):
+        try:
+            async with self._session_factory() as db_session:
+                await insert_history(db_session, rows)
+                await db_session.commit()
+        except Exception as e:
+            logger.warning("Could not write %d history rows: %s", len(rows), e)
+            self._spool(rows)
+        else:
+            _record(rows)
+            # the history feed changed
+            await bump_catalog_version(db_session)
+
+    def _spool(self, rows: list[dict]):
+        os.makedirs(self.spool_dir, exist_ok=True)
+        with open(self.spool_path, "a") as spool:
+            for row in rows:
+                spool.write(
+                    json.dumps(
+                        {
+                            **row,
+                            "update_field": row["update_field"].name,
+                            "update_type": row["update_type"].name,
+                            "update_timestamp": row["update_timestamp"].isoformat(),
+                        }
+                    )
+                    + "\n"
+                )
+
+    def _orphaned_spools(self) -> list[tuple[str, str]]:
+        """
+        (file, spool) pairs for the spool files of this process and of
+        processes that are gone, including claims left by a replay that
+        crashed. the others are still being appended to or replayed
+        """
+        try:
+            names = sorted(os.listdir(self.spool_dir))
+        except FileNotFoundError:
+            return []
+
+        paths = []
+        for name in names:
+            if not (match := _SPOOL_NAME.fullmatch(name)):
+                continue
+            owner = int(match[2] or match[1])
+            if owner != os.getpid() and _alive(owner):
+                continue
+            paths.append(
+                (
+                    os.path.join(self.spool_dir, name),
+                    os.path.join(self.spool_dir, f"{match[1]}.jsonl"),
+                )
+            )
+        return paths
+
+    async def _replay_spool(self):
+        for path, spool in self._orphaned_spools():
+            # workers starting together race for the same files
+            claimed = f"{spool}.{os.getpid()}.replaying"
+            try:
+                os.rename(path, claimed)
+            except FileNotFoundError:
+                continue
+
+            if await self._replay(claimed):
+                os.remove(claimed)
+            else:
+                os.rename(claimed, spool)
+
+    async def _replay(self, path: str) -> bool:
+        with open(path) as spool:
+            rows = [json.loads(line) for line in spool if line.strip()]
+
+        rows = [
+            {
+                **row,
+                "update_field": UpdateField[row["update_field"]],
+                "update_type": UpdateType[row["update_type"]],
+                "update_timestamp": datetime.fromisoformat(row["update_timestamp"]),
+            }
+            for row in rows
+        ]
+        try:
+            async with self._session_factory() as db_session:
+                for i in range(0, len(rows), self.batch_size):
+                    await insert_history(db_session, rows[i : i + self.batch_size])
+                await db_session.commit()
+        except Exception as e:
+            logger.warning("Could not replay the history spool %s: %s", path, e)
+            return False
+
+        _record(rows)
+        await bump_catalog_version(db_session)
+        return True
+
+
+writer = HistoryWriter(
+    settings.history_queue,
+    settings.history_batch_size,
+    settings.history_flush_interval,
+    settings.history_max_queued,
+    settings.history_spool_dir,
+)
@@ -1,94 +1,297 @@
-from datetime import datetime, timezone
+import base64
+import binascii
+import functools
+import itertools
+import json
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from enum import Enum
+from operator import eq, ge, gt, le, lt, ne
 from typing import Sequence
 
+from app import metrics
+from app.cache import CountCache
+from app.config import settings
+from app.crud.catalog import bump_catalog_version, get_catalog_version
+from app.crud.history import history_row
+from app.crud.history import writer as history_writer
 from app.dependencies.exceptions import (
+    InsufficientStock,
     MalformedInput,
+    PreconditionFailed,
     ProductAlreadyExists,
     ProductNotFound,
+    TooManyAffected,
+    VersionConflict,
 )
-from app.models import Lenses, LensesHistory, UpdateField, UpdateType
-from app.schemas import LensCreate, LensUpdate
-from sqlalchemy import desc, func, select, update, or_, and_, not_
+from app.etags import etag_matches, lens_etag
+from app.models import (
+    Lenses,
+    LensesHistory,
+    LensStockMatrix,
+    UpdateField,
+    UpdateType,
+)
+from app.schemas import LensAdjust, LensCreate, LensMutation, LensUpdate
+from app.serialization import HISTORY_READ_FIELDS, LENS_READ_FIELDS
+from sqlalchemy import (
+    ARRAY,
+    TIMESTAMP,
+    Enum as SQLEnum,
+    Integer,
+    Interval,
+    all_,
+    and_,
+    any_,
+    bindparam,
+    cast,
+    desc,
+    false,
+    func,
+    insert,
+    inspect,
+    literal,
+    not_,
+    or_,
+    select,
+    String,
+    text,
+    tuple_,
+    union_all,
+    update,
+)
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
+
+count_cache = CountCache(settings.count_cache_size, settings.count_cache_ttl)
+
+
+async def _commit(db_session: AsyncSession, history_rows: list[dict] | None = None):
+    history_rows = history_rows or []
+    await history_writer.before_commit(db_session, history_rows)
+    await db_session.commit()
+    count_cache.invalidate()
+    history_writer.after_commit(history_rows)
+    await bump_catalog_version(db_session)
+
+
+# operators whose value is bound as-is, or as a LIKE pattern built from it
+_PATTERNS = {
+    "contains": "%{}%",
+    "ncontains": "%{}%",
+    "startswith": "{}%",
+    "nstartswith": "{}%",
+    "endswith": "%{}",
+    "nendswith": "%{}",
+}
+
+
+# columns the "q" pseudo field searches, per model
+_SEARCH_FIELDS = {
+    Lenses: ("lens_type", "comment"),
+    LensesHistory: ("old_value", "new_value", "update_notes"),
+}
+
+# comparisons that also take another field, {"field": "storage_limit"}, as value
+_COLUMN_OPERATORS = {
+    "eq": eq,
+    "ne": ne,
+    "lt": lt,
+    "gt": gt,
+    "lte": le,
+    "gte": ge,
+}
+_NUMERIC_TYPES = (int, float, Decimal)
+
+
+def _coerce(column, value):
+    """
+    converts a JSON filter value to what the column binds, enum values, ISO
+    timestamps, numbers and text, so that a value of the wrong type is a
+    MalformedInput rather than a driver error
+    """
+    if value is None:
+        return value
 
+    try:
+        if isinstance(column.type, SQLEnum) and column.type.enum_class is not None:
+            return column.type.enum_class(value)
+
+        python_type = column.type.python_type
+        if isinstance(value, (bool, dict, list)) and python_type is not bool:
+            raise ValueError(value)
+
+        if python_type is datetime:
+            return datetime.fromisoformat(value)
+        if python_type is int:
+            number = Decimal(str(value))
+            if number != number.to_integral_value():
+                raise ValueError(value)
+            return int(number)
+        if python_type is Decimal:
+            return Decimal(str(value))
+        if python_type is float:
+            return float(value)
+        if python_type is str and not isinstance(value, str):
+            raise ValueError(value)
+    except NotImplementedError:
+        pass
+    except (ValueError, TypeError, ArithmeticError):
+        raise MalformedInput(f"Invalid value {value!r} for field {column.key}")
+
+    return value
+
+
+def _comparable(column, other) -> bool:
+    """whether postgres can compare the two columns, numbers or the same type"""
+    try:
+        types = (column.type.python_type, other.type.python_type)
+    except NotImplementedError:
+        return False
+    return types[0] is types[1] or all(issubclass(t, _NUMERIC_TYPES) for t in types)
 
-def _process_filter(filter):
-    operator = filter["operator"]
-    field = getattr(Lenses, filter["field"])
-    value = filter["value"]
+
+def _filter_shape(filter, values: list, model=Lenses):
+    """
+    splits a filter into a hashable shape (fields, operators and nesting)
+    and appends its values, in order, to `values`
+    """
+    try:
+        operator = filter["operator"]
+        value = filter["value"]
+
+        if "field" not in filter:  # logical filter
+            if operator not in ("and", "or") or not isinstance(value, list):
+                raise MalformedInput(f'logical operator "{operator}" not supported')
+            return (
+                operator,
+                tuple(_filter_shape(sub, values, model) for sub in value),
+            )
+
+        field = filter["field"]
+    except (KeyError, TypeError):
+        raise MalformedInput("filter must have an operator and a value")
 
     if field == "q":
         # search over all text fields
+        values.append(f"%{value}%")
+        return (field, operator)
+
+    columns = inspect(model).mapper.columns
+    if field not in columns:
+        raise MalformedInput(
+            f"Requested filter on field {field} but field doesn't exist"
+        )
+    column = columns[field]
+
+    if isinstance(value, dict):
+        # compared to another column of the same row, part of the shape
+        if operator not in _COLUMN_OPERATORS or value.keys() != {"field"}:
+            raise MalformedInput(
+                f'filter operator "{operator}" can\'t compare two fields'
+            )
+        if value["field"] not in columns:
+            raise MalformedInput(
+                f"Requested filter on field {value['field']} but field doesn't exist"
+            )
+        if not _comparable(column, columns[value["field"]]):
+            raise MalformedInput(
+                f"Can't compare field {field} to field {value['field']}"
+            )
+        return (field, operator, value["field"])
+
+    match operator:
+        case "in" | "nin":
+            if isinstance(value, str) or not isinstance(value, Sequence):
+                raise MalformedInput(
+                    f'filter operator "{operator}" takes a sequence of values'
+                )
+            values.append([_coerce(column, v) for v in value])
+        case "between" | "nbetween":
+            if not isinstance(value, Sequence) or len(value) != 2:
+                raise MalformedInput(f'filter operator "{operator}" takes 2 arguments')
+            values.extend(_coerce(column, v) for v in value)
+        case _ if operator in _PATTERNS:
+            values.append(_PATTERNS[operator].format(value))
+        case _:
+            values.append(_coerce(column, value))
+
+    return (field, operator)
+
+
+def _compile_shape(shape, names, model):
+    if shape[0] in ("and", "or"):
+        conditions = [_compile_shape(sub, names, model) for sub in shape[1]]
+        return and_(*conditions) if shape[0] == "and" else or_(*conditions)
+
+    field, operator, *other = shape
+
+    if other:
+        return _COLUMN_OPERATORS[operator](
+            getattr(model, field), getattr(model, other[0])
+        )
+
+    if field == "q":
+        param = bindparam(next(names))
         return or_(
-            Lenses.lens_type.ilike(f"%{value}%"),
-            Lenses.comment.ilike(f"%{value}%"),
+            *[
+                getattr(model, search).ilike(param)
+                for search in _SEARCH_FIELDS[inspect(model).class_]
+            ]
         )
 
+    field = getattr(model, field)
+
     match operator:
         case "eq":
-            return field == value
+            return field == bindparam(next(names))
         case "ne":
-            return field != value
+            return field != bindparam(next(names))
         case "lt":
-            return field < value
+            return field < bindparam(next(names))
         case "gt":
-            return field > value
+            return field > bindparam(next(names))
         case "lte":
-            return field <= value
+            return field <= bindparam(next(names))
         case "gte":
-            return field >= value
+            return field >= bindparam(next(names))
         case "in":
-            if not isinstance(value, Sequence):
-                raise MalformedInput('filter operator "in" takes a sequence of values')
-            return field in value
+            return field.in_(bindparam(next(names), expanding=True))
         case "nin":
-            if not isinstance(value, Sequence):
-                raise MalformedInput('filter operator "nin" takes a sequence of values')
-            return not_(field in value)
+            return field.not_in(bindparam(next(names), expanding=True))
         case "contains":
-            return field.ilike(f"%{value}%")
+            return field.ilike(bindparam(next(names)))
         case "ncontains":
-            return not_(field.ilike(f"%{value}%"))
+            return not_(field.ilike(bindparam(next(names))))
         case "between":
-            if not isinstance(value, Sequence) or len(value) != 2:
-                raise MalformedInput('filter operator "between" takes 2 arguments')
-            return and_(field >= value[0], field <= value[1])
+            return and_(
+                field >= bindparam(next(names)), field <= bindparam(next(names))
+            )
         case "nbetween":
-            if not isinstance(value, Sequence) or len(value) != 2:
-                raise MalformedInput('filter operator "nbetween" takes 2 arguments')
-            return or_(field < value[0], field > value[1])
-        case "startswith":
-            return field.startswith(value)
-        case "nstartswith":
-            return not_(field.startswith(value))
-        case "endswith":
-            return field.endswith(value)
-        case "nendswith":
-            return not_(field.endswith(value))
+            return or_(field < bindparam(next(names)), field > bindparam(next(names)))
+        case "startswith" | "endswith":
+            return field.like(bindparam(next(names)))
+        case "nstartswith" | "nendswith":
+            return not_(field.like(bindparam(next(names))))
         case _:
             raise MalformedInput(f'filter operator "{operator}" not supported')
 
 
-def _apply_filter(filter):
-    if "field" in filter:
-        return _process_filter(filter)
-    else:  # logical filter
-        conditions = []
-
-        for subfilter in filter["value"]:
-            if "field" in subfilter:
-                conditions.append(_process_filter(subfilter))
-            else:
-                conditions.append(_apply_filter(subfilter))
-
-        if filter["operator"] == "and":
-            return and_(*conditions)
-        else:
-            return or_(*conditions)
+@functools.lru_cache(maxsize=settings.filter_cache_size)
+def _compile_filter(shape: tuple, model=Lenses):
+    """
+    builds the where clause for a filter shape once, with a bind parameter
+    per value. statements built from the same shape compile to the same SQL,
+    so they hit both the SQLAlchemy compiled cache and asyncpg's prepared
+    statement cache
+    """
+    names = (f"filter_{i}" for i in itertools.count())
+    return and_(*[_compile_shape(sub, names, model) for sub in shape])
 
 
-def _build_filter_query(filters):
+def _build_filter_query(filters, model=Lenses) -> tuple:
     """
     example:
     [
@@ -115,16 +318,362 @@ def _build_filter_query(filters):
                     operator: "eq",
                     value: 2,
                 },
+                {
+                    field: "quantity",
+                    operator: "lt",
+                    value: {field: "storage_limit"},
+                },
             ],
         },
     ]
     """
+    if not isinstance(filters, list):
+        raise MalformedInput("filter must be a list of filters")
+
+    values = []
+    shape = tuple(_filter_shape(filter, values, model) for filter in filters)
+
+    return (
+        _compile_filter(shape, model),
+        {f"filter_{i}": v for i, v in enumerate(values)},
+    )
+
+
+def _build_order(sort, model=Lenses) -> list[tuple]:
+    """
+    returns a list of (column, descending) pairs for the requested sort,
+    with id as the final tiebreaker so that the order is total
+    """
+    order = []
+
+    for entry in sort or []:
+        if (
+            not isinstance(entry, (list, tuple))
+            or len(entry) != 2
+            or not all(isinstance(part, str) for part in entry)
+        ):
+            raise MalformedInput(
+                f"Requested sort {entry!r} isn't a [field, direction] pair"
+            )
+        field, direction = entry
+
+        if field not in inspect(model).mapper.columns:
+            raise MalformedInput(
+                f"Requested sort on field {field} but field doesn't exist"
+            )
+
+        if direction.lower() == "asc":
+            order.append((getattr(model, field), False))
+        elif direction.lower() == "desc":
+            order.append((getattr(model, field), True))
+        else:
+            raise MalformedInput(f"Requested sort direction {direction} doesn't exist")
+
+    if "id" not in [column.key for column, _ in order]:
+        order.append((model.id, False))
+
+    return order
+
+
+def _order_by(order: list[tuple]):
+    return [desc(column) if descending else column for column, descending in order]
+
+
+def _encode_cursor(order: list[tuple], direction: str, row) -> str:
+    values = []
+    for column, _ in order:
+        value = getattr(row, column.key)
+        if isinstance(value, Decimal):
+            value = str(value)
+        elif isinstance(value, datetime):
+            value = value.isoformat()
+        elif isinstance(value, Enum):
+            value = value.value
+        values.append(value)
+
+    payload = {
+        "d": direction,
+        "k": [f"{column.key}:{int(descending)}" for column, descending in order],
+        "v": values,
+    }
+    raw = json.dumps(payload, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def _decode_cursor(order: list[tuple], cursor: str) -> tuple[str, list]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        payload = json.loads(raw)
+        direction, keys, values = payload["d"], payload["k"], payload["v"]
+    except (binascii.Error, ValueError, TypeError, KeyError):
+        raise MalformedInput("Malformed cursor")
+
+    if keys != [f"{column.key}:{int(descending)}" for column, descending in order]:
+        raise MalformedInput("Cursor does not match the requested sort")
+    if (
+        direction not in ("next", "prev")
+        or not isinstance(values, list)
+        or len(values) != len(order)
+    ):
+        raise MalformedInput("Malformed cursor")
+
+    decoded = []
+    for (column, _), value in zip(order, values):
+        if value is not None:
+            python_type = column.type.python_type
+            try:
+                if python_type is datetime:
+                    value = datetime.fromisoformat(value)
+                else:
+                    value = python_type(value)
+            except (ValueError, TypeError, ArithmeticError):
+                raise MalformedInput("Malformed cursor")
+        decoded.append(value)
+
+    return direction, decoded
+
+
+def _after(column, descending: bool, value):
+    # postgres sorts NULLs last for ASC and first for DESC
+    if value is None:
+        return column.is_not(None) if descending else false()
+    if descending:
+        return column < value
+    if column.nullable:
+        return or_(column > value, column.is_(None))
+    return column > value
+
+
+def _keyset_condition(order: list[tuple], values: list):
+    """
+    rows strictly after `values` in the given order
+    """
+    if (
+        len({descending for _, descending in order}) == 1
+        and not any(column.nullable for column, _ in order)
+        and None not in values
+    ):
+        # a row comparison lets postgres walk a composite index directly
+        columns = tuple_(*[column for column, _ in order])
+        if order[0][1]:
+            return columns < tuple_(*values)
+        return columns > tuple_(*values)
+
     conditions = []
+    for i, (column, descending) in enumerate(order):
+        equal = [
+            c.is_(None) if v is None else c == v
+            for (c, _), v in zip(order[:i], values[:i])
+        ]
+        conditions.append(and_(*equal, _after(column, descending, values[i])))
+
+    return or_(*conditions)
+
+
+def _read_columns(order: list[tuple], model=Lenses):
+    """
+    the LensRead columns, followed by any sort columns a cursor needs
+    """
+    columns = [getattr(model, field) for field in LENS_READ_FIELDS]
+    columns += [column for column, _ in order if column.key not in LENS_READ_FIELDS]
+    return columns
 
-    for filter in filters:
-        conditions.append(_apply_filter(filter))
 
-    return and_(*conditions)
+def _build_lenses_as_of(single: bool = False):
+    """
+    the catalog as of :as_of, from the latest snapshot taken by then plus the
+    newest history row of each changed field since. history is replayed from
+    :replay_margin before the snapshot, for rows of transactions that were
+    still running when it was taken. with single, only lens :lens_id is
+    replayed, so the read goes through the lens_id indexes
+    """
+    dialect = postgresql.dialect()
+    window = (
+        "update_timestamp <= :as_of AND update_timestamp > "
+        "coalesce((SELECT taken_at FROM snapshot) - :replay_margin, '-infinity')"
+    )
+    in_snapshot = "taken_at = (SELECT taken_at FROM snapshot)"
+    if single:
+        window += " AND lens_id = :lens_id"
+        in_snapshot += " AND id = :lens_id"
+
+    pivot = []
+    columns = []
+    for field in UpdateField:
+        sql_type = Lenses.__table__.c[field.value].type.compile(dialect=dialect)
+        pivot.append(
+            f"bool_or(update_field = '{field.name}') AS has_{field.value}, "
+            f"max(value) FILTER (WHERE update_field = '{field.name}') "
+            f"AS {field.value}"
+        )
+        columns.append(
+            f"CASE WHEN p.has_{field.value} "
+            f"THEN CAST(p.{field.value} AS {sql_type}) "
+            f"ELSE s.{field.value} END AS {field.value}"
+        )
+
+    pivot = ",\n                ".join(pivot)
+    replayed = ",\n            ".join(columns[:-1])
+    sql = f"""
+        WITH snapshot AS (
+            SELECT max(taken_at) AS taken_at FROM lenses_snapshots
+            WHERE taken_at <= :as_of
+        ),
+        changes AS (
+            SELECT DISTINCT ON (lens_id, update_field)
+                lens_id, update_field, new_value AS value
+            FROM lenses_history
+            WHERE {window}
+            ORDER BY lens_id, update_field, update_timestamp DESC, id DESC
+        ),
+        pivot AS (
+            SELECT
+                lens_id,
+                {pivot}
+            FROM changes
+            GROUP BY lens_id
+        ),
+        times AS (
+            SELECT
+                lens_id,
+                max(update_timestamp) FILTER (WHERE update_type = 'CREATE')
+                    AS created_at,
+                max(update_timestamp) AS updated_at
+            FROM lenses_history
+            WHERE {window}
+            GROUP BY lens_id
+        )
+        SELECT
+            coalesce(s.id, p.lens_id) AS id,
+            {replayed},
+            greatest(t.created_at, s.created_at) AS created_at,
+            greatest(t.updated_at, s.updated_at) AS updated_at,
+            {columns[-1]}
+        FROM (
+            SELECT * FROM lenses_snapshots
+            WHERE {in_snapshot}
+        ) AS s
+        FULL JOIN (pivot AS p JOIN times AS t ON t.lens_id = p.lens_id)
+            ON p.lens_id = s.id
+        WHERE s.id IS NOT NULL OR t.created_at IS NOT NULL
+    """
+    # generated columns aren't in history or snapshots, they're derived again
+    generated = "".join(
+        f", {column.computed.sqltext} AS {column.name}"
+        for column in Lenses.__table__.c
+        if column.computed is not None
+    )
+    sql = f"SELECT *{generated} FROM ({sql}) AS replayed"
+
+    params = [
+        bindparam("as_of", type_=TIMESTAMP(timezone=True)),
+        bindparam("replay_margin", type_=Interval()),
+    ]
+    if single:
+        params.append(bindparam("lens_id", type_=Integer()))
+
+    subquery = (
+        text(sql)
+        .bindparams(*params)
+        .columns(*Lenses.__table__.c)
+        .subquery("lens_as_of" if single else "lenses_as_of")
+    )
+    return aliased(Lenses, subquery)
+
+
+# the whole read pipeline runs against it like it does against Lenses, reads
+# of one lens against LensAsOf
+LensesAsOf = _build_lenses_as_of()
+LensAsOf = _build_lenses_as_of(single=True)
+
+
+def _as_of_params(as_of: datetime) -> dict:
+    return {
+        "as_of": as_of,
+        "replay_margin": timedelta(seconds=settings.snapshot_replay_margin),
+    }
+
+
+def _lenses_query(filter, show_deleted: bool, columns=None, as_of=None):
+    """
+    returns the select over the requested lenses and the bound filter values
+    to execute it with. with as_of, over the catalog as it was then
+    """
+    model = Lenses if as_of is None else LensesAsOf
+    stmt = select(*columns) if columns else select(model)
+    params = {}
+
+    if not show_deleted:
+        stmt = stmt.where(model.deleted_at.is_(None))
+
+    if filter:
+        condition, params = _build_filter_query(filter, model)
+        stmt = stmt.where(condition)
+
+    if as_of is not None:
+        params = {**params, **_as_of_params(as_of)}
+
+    return stmt, params
+
+
+async def _explain(db_session: AsyncSession, stmt, params: dict = None) -> dict:
+    if params:
+        stmt = stmt.params(params)
+
+    compiled = stmt.compile(
+        dialect=db_session.get_bind().dialect,
+        compile_kwargs={"literal_binds": True},
+    )
+    plan = await db_session.scalar(text(f"EXPLAIN (FORMAT JSON) {compiled}"))
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+
+    return plan[0]["Plan"]
+
+
+async def _estimate_count(db_session: AsyncSession, stmt) -> int:
+    """
+    planner row estimate for stmt, only as good as the last ANALYZE
+    """
+    return int((await _explain(db_session, stmt))["Plan Rows"])
+
+
+async def count_lenses(
+    db_session: AsyncSession,
+    filter: dict = None,
+    show_deleted: bool = False,
+    estimate: bool = False,
+    as_of: datetime | None = None,
+) -> int:
+    stmt, params = _lenses_query(filter, show_deleted, as_of=as_of)
+
+    if as_of is not None:
+        # the past doesn't change, but it isn't asked for often enough to cache
+        return await db_session.scalar(
+            select(func.count()).select_from(stmt.subquery()), params
+        )
+
+    key = count_cache.key(filter, show_deleted)
+    # clients pinned to the primary by their own write count it themselves
+    if (
+        not db_session.info.get("pinned_to_primary")
+        and (total := count_cache.get(key)) is not None
+    ):
+        return total
+
+    if estimate and not filter:
+        # only trust the planner on big unfiltered scans, where an exact
+        # count is expensive and a rough total is good enough for paging
+        total = await _estimate_count(db_session, stmt)
+        if total >= settings.estimated_count_threshold:
+            return total
+
+    total = await db_session.scalar(
+        select(func.count()).select_from(stmt.subquery()), params
+    )
+    count_cache.set(key, total)
+
+    return total
 
 
 async def get_lenses(
@@ -133,46 +682,40 @@ async def get_lenses(
     range: list[int] = None,
     filter: dict = None,
     show_deleted: bool = False,
+    estimate_count: bool = False,
+    as_rows: bool = False,
+    as_of: datetime | None = None,
 ):
-    stmt = select(Lenses)
-
-    if not show_deleted:
-        stmt = stmt.where(Lenses.deleted_at.is_(None))
-
-    if sort:
-        for field, direction in sort:
-            sort_column = getattr(Lenses, field, None)
-            if not sort_column:
-                raise MalformedInput(
-                    f"Requested sort on field {field} but field doesn't exist"
-                )
-
-            if direction.lower() == "asc":
-                stmt = stmt.order_by(field)
-            elif direction.lower() == "desc":
-                stmt = stmt.order_by(desc(field))
-            else:
-                raise MalformedInput(
-                    f"Requested sort direction {direction} doesn't exist"
-                )
-    else:
-        stmt = stmt.order_by(Lenses.id)
+    """
+    with as_rows, returns plain rows of the LensRead columns instead of
+    Lenses objects, skipping the ORM for callers that only serialize them.
+    as_of reads always return rows
+    """
+    model = Lenses if as_of is None else LensesAsOf
+    order = _build_order(sort, model)
+    columns = _read_columns(order, model) if as_rows or as_of else None
 
-    if filter:
-        stmt = stmt.where(_build_filter_query(filter))
+    stmt, params = _lenses_query(filter, show_deleted, columns, as_of)
+    stmt = stmt.order_by(*_order_by(order))
 
     total = 0
 
     if range:
-        # calculate total before range is applied
-        total = await db_session.scalar(select(func.count()).select_from(stmt))
-
         start, end = range
         if end < start:
             raise MalformedInput(f"Range end cannot be less than range start")
+
+        # calculate total before range is applied
+        total = await count_lenses(
+            db_session, filter, show_deleted, estimate_count, as_of
+        )
+
         stmt = stmt.offset(start).limit(end - start)
 
-    lenses = (await db_session.scalars(stmt)).all()
+    if columns:
+        lenses = (await db_session.execute(stmt, params)).all()
+    else:
+        lenses = (await db_session.scalars(stmt, params)).all()
 
     if not lenses:
         # if range is out of bounds, we need to set total back to 0
@@ -181,7 +724,208 @@ async def get_lenses(
     return lenses, total
 
 
-async def get_lens(db_session: AsyncSession, lens_id: int):
+async def get_lenses_page(
+    db_session: AsyncSession,
+    limit: int,
+    cursor: str | None = None,
+    sort: list[list[str]] = None,
+    filter: dict = None,
+    show_deleted: bool = False,
+    as_rows: bool = False,
+    as_of: datetime | None = None,
+):
+    """
+    keyset pagination over the requested sort, with id as the tiebreaker.
+    returns the page along with the cursors for the next and previous pages
+    """
+    model = Lenses if as_of is None else LensesAsOf
+    order = _build_order(sort, model)
+    as_rows = as_rows or as_of is not None
+    columns = _read_columns(order, model) if as_rows else None
+    stmt, params = _lenses_query(filter, show_deleted, columns, as_of)
+
+    return await _page(db_session, stmt, params, order, limit, cursor, as_rows)
+
+
+async def _page(
+    db_session: AsyncSession,
+    stmt,
+    params: dict,
+    order: list[tuple],
+    limit: int,
+    cursor: str | None,
+    as_rows: bool,
+):
+    direction = "next"
+
+    if cursor:
+        direction, values = _decode_cursor(order, cursor)
+        if direction == "prev":
+            # walk backwards from the cursor, then flip the page back around
+            reverse = [(column, not descending) for column, descending in order]
+            stmt = stmt.where(_keyset_condition(reverse, values))
+            stmt = stmt.order_by(*_order_by(reverse))
+        else:
+            stmt = stmt.where(_keyset_condition(order, values))
+            stmt = stmt.order_by(*_order_by(order))
+    else:
+        stmt = stmt.order_by(*_order_by(order))
+
+    # fetch one extra row to know whether there is another page
+    if as_rows:
+        result = await db_session.execute(stmt.limit(limit + 1), params)
+    else:
+        result = await db_session.scalars(stmt.limit(limit + 1), params)
+
+    rows = list(result.all())
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    if direction == "prev":
+        rows.reverse()
+
+    if not rows:
+        return rows, None, None
+
+    next_cursor = prev_cursor = None
+
+    if direction == "next":
+        if has_more:
+            next_cursor = _encode_cursor(order, "next", rows[-1])
+        if cursor:
+            prev_cursor = _encode_cursor(order, "prev", rows[0])
+    else:
+        next_cursor = _encode_cursor(order, "next", rows[-1])
+        if has_more:
+            prev_cursor = _encode_cursor(order, "prev", rows[0])
+
+    return rows, next_cursor, prev_cursor
+
+
+async def get_history_page(
+    db_session: AsyncSession,
+    limit: int,
+    cursor: str | None = None,
+    sort: list[list[str]] = None,
+    filter: dict = None,
+    lens_id: int | None = None,
+):
+    """
+    keyset pagination over lenses_history, newest first by default. with a
+    lens_id the (lens_id, update_timestamp) index is walked, otherwise the
+    (update_timestamp, id) one, so pages cost the same however deep they are
+    """
+    order = _build_order(
+        sort or [["update_timestamp", "DESC"], ["id", "DESC"]], LensesHistory
+    )
+    columns = _history_columns()
+    columns += [column for column, _ in order if column.key not in HISTORY_READ_FIELDS]
+
+    stmt = select(*columns)
+    params = {}
+
+    if lens_id is not None:
+        stmt = stmt.where(LensesHistory.lens_id == lens_id)
+
+    if filter:
+        condition, params = _build_filter_query(filter, LensesHistory)
+        stmt = stmt.where(condition)
+
+    history, next_cursor, prev_cursor = await _page(
+        db_session, stmt, params, order, limit, cursor, as_rows=True
+    )
+
+    if not history and not cursor and lens_id is not None:
+        # an empty first page is either no matches or no such lens
+        if (
+            await db_session.scalar(select(Lenses.id).where(Lenses.id == lens_id))
+            is None
+        ):
+            raise ProductNotFound(lens_id)
+
+    return history, next_cursor, prev_cursor
+
+
+def _history_columns():
+    return [getattr(LensesHistory, field) for field in HISTORY_READ_FIELDS]
+
+
+async def get_history_since(
+    db_session: AsyncSession, since: datetime, seen: Sequence[int], limit: int
+):
+    """
+    history rows written at or after `since`, but for the `seen` ones, in the
+    order they were written
+    """
+    return (
+        await db_session.execute(
+            select(*_history_columns())
+            .where(
+                LensesHistory.update_timestamp >= since,
+                LensesHistory.id
+                != all_(bindparam("seen", list(seen), type_=ARRAY(Integer))),
+            )
+            .order_by(LensesHistory.update_timestamp, LensesHistory.id)
+            .limit(limit)
+        )
+    ).all()
+
+
+async def get_history_after(db_session: AsyncSession, history_id: int, limit: int):
+    return (
+        await db_session.execute(
+            select(*_history_columns())
+            .where(LensesHistory.id > history_id)
+            .order_by(LensesHistory.id)
+            .limit(limit)
+        )
+    ).all()
+
+
+def export_lenses_query(
+    sort: list[list[str]] = None,
+    filter: dict = None,
+    show_deleted: bool = False,
+):
+    """
+    validates the export request up front, before any of the response is sent
+    """
+    order = _build_order(sort)
+    stmt, params = _lenses_query(filter, show_deleted, _read_columns(order))
+
+    return stmt.order_by(*_order_by(order)), params
+
+
+async def stream_lenses(db_session: AsyncSession, stmt, params: dict):
+    """
+    yields batches of rows from a server side cursor, so memory use doesn't
+    depend on the size of the catalog
+    """
+    stmt = stmt.execution_options(yield_per=settings.export_batch_size)
+    result = await db_session.stream(stmt, params)
+
+    async for rows in result.partitions():
+        yield rows
+
+
+async def get_lens(
+    db_session: AsyncSession, lens_id: int, as_of: datetime | None = None
+):
+    if as_of is not None:
+        lens = (
+            await db_session.execute(
+                select(*_read_columns([], LensAsOf)).where(
+                    LensAsOf.deleted_at.is_(None)
+                ),
+                {**_as_of_params(as_of), "lens_id": lens_id},
+            )
+        ).first()
+
+        if not lens:
+            raise ProductNotFound(lens_id)
+
+        return lens
+
     lens = (
         await db_session.scalars(
             select(Lenses)
@@ -196,22 +940,113 @@ async def get_lens(db_session: AsyncSession, lens_id: int):
     return lens
 
 
+async def warm_up(db_session: AsyncSession):
+    """
+    runs the statements of the most common reads once, which prepares them on
+    the session's connection
+    """
+    await get_catalog_version(db_session)
+    await get_lenses(db_session, range=[0, settings.default_page_size], as_rows=True)
+    await get_lenses_page(db_session, settings.default_page_size, as_rows=True)
+    try:
+        await get_lens(db_session, 0)
+    except ProductNotFound:
+        pass
+    await db_session.rollback()
+
+
+def _grid_axis(values: set[Decimal]) -> list[Decimal]:
+    """
+    every step between the lowest and highest value, plus any off-step values
+    """
+    step = settings.stock_matrix_step
+    low, high = min(values), max(values)
+    steps = int((high - low) / step)
+
+    return sorted(values | {low + i * step for i in range(steps + 1)})
+
+
+async def get_reorder_report(
+    db_session: AsyncSession,
+    rank: str = "shortage",
+    limit: int | None = None,
+    filter: list | None = None,
+):
+    """
+    the lenses below their storage limit, largest shortage or reorder cost
+    (shortage * unit_price) first. served by ix_lenses_reorder
+    """
+    reorder_cost = (Lenses.shortage * Lenses.unit_price).label("reorder_cost")
+    stmt, params = _lenses_query(
+        filter,
+        False,
+        [*_read_columns([]), Lenses.shortage, Lenses.fill_ratio, reorder_cost],
+    )
+    stmt = (
+        stmt.where(Lenses.shortage > 0)
+        .order_by(desc(Lenses.shortage if rank == "shortage" else reorder_cost))
+        .order_by(Lenses.id)
+        .limit(limit or settings.default_page_size)
+    )
+
+    return (await db_session.execute(stmt, params)).all()
+
+
+async def get_stock_matrix(
+    db_session: AsyncSession, lens_type: str | None = None
+) -> list[dict]:
+    """
+    dense sphere x cylinder grids of quantity and storage fill per lens_type,
+    read from lens_stock_matrix in one query
+    """
+    stmt = select(*LensStockMatrix.__table__.c).order_by(LensStockMatrix.lens_type)
+    if lens_type is not None:
+        stmt = stmt.where(LensStockMatrix.lens_type == lens_type)
+
+    matrices = []
+    for lens_type, cells in itertools.groupby(
+        await db_session.execute(stmt), key=lambda cell: cell.lens_type
+    ):
+        cells = {(cell.sphere, cell.cylinder): cell for cell in cells}
+        spheres = _grid_axis({sphere for sphere, _ in cells})
+        cylinders = _grid_axis({cylinder for _, cylinder in cells})
+
+        grid = [[cells.get((s, c)) for c in cylinders] for s in spheres]
+        matrices.append(
+            {
+                "lens_type": lens_type,
+                "spheres": spheres,
+                "cylinders": cylinders,
+                "quantity": [
+                    [cell.quantity if cell else 0 for cell in row] for row in grid
+                ],
+                "fill": [
+                    [
+                        (
+                            cell.limited_quantity / cell.storage_limit
+                            if cell and cell.storage_limit
+                            else None
+                        )
+                        for cell in row
+                    ]
+                    for row in grid
+                ],
+            }
+        )
+
+    return matrices
+
+
 async def create_lens(db_session: AsyncSession, lens: LensCreate):
     # TODO: allow update_source
     try:
-        new_lens = Lenses(**lens.model_dump(exclude_unset=True))
+        new_lens = Lenses(**lens.model_dump())
         db_session.add(new_lens)
 
         await db_session.flush()
 
         history_entries = [
-            LensesHistory(
-                lens_id=new_lens.id,
-                update_field=field,
-                old_value=None,
-                new_value=str(value),
-                update_type=UpdateType.CREATE,
-            )
+            history_row(new_lens.id, field, None, value, UpdateType.CREATE)
             for value, field in zip(
                 [
                     new_lens.lens_type,
@@ -233,9 +1068,8 @@ async def create_lens(db_session: AsyncSession, lens: LensCreate):
                 ],
             )
         ]
-        db_session.add_all(history_entries)
 
-        await db_session.commit()
+        await _commit(db_session, history_entries)
         await db_session.refresh(new_lens)
 
         return new_lens
@@ -267,33 +1101,25 @@ async def replace_lens(db_session: AsyncSession, lens: Lenses, update_data: Lens
         if (old_val := getattr(lens, key)) != value:
             setattr(lens, key, value)
         history_entries.append(
-            LensesHistory(
-                lens_id=lens.id,
-                update_field=get_field[key],
-                old_value=str(old_val),
-                new_value=str(value),
-                update_type=UpdateType.CREATE,
-            )
+            history_row(lens.id, get_field[key], old_val, value, UpdateType.CREATE)
         )
 
     history_entries.append(
-        LensesHistory(
-            lens_id=lens.id,
-            update_field=UpdateField.DELETED_AT,
-            old_value=str(lens.deleted_at),
-            new_value=None,
-            update_type=UpdateType.CREATE,
+        history_row(
+            lens.id,
+            UpdateField.DELETED_AT,
+            lens.deleted_at,
+            None,
+            UpdateType.CREATE,
         )
     )
 
     lens.created_at = datetime.now(timezone.utc)
-    lens.updated_at = None
+    lens.updated_at = lens.created_at
     lens.deleted_at = None
 
-    db_session.add_all(history_entries)
-
     try:
-        await db_session.commit()
+        await _commit(db_session, history_entries)
         await db_session.refresh(lens)
 
         return lens
@@ -316,28 +1142,231 @@ async def create_or_replace_lens(db_session: AsyncSession, lens: LensCreate):
     return await create_lens(db_session, lens)
 
 
-async def update_lens(db_session: AsyncSession, lens_id: int, update_data: LensUpdate):
-    get_field: dict[str, UpdateField] = {
-        "lens_type": UpdateField.LENS_TYPE,
-        "sphere": UpdateField.SPHERE,
-        "cylinder": UpdateField.CYLINDER,
-        "unit_price": UpdateField.UNIT_PRICE,
-        "quantity": UpdateField.QUANTITY,
-        "storage_limit": UpdateField.STORAGE_LIMIT,
-        "comment": UpdateField.COMMENT,
-    }
+_BULK_COLUMNS = (
+    "id",
+    "lens_type",
+    "sphere",
+    "cylinder",
+    "unit_price",
+    "quantity",
+    "storage_limit",
+    "comment",
+)
 
-    lens = (
-        await db_session.execute(
-            select(Lenses)
-            .where(Lenses.id == lens_id)
-            .where(Lenses.deleted_at.is_(None))
+
+def _build_bulk_writes():
+    """
+    one INSERT and one UPDATE for any number of lenses, each column bound as
+    an array and unnested into rows
+    """
+    rows = (
+        func.unnest(
+            *(
+                bindparam(
+                    f"bulk_{column}", type_=ARRAY(Lenses.__table__.c[column].type)
+                )
+                for column in _BULK_COLUMNS
+            )
         )
-    ).scalar_one_or_none()
+        .table_valued(*_BULK_COLUMNS)
+        .render_derived()
+    )
+
+    inserts = insert(Lenses.__table__).from_select(
+        list(_BULK_COLUMNS), select(*(rows.c[column] for column in _BULK_COLUMNS))
+    )
+    replacements = (
+        update(Lenses.__table__)
+        .where(Lenses.id == rows.c.id)
+        .values(
+            **{column: rows.c[column] for column in _BULK_COLUMNS[1:]},
+            created_at=func.now(),
+            updated_at=func.now(),
+            deleted_at=None,
+        )
+    )
+    return inserts, replacements
+
+
+_insert_lenses, _replace_lenses = _build_bulk_writes()
+
+
+def _bulk_params(rows: list[dict]) -> dict[str, list]:
+    return {f"bulk_{column}": [row[column] for row in rows] for column in _BULK_COLUMNS}
+
+
+async def create_or_replace_lenses(
+    db_session: AsyncSession, new_lenses: list[LensCreate]
+):
+    """
+    set based version of create_or_replace_lens: one lookup for conflicting ids,
+    then a single statement each for the new lenses, the replaced ones and
+    their history, in one transaction. returns a result per input row, in
+    input order
+    """
+    fields = [
+        ("lens_type", UpdateField.LENS_TYPE),
+        ("sphere", UpdateField.SPHERE),
+        ("cylinder", UpdateField.CYLINDER),
+        ("unit_price", UpdateField.UNIT_PRICE),
+        ("quantity", UpdateField.QUANTITY),
+        ("storage_limit", UpdateField.STORAGE_LIMIT),
+        ("comment", UpdateField.COMMENT),
+    ]
+
+    ids = [lens.id for lens in new_lenses]
+    existing = {
+        row.id: row
+        for row in await db_session.execute(
+            select(*Lenses.__table__.c).where(
+                Lenses.id == any_(bindparam("ids", ids, type_=ARRAY(Integer)))
+            )
+        )
+    }
+
+    results = []
+    seen = set()
+    inserts = []
+    replacements = []
+    history_entries = []
+
+    for lens in new_lenses:
+        if lens.id in seen:
+            results.append(
+                {"id": lens.id, "status": "error", "detail": "Duplicate ID in request"}
+            )
+            continue
+        seen.add(lens.id)
+
+        old = existing.get(lens.id)
+        if old is not None and old.deleted_at is None:
+            results.append(
+                {
+                    "id": lens.id,
+                    "status": "error",
+                    "detail": str(ProductAlreadyExists(lens.id)),
+                }
+            )
+            continue
+
+        values = lens.model_dump()
+
+        if old is None:
+            inserts.append(values)
+            history_entries.extend(
+                history_row(lens.id, field, None, values[key], UpdateType.CREATE)
+                for key, field in fields
+            )
+            results.append({"id": lens.id, "status": "created", "detail": None})
+        else:
+            replacements.append(values)
+            history_entries.extend(
+                history_row(
+                    lens.id,
+                    field,
+                    getattr(old, key),
+                    values[key],
+                    UpdateType.CREATE,
+                )
+                for key, field in fields
+            )
+            history_entries.append(
+                history_row(
+                    lens.id,
+                    UpdateField.DELETED_AT,
+                    old.deleted_at,
+                    None,
+                    UpdateType.CREATE,
+                )
+            )
+            results.append({"id": lens.id, "status": "replaced", "detail": None})
+
+    try:
+        if inserts:
+            await db_session.execute(_insert_lenses, _bulk_params(inserts))
+        if replacements:
+            await db_session.execute(_replace_lenses, _bulk_params(replacements))
+
+        await _commit(db_session, history_entries)
+    except Exception as e:
+        await db_session.rollback()
+        raise RuntimeError(f"Database error {type(e)}: {e}")
+
+    return results
+
+
+_UPDATE_FIELDS: dict[str, UpdateField] = {
+    "lens_type": UpdateField.LENS_TYPE,
+    "sphere": UpdateField.SPHERE,
+    "cylinder": UpdateField.CYLINDER,
+    "unit_price": UpdateField.UNIT_PRICE,
+    "quantity": UpdateField.QUANTITY,
+    "storage_limit": UpdateField.STORAGE_LIMIT,
+    "comment": UpdateField.COMMENT,
+}
+
+
+def _history_of_changes(
+    updated,
+    fields: dict[str, UpdateField],
+    update_type: UpdateType,
+    update_notes: str | None,
+    update_source: str | None,
+):
+    """
+    INSERT ... SELECT of a history row per changed field of the rows an
+    UPDATE ... RETURNING cte returned, with the old values as old_<field>
+    """
+    return insert(LensesHistory).from_select(
+        [
+            "lens_id",
+            "update_field",
+            "old_value",
+            "new_value",
+            "update_type",
+            "update_notes",
+            "update_source",
+        ],
+        union_all(
+            *(
+                select(
+                    updated.c.id,
+                    literal(field, LensesHistory.update_field.type),
+                    cast(updated.c[f"old_{key}"], String),
+                    cast(updated.c[key], String),
+                    literal(update_type, LensesHistory.update_type.type),
+                    literal(update_notes, String),
+                    literal(update_source, String),
+                ).where(updated.c[f"old_{key}"].is_distinct_from(updated.c[key]))
+                for key, field in fields.items()
+            )
+        ),
+    )
+
+
+async def update_lens(
+    db_session: AsyncSession,
+    lens_id: int,
+    update_data: LensUpdate,
+    if_match: str | None = None,
+):
+    if update_data.updated_at is not None:
+        return await _swap_lens(db_session, lens_id, update_data, if_match)
+
+    stmt = select(Lenses).where(Lenses.id == lens_id).where(Lenses.deleted_at.is_(None))
+    if if_match is not None:
+        # held until commit, nothing can change the lens after the check
+        stmt = stmt.with_for_update()
+
+    lens = (await db_session.execute(stmt)).scalar_one_or_none()
 
     if not lens:
         raise ProductNotFound(lens_id)
 
+    if if_match is not None and not etag_matches(if_match, lens_etag(lens), weak=False):
+        await db_session.rollback()
+        raise PreconditionFailed(lens_id)
+
     update_dict = update_data.model_dump(exclude_unset=True)
 
     update_notes = update_dict.get("update_notes")
@@ -346,29 +1375,28 @@ async def update_lens(db_session: AsyncSession, lens_id: int, update_data: LensU
     history_entries = []
 
     for key, value in update_dict.items():
-        if key in ["update_notes", "update_source"]:
-            # TODO: handle these values
+        if key not in _UPDATE_FIELDS:
+            # the notes, the source and an updated_at sent as null
             continue
 
         if (old_val := getattr(lens, key)) != value:
             setattr(lens, key, value)
             history_entries.append(
-                LensesHistory(
-                    lens_id=lens_id,
-                    update_field=get_field[key],
-                    old_value=str(old_val),
-                    new_value=str(value),
-                    update_type=UpdateType.UPDATE,
-                    update_notes=update_notes,
-                    update_source=update_source,
+                history_row(
+                    lens_id,
+                    _UPDATE_FIELDS[key],
+                    old_val,
+                    value,
+                    UpdateType.UPDATE,
+                    update_notes,
+                    update_source,
                 )
             )
 
     lens.updated_at = datetime.now(timezone.utc)
-    db_session.add_all(history_entries)
 
     try:
-        await db_session.commit()
+        await _commit(db_session, history_entries)
         await db_session.refresh(lens)
 
         return lens
@@ -377,6 +1405,245 @@ async def update_lens(db_session: AsyncSession, lens_id: int, update_data: LensU
         raise RuntimeError(f"Database error {type(e)}: {e}")
 
 
+async def _swap_lens(
+    db_session: AsyncSession,
+    lens_id: int,
+    update_data: LensUpdate,
+    if_match: str | None,
+):
+    """
+    applies the update only while the lens is still at the version the client
+    read, updated_at, writing the history of the fields that changed in the
+    same statement
+    """
+    expected = update_data.updated_at
+    # the lens can only be swapped while its ETag is the one of that version
+    if if_match is not None and not etag_matches(
+        if_match, lens_etag(Lenses(id=lens_id, updated_at=expected)), weak=False
+    ):
+        raise PreconditionFailed(lens_id)
+
+    values = update_data.model_dump(
+        exclude_unset=True, exclude={"updated_at", "update_notes", "update_source"}
+    )
+    old = aliased(Lenses)
+    condition = [Lenses.id == lens_id, Lenses.deleted_at.is_(None)]
+
+    swapped = (
+        update(Lenses)
+        .where(*condition, Lenses.updated_at == expected, old.id == Lenses.id)
+        .values(**values, updated_at=func.now())
+        .returning(
+            *Lenses.__table__.c,
+            *(getattr(old, key).label(f"old_{key}") for key in values),
+        )
+        .cte("swapped")
+    )
+
+    stmt = select(swapped)
+    if values:
+        history = _history_of_changes(
+            swapped,
+            {key: _UPDATE_FIELDS[key] for key in values},
+            UpdateType.UPDATE,
+            update_data.update_notes,
+            update_data.update_source,
+        )
+        stmt = stmt.add_cte(history.cte("history"))
+
+    try:
+        lens = (await db_session.execute(stmt)).first()
+
+        if lens is None:
+            await db_session.rollback()
+        else:
+            # the history rows were written by the statement itself
+            await _commit(db_session)
+            metrics.record_history_rows(
+                UpdateType.UPDATE.value,
+                sum(
+                    lens._mapping[f"old_{key}"] != lens._mapping[key] for key in values
+                ),
+            )
+    except Exception as e:
+        await db_session.rollback()
+        raise RuntimeError(f"Database error {type(e)}: {e}")
+
+    if lens is None:
+        exists = await db_session.scalar(select(Lenses.id).where(*condition))
+        await db_session.rollback()
+
+        if exists is None:
+            raise ProductNotFound(lens_id)
+        raise VersionConflict(lens_id)
+
+    return lens
+
+
+async def adjust_lens_quantity(
+    db_session: AsyncSession, lens_id: int, adjustment: LensAdjust
+):
+    """
+    applies a quantity delta and writes its history row in a single statement,
+    so concurrent adjustments of the same lens can't lose updates
+    """
+    condition = [Lenses.id == lens_id, Lenses.deleted_at.is_(None)]
+    if not adjustment.allow_negative:
+        condition.append(Lenses.quantity + adjustment.delta >= 0)
+
+    adjusted = (
+        update(Lenses)
+        .where(*condition)
+        .values(quantity=Lenses.quantity + adjustment.delta, updated_at=func.now())
+        .returning(*Lenses.__table__.c)
+        .cte("adjusted")
+    )
+    history = (
+        insert(LensesHistory)
+        .from_select(
+            [
+                "lens_id",
+                "update_field",
+                "old_value",
+                "new_value",
+                "update_type",
+                "update_notes",
+                "update_source",
+            ],
+            select(
+                adjusted.c.id,
+                literal(UpdateField.QUANTITY, LensesHistory.update_field.type),
+                cast(adjusted.c.quantity - adjustment.delta, String),
+                cast(adjusted.c.quantity, String),
+                literal(UpdateType.UPDATE, LensesHistory.update_type.type),
+                literal(adjustment.update_notes, String),
+                literal(adjustment.update_source, String),
+            ),
+        )
+        .cte("history")
+    )
+
+    try:
+        lens = (await db_session.execute(select(adjusted).add_cte(history))).first()
+
+        if lens is None:
+            await db_session.rollback()
+        else:
+            # the history row was written by the statement itself
+            await _commit(db_session)
+            metrics.record_history_rows(UpdateType.UPDATE.value, 1)
+    except Exception as e:
+        await db_session.rollback()
+        raise RuntimeError(f"Database error {type(e)}: {e}")
+
+    if lens is None:
+        exists = await db_session.scalar(select(Lenses.id).where(*condition[:2]))
+        await db_session.rollback()
+
+        if exists is None:
+            raise ProductNotFound(lens_id)
+        raise InsufficientStock(lens_id)
+
+    return lens._asdict()
+
+
+async def mutate_lenses(db_session: AsyncSession, mutation: LensMutation):
+    """
+    applies the mutation to every active lens the filter matches in a single
+    UPDATE ... RETURNING, writing the history of what changed from it in the
+    same statement. with dry_run only counts them.
+
+    at most max_affected + 1 lenses are locked and updated, one more than
+    allowed is rolled back without looking for the rest
+    """
+    condition, params = _build_filter_query(mutation.filter)
+    active = [Lenses.deleted_at.is_(None), condition]
+
+    if mutation.dry_run:
+        affected = await db_session.scalar(
+            select(func.count()).select_from(Lenses).where(*active), params
+        )
+        return {"affected": affected, "dry_run": True}
+
+    if mutation.operation == "delete":
+        values = {"deleted_at": func.now()}
+        fields = {"deleted_at": UpdateField.DELETED_AT}
+        update_type = UpdateType.DELETE
+    elif mutation.operation == "set":
+        if mutation.values is None or not mutation.values.model_fields_set:
+            raise MalformedInput("set needs values")
+        values = {
+            **mutation.values.model_dump(exclude_unset=True),
+            "updated_at": func.now(),
+        }
+        fields = {key: _UPDATE_FIELDS[key] for key in mutation.values.model_fields_set}
+        update_type = UpdateType.UPDATE
+    else:
+        if mutation.percent is None:
+            raise MalformedInput("scale_price needs percent")
+        values = {
+            "unit_price": func.round(
+                Lenses.unit_price * (100 + mutation.percent) / 100, 2
+            ),
+            "updated_at": func.now(),
+        }
+        fields = {"unit_price": UpdateField.UNIT_PRICE}
+        update_type = UpdateType.UPDATE
+
+    matched = (
+        select(Lenses.id)
+        .where(*active)
+        .order_by(Lenses.id)
+        .limit(mutation.max_affected + 1)
+        .with_for_update()
+    )
+    old = aliased(Lenses)
+    updated = (
+        update(Lenses)
+        .where(*active, Lenses.id.in_(matched), old.id == Lenses.id)
+        .values(**values)
+        .returning(
+            Lenses.id,
+            *(getattr(Lenses, key) for key in fields),
+            *(getattr(old, key).label(f"old_{key}") for key in fields),
+        )
+        .cte("updated")
+    )
+    history = (
+        _history_of_changes(
+            updated,
+            fields,
+            update_type,
+            mutation.update_notes,
+            mutation.update_source,
+        )
+        .returning(LensesHistory.id)
+        .cte("history")
+    )
+    stmt = select(
+        select(func.count()).select_from(updated).scalar_subquery(),
+        select(func.count()).select_from(history).scalar_subquery(),
+    )
+
+    try:
+        affected, history_rows = (await db_session.execute(stmt, params)).one()
+
+        if affected == 0 or affected > mutation.max_affected:
+            await db_session.rollback()
+        else:
+            # the history rows were written by the statement itself
+            await _commit(db_session)
+            metrics.record_history_rows(update_type.value, history_rows)
+    except Exception as e:
+        await db_session.rollback()
+        raise RuntimeError(f"Database error {type(e)}: {e}")
+
+    if affected > mutation.max_affected:
+        raise TooManyAffected(mutation.max_affected)
+
+    return {"affected": affected, "dry_run": False}
+
+
 async def delete_lens(db_session: AsyncSession, lens_id: int):
     lens = (
         await db_session.execute(
@@ -395,18 +1662,19 @@ async def delete_lens(db_session: AsyncSession, lens_id: int):
         stmt = update(Lenses).where(Lenses.id == lens_id).values(deleted_at=utc_now)
         await db_session.execute(stmt)
 
-        db_session.add(
-            LensesHistory(
-                lens_id=lens_id,
-                update_field=UpdateField.DELETED_AT,
-                old_value=None,
-                new_value=str(utc_now),
-                update_type=UpdateType.DELETE,
-            )
+        await _commit(
+            db_session,
+            [
+                history_row(
+                    lens_id,
+                    UpdateField.DELETED_AT,
+                    None,
+                    utc_now,
+                    UpdateType.DELETE,
+                )
+            ],
         )
 
-        await db_session.commit()
-
         return {"message": f"Lens with ID {lens_id} deleted successfully"}
     except Exception as e:
         await db_session.rollback()
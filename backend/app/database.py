@@ -1,10 +1,18 @@
 # https://github.com/ThomasAitken/demo-fastapi-async-sqlalchemy/blob/main/backend/app/database.py
+import asyncio
 import contextlib
-from typing import Any, AsyncIterator
+import itertools
+import logging
+from typing import Any, AsyncIterator, Awaitable, Callable
 
-from app.config import settings
+from app.config import Settings, settings
+from app.instrumentation import instrument_engine
+from app.metrics import InstrumentedQueuePool, instrument_pool
+from sqlalchemy import QueuePool, text
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.ext.asyncio import (
     AsyncConnection,
+    AsyncEngine,
     AsyncSession,
     async_sessionmaker,
     create_async_engine,
@@ -14,18 +22,160 @@ from sqlalchemy.orm import DeclarativeBase
 class Base(DeclarativeBase):
     __mapper_args__ = {"eager_defaults": True}
 
+logger = logging.getLogger(__name__)
+
+
+def engine_kwargs_from_settings(settings: Settings) -> dict[str, Any]:
+    return {
+        "echo": settings.echo_sql,
+        "pool_size": settings.db_pool_size,
+        "max_overflow": settings.db_max_overflow,
+        "pool_timeout": settings.db_pool_timeout,
+        "pool_recycle": settings.db_pool_recycle,
+        "pool_pre_ping": settings.db_pool_pre_ping,
+        "connect_args": {
+            "statement_cache_size": settings.db_statement_cache_size,
+            "prepared_statement_cache_size": settings.db_prepared_statement_cache_size,
+            "server_settings": settings.db_server_settings,
+        },
+    }
+
+
+def _pool_status(engine: AsyncEngine) -> dict[str, Any]:
+    pool = engine.pool
+    if not isinstance(pool, QueuePool):
+        return {"pool": type(pool).__name__}
+
+    return {
+        "pool": type(pool).__name__,
+        "size": pool.size(),
+        "max_overflow": pool._max_overflow,
+        "checked_in": pool.checkedin(),
+        "checked_out": pool.checkedout(),
+        "overflow": pool.overflow(),
+    }
+
+
+def _create_engine(
+    host: str, name: str, engine_kwargs: dict[str, Any]
+) -> AsyncEngine:
+    engine = create_async_engine(
+        host,
+        **{
+            "poolclass": InstrumentedQueuePool,
+            "pool_logging_name": name,
+            **engine_kwargs,
+        },
+    )
+    instrument_engine(engine)
+    instrument_pool(engine, name)
+    return engine
+
+
 class DatabaseSessionManager:
-    def __init__(self, host: str, engine_kwargs: dict[str, Any] = {}):
-        self._engine = create_async_engine(host, **engine_kwargs)
+    def __init__(
+        self,
+        host: str,
+        engine_kwargs: dict[str, Any] = {},
+        replica_hosts: list[str] = [],
+    ):
+        self._engine = _create_engine(host, "primary", engine_kwargs)
         self._sessionmaker = async_sessionmaker(autocommit=False, bind=self._engine, expire_on_commit=False)
 
+        # read only traffic is spread over the replicas, round robin
+        self._replica_engines = [
+            _create_engine(replica_host, f"replica{i}", engine_kwargs)
+            for i, replica_host in enumerate(replica_hosts)
+        ]
+        self._replica_sessionmakers = [
+            async_sessionmaker(autocommit=False, bind=engine, expire_on_commit=False)
+            for engine in self._replica_engines
+        ]
+        self._next_replica = itertools.count()
+
+    @property
+    def has_replicas(self) -> bool:
+        return bool(self._replica_sessionmakers)
+
     async def close(self):
         if self._engine is None:
             raise Exception("DatabaseSessionManager is not initialized")
         await self._engine.dispose()
+        for engine in self._replica_engines:
+            await engine.dispose()
 
         self._engine = None
         self._sessionmaker = None
+        self._replica_engines = []
+        self._replica_sessionmakers = []
+
+    def pool_status(self) -> dict[str, Any]:
+        if self._engine is None:
+            raise Exception("DatabaseSessionManager is not initialized")
+
+        status = _pool_status(self._engine)
+        if self._replica_engines:
+            status["replicas"] = [_pool_status(e) for e in self._replica_engines]
+
+        return status
+
+    async def check_capacity(self, workers: int):
+        """
+        warns when every worker filling its pool would exceed max_connections
+        """
+        status = self.pool_status()
+        if "size" not in status:
+            return
+
+        try:
+            async with self.connect() as connection:
+                max_connections = int(
+                    await connection.scalar(text("SHOW max_connections"))
+                )
+                reserved = int(
+                    await connection.scalar(text("SHOW superuser_reserved_connections"))
+                )
+        except (OSError, SQLAlchemyError) as e:
+            logger.warning("Could not check the connection limit: %s", e)
+            return
+
+        # plus the connection each worker listens for catalog changes on
+        needed = workers * (status["size"] + status["max_overflow"] + 1)
+        if needed > max_connections - reserved:
+            logger.warning(
+                "%d workers can open up to %d connections, but the server only "
+                "allows %d (max_connections %d, %d reserved)",
+                workers,
+                needed,
+                max_connections - reserved,
+                max_connections,
+                reserved,
+            )
+
+    async def warm_up(self, prepare: Callable[[AsyncSession], Awaitable[Any]]):
+        """
+        fills every pool up to its size at once, running prepare on each new
+        connection so the statements it runs are already prepared there
+        """
+        for engine, sessionmaker in [
+            (self._engine, self._sessionmaker),
+            *zip(self._replica_engines, self._replica_sessionmakers),
+        ]:
+            if not isinstance(engine.pool, QueuePool):
+                continue
+
+            try:
+                # all held until the end, so each gets its own connection
+                async with contextlib.AsyncExitStack() as stack:
+                    sessions = [
+                        await stack.enter_async_context(sessionmaker())
+                        for _ in range(engine.pool.size())
+                    ]
+                    await asyncio.gather(*(prepare(session) for session in sessions))
+            except (OSError, SQLAlchemyError) as e:
+                logger.warning(
+                    "Could not warm up the %s pool: %s", engine.pool.logging_name, e
+                )
 
     @contextlib.asynccontextmanager
     async def connect(self) -> AsyncIterator[AsyncConnection]:
@@ -40,11 +190,15 @@ class DatabaseSessionManager:
                 raise
 
     @contextlib.asynccontextmanager
-    async def session(self) -> AsyncIterator[AsyncSession]:
+    async def session(self, readonly: bool = False) -> AsyncIterator[AsyncSession]:
         if self._sessionmaker is None:
             raise Exception("DatabaseSessionManager is not initialized")
 
-        session = self._sessionmaker()
+        if readonly and self._replica_sessionmakers:
+            index = next(self._next_replica) % len(self._replica_sessionmakers)
+            session = self._replica_sessionmakers[index]()
+        else:
+            session = self._sessionmaker()
         try:
             yield session
         except Exception:
@@ -54,9 +208,18 @@ class DatabaseSessionManager:
             await session.close()
 
 
-sessionmanager = DatabaseSessionManager(settings.database_url, {"echo": settings.echo_sql})
+sessionmanager = DatabaseSessionManager(
+    settings.database_url,
+    engine_kwargs_from_settings(settings),
+    settings.database_replica_urls,
+)
 
 
 async def get_db_session():
     async with sessionmanager.session() as session:
         yield session
+
+
+def get_session_factory():
+    # for responses that outlive the request's dependencies, like streams
+    return sessionmanager.session
@@ -1,7 +1,147 @@
-from typing import Annotated
+import functools
+import math
+import time
+from typing import Annotated, AsyncContextManager, Callable
 
-from app.database import get_db_session
-from fastapi import Depends
+from app.cache import ResponseCache
+from app.config import settings
+from app.crud.catalog import get_catalog_version
+from app.database import get_db_session, get_session_factory, sessionmanager
+from app.etags import etag_headers, etag_matches, list_etag
+from app.notifications import listener as catalog_listener
+from fastapi import Depends, HTTPException, Request, Response
 from sqlalchemy.ext.asyncio import AsyncSession
 
-DBSessionDep = Annotated[AsyncSession, Depends(get_db_session)]
\ No newline at end of file
+PRIMARY_PIN_COOKIE = "inventory_primary_until"
+PRIMARY_PIN_HEADER = "X-Primary-Until"
+
+response_cache = ResponseCache(settings.response_cache_max_bytes)
+
+
+def _pinned_to_primary(request: Request) -> bool:
+    """
+    clients that wrote recently read from the primary, so they never see a
+    replica that hasn't caught up with their own write yet. a pin further out
+    than read_your_writes_window wasn't set by pin_to_primary and is ignored
+    """
+    token = request.headers.get(PRIMARY_PIN_HEADER) or request.cookies.get(
+        PRIMARY_PIN_COOKIE
+    )
+    try:
+        until = float(token)
+    except (TypeError, ValueError):
+        return False
+
+    now = time.time()
+    return now < until <= now + settings.read_your_writes_window
+
+
+async def get_db_read_session(request: Request):
+    readonly = not _pinned_to_primary(request)
+    async with sessionmanager.session(readonly=readonly) as session:
+        # cached totals may have been counted on a lagging replica
+        session.info["pinned_to_primary"] = not readonly
+        yield session
+
+
+def get_read_session_factory(request: Request):
+    readonly = not _pinned_to_primary(request)
+    return functools.partial(sessionmanager.session, readonly=readonly)
+
+
+def pin_to_primary(response: Response):
+    if not settings.database_replica_urls:
+        return
+
+    until = f"{time.time() + settings.read_your_writes_window:.3f}"
+    response.headers[PRIMARY_PIN_HEADER] = until
+    response.set_cookie(
+        PRIMARY_PIN_COOKIE,
+        until,
+        max_age=math.ceil(settings.read_your_writes_window),
+        httponly=True,
+        samesite="lax",
+    )
+
+
+DBSessionDep = Annotated[AsyncSession, Depends(get_db_session)]
+DBReadSessionDep = Annotated[AsyncSession, Depends(get_db_read_session)]
+
+
+def catalog_generation(request: Request) -> int | None:
+    """
+    the catalog version this worker was last notified of. None for clients
+    that just wrote, whose own write may not have been notified yet
+    """
+    if _pinned_to_primary(request):
+        return None
+
+    return catalog_listener.generation
+
+
+def _not_modified(request: Request, etag: str):
+    if etag_matches(request.headers.get("If-None-Match"), etag):
+        raise HTTPException(status_code=304, headers=etag_headers(etag))
+
+
+async def catalog_version_etag(
+    request: Request, db_session: AsyncSession
+) -> tuple[int, str]:
+    """
+    answers a matching If-None-Match with 304 before the list is queried, with
+    no query at all when the worker knows the current version
+    """
+    generation = catalog_generation(request)
+    if generation is not None:
+        _not_modified(request, list_etag(generation, request))
+
+    version = await get_catalog_version(db_session)
+    etag = list_etag(version, request)
+    _not_modified(request, etag)
+
+    return version, etag
+
+
+async def catalog_etag(request: Request, db_session: DBReadSessionDep) -> str:
+    _, etag = await catalog_version_etag(request, db_session)
+    return etag
+
+
+def _cache_key(request: Request) -> tuple:
+    return ResponseCache.key(request.url.path, request.query_params.multi_items())
+
+
+def cached_list(request: Request) -> Response | None:
+    """
+    the cached response at the current catalog version, if there is one
+    """
+    generation = catalog_generation(request)
+    if not settings.response_cache or generation is None:
+        return None
+
+    _not_modified(request, list_etag(generation, request))
+    entry = response_cache.get(generation, _cache_key(request))
+    if entry is None:
+        return None
+
+    body, headers = entry
+    return Response(body, media_type="application/json", headers=headers)
+
+
+def cache_list(
+    request: Request, version: int, response: Response, headers: dict[str, str]
+) -> Response:
+    if settings.response_cache:
+        response_cache.set(version, _cache_key(request), response.body, headers)
+
+    return response
+
+
+CatalogETagDep = Annotated[str, Depends(catalog_etag)]
+CachedListDep = Annotated[Response | None, Depends(cached_list)]
+SessionFactoryDep = Annotated[
+    Callable[[], AsyncContextManager[AsyncSession]], Depends(get_session_factory)
+]
+ReadSessionFactoryDep = Annotated[
+    Callable[[], AsyncContextManager[AsyncSession]], Depends(get_read_session_factory)
+]
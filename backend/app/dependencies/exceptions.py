@@ -13,6 +13,26 @@ class ProductAlreadyExists(Exception):
         super().__init__(f"Product with ID {product_id} already exists")
 
 
+class InsufficientStock(Exception):
+    def __init__(self, product_id: int):
+        super().__init__(f"Not enough stock of product with ID {product_id}")
+
+
+class TooManyAffected(Exception):
+    def __init__(self, limit: int):
+        super().__init__(f"More than the limit of {limit} products match")
+
+
 class MalformedInput(Exception):
     def __init__(self, message: str):
         super().__init__(message)
+
+
+class VersionConflict(Exception):
+    def __init__(self, product_id: int):
+        super().__init__(f"Product with ID {product_id} was updated by someone else")
+
+
+class PreconditionFailed(Exception):
+    def __init__(self, product_id: int):
+        super().__init__(f"Product with ID {product_id} has changed")
@@ -0,0 +1,50 @@
+"""
+strong ETags for catalog reads. a lens is tagged by its id and updated_at, a
+list by the catalog version and the request it answers, see
+app.crud.catalog
+"""
+
+import hashlib
+import json
+from datetime import datetime, timedelta, timezone
+
+from fastapi import Request
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def lens_etag(lens) -> str:
+    micros = (lens.updated_at - EPOCH) // timedelta(microseconds=1)
+    return f'"{lens.id}-{micros}"'
+
+
+def list_etag(version: int, request: Request) -> str:
+    key = json.dumps([request.url.path, sorted(request.query_params.multi_items())])
+    digest = hashlib.blake2b(key.encode(), digest_size=8).hexdigest()
+    return f'"{version}-{digest}"'
+
+
+def etag_matches(header: str | None, etag: str, weak: bool = True) -> bool:
+    """
+    If-None-Match compares weakly, If-Match strongly
+    """
+    if header is None:
+        return False
+    if header.strip() == "*":
+        return True
+
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            if not weak:
+                continue
+            tag = tag[2:]
+        if tag == etag:
+            return True
+
+    return False
+
+
+def etag_headers(etag: str) -> dict[str, str]:
+    # cached, but revalidated with If-None-Match on every use
+    return {"ETag": etag, "Cache-Control": "no-cache"}
@@ -0,0 +1,309 @@
+"""
+Idempotency-Key support for the lens routes. the first response to a POST or
+PUT sent with a key is stored in idempotency_keys and replayed to retries of
+it, which never reach the route.
+
+the first request claims the key with a pending row, committed before the
+route runs, and fills in its response once it is sent. concurrent duplicates
+poll for the response without holding a connection in between, so keyed
+requests need no more connections than any others. a worker dying before
+the response is stored leaves the claim pending until pending_ttl, when a
+retry takes it over and runs again
+"""
+
+import asyncio
+import contextlib
+import hashlib
+import logging
+from datetime import timedelta
+from typing import AsyncContextManager, Callable
+
+from app.config import settings
+from app.models import IdempotencyKey
+from sqlalchemy import and_, delete, func, or_, select, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.datastructures import Headers
+from starlette.responses import JSONResponse, Response
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENT_PREFIX = "/api/inventory/lenses"
+IDEMPOTENT_METHODS = ("POST", "PUT")
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+MAX_KEY_LENGTH = 255
+# response headers worth replaying, the rest are recomputed or per request
+_STORED_HEADERS = ("content-type", "etag", "location")
+
+
+def _fingerprint(scope, body: bytes) -> bytes:
+    digest = hashlib.blake2b(digest_size=16)
+    for part in (scope["method"], scope["path"], scope["query_string"].decode()):
+        digest.update(part.encode() + b"\0")
+    digest.update(body)
+    return digest.digest()
+
+
+async def _read_body(receive) -> bytes:
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] != "http.request":
+            break
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body", False):
+            break
+    return b"".join(chunks)
+
+
+class IdempotencyStore:
+    def __init__(
+        self,
+        ttl: float = 24 * 60 * 60,
+        purge_interval: float = 60 * 60,
+        wait: float = 30.0,
+        pending_ttl: float = 5 * 60,
+        poll_interval: float = 0.1,
+    ):
+        self.ttl = timedelta(seconds=ttl)
+        self.purge_interval = purge_interval
+        self.wait = wait
+        self.pending_ttl = timedelta(seconds=pending_ttl)
+        self.poll_interval = poll_interval
+        self.session_factory: Callable[[], AsyncContextManager[AsyncSession]] | None = (
+            None
+        )
+        self._task: asyncio.Task | None = None
+
+    def start(self, session_factory: Callable[[], AsyncContextManager[AsyncSession]]):
+        self.session_factory = session_factory
+        self._task = asyncio.create_task(self._purge_periodically())
+
+    async def stop(self):
+        self.session_factory = None
+        if self._task is None:
+            return
+
+        self._task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._task
+        self._task = None
+
+    async def claim(
+        self, db_session: AsyncSession, key: str, fingerprint: bytes
+    ) -> IdempotencyKey | None:
+        """
+        claims the key for a request, committed right away. returns None once
+        claimed, or the row of the request that holds it
+        """
+        values = {
+            "fingerprint": fingerprint,
+            "status_code": None,
+            "headers": None,
+            "body": None,
+            "created_at": func.now(),
+        }
+        # expired responses and abandoned claims that weren't purged yet are
+        # taken over
+        stmt = (
+            insert(IdempotencyKey)
+            .values(key=key, **values)
+            .on_conflict_do_update(
+                index_elements=["key"],
+                set_=values,
+                where=or_(
+                    IdempotencyKey.created_at <= func.now() - self.ttl,
+                    and_(
+                        IdempotencyKey.status_code.is_(None),
+                        IdempotencyKey.created_at <= func.now() - self.pending_ttl,
+                    ),
+                ),
+            )
+            .returning(IdempotencyKey.key)
+        )
+        while True:
+            held = None
+            claimed = await db_session.scalar(stmt)
+            if claimed is None:
+                held = await db_session.scalar(
+                    select(IdempotencyKey).where(IdempotencyKey.key == key)
+                )
+            await db_session.commit()
+
+            if claimed is not None or held is not None:
+                return held
+            # released in between, by a request that failed
+
+    async def acquire(self, key: str, fingerprint: bytes) -> IdempotencyKey | None:
+        """
+        claims the key, or returns the row of the request that holds it once
+        that has a response. a row still pending is returned after `wait`
+        """
+        deadline = asyncio.get_running_loop().time() + self.wait
+        while True:
+            async with self.session_factory() as db_session:
+                held = await self.claim(db_session, key, fingerprint)
+
+            if (
+                held is None
+                or held.status_code is not None
+                or held.fingerprint != fingerprint
+                or asyncio.get_running_loop().time() >= deadline
+            ):
+                return held
+            await asyncio.sleep(self.poll_interval)
+
+    async def save(
+        self,
+        db_session: AsyncSession,
+        key: str,
+        status_code: int,
+        headers: dict[str, str],
+        body: bytes,
+    ):
+        await db_session.execute(
+            update(IdempotencyKey)
+            .where(IdempotencyKey.key == key, IdempotencyKey.status_code.is_(None))
+            .values(
+                status_code=status_code,
+                headers=headers,
+                body=body,
+                created_at=func.now(),
+            )
+        )
+        await db_session.commit()
+
+    async def release(self, db_session: AsyncSession, key: str):
+        """lets the retries of a request that failed run again"""
+        await db_session.execute(
+            delete(IdempotencyKey).where(
+                IdempotencyKey.key == key, IdempotencyKey.status_code.is_(None)
+            )
+        )
+        await db_session.commit()
+
+    async def purge(self, db_session: AsyncSession) -> int:
+        result = await db_session.execute(
+            delete(IdempotencyKey).where(
+                IdempotencyKey.created_at <= func.now() - self.ttl
+            )
+        )
+        await db_session.commit()
+        return result.rowcount
+
+    async def _purge_periodically(self):
+        while True:
+            try:
+                async with self.session_factory() as db_session:
+                    if purged := await self.purge(db_session):
+                        logger.info("Purged %d expired idempotency keys", purged)
+            except (OSError, SQLAlchemyError) as e:
+                logger.warning("Could not purge the idempotency keys: %s", e)
+
+            await asyncio.sleep(self.purge_interval)
+
+
+class IdempotencyMiddleware:
+    """
+    replays the stored response to POST and PUT requests on the lens routes
+    whose Idempotency-Key was seen before. 5xx responses aren't stored, their
+    retries run again. a duplicate of a request still running after `wait`
+    gets a 409
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] != "http"
+            or scope["method"] not in IDEMPOTENT_METHODS
+            or not scope["path"].startswith(IDEMPOTENT_PREFIX)
+            or store.session_factory is None
+        ):
+            return await self.app(scope, receive, send)
+
+        key = Headers(scope=scope).get(IDEMPOTENCY_HEADER)
+        if key is None:
+            return await self.app(scope, receive, send)
+        if not key or len(key) > MAX_KEY_LENGTH:
+            response = JSONResponse(
+                {"detail": f"{IDEMPOTENCY_HEADER} must be 1 to 255 characters"},
+                status_code=400,
+            )
+            return await response(scope, receive, send)
+
+        body = await _read_body(receive)
+        fingerprint = _fingerprint(scope, body)
+
+        stored = await store.acquire(key, fingerprint)
+        if stored is not None:
+            if stored.fingerprint != fingerprint:
+                response = JSONResponse(
+                    {"detail": f"{IDEMPOTENCY_HEADER} was used for another request"},
+                    status_code=422,
+                )
+            elif stored.status_code is None:
+                response = JSONResponse(
+                    {"detail": f"A request with this {IDEMPOTENCY_HEADER} is running"},
+                    status_code=409,
+                )
+            else:
+                response = Response(
+                    stored.body,
+                    status_code=stored.status_code,
+                    headers={**stored.headers, REPLAYED_HEADER: "true"},
+                )
+            return await response(scope, receive, send)
+
+        received = False
+
+        async def receive_body():
+            nonlocal received
+            if received:
+                return await receive()
+            received = True
+            return {"type": "http.request", "body": body, "more_body": False}
+
+        status_code = 500
+        headers = {}
+        chunks = []
+
+        async def send_and_capture(message):
+            nonlocal status_code, headers
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                response_headers = Headers(raw=message.get("headers", []))
+                headers = {
+                    name: response_headers[name]
+                    for name in _STORED_HEADERS
+                    if name in response_headers
+                }
+            elif message["type"] == "http.response.body":
+                chunks.append(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive_body, send_and_capture)
+        except BaseException:
+            # a response cut short isn't stored either
+            status_code = 500
+            raise
+        finally:
+            async with store.session_factory() as db_session:
+                if status_code < 500:
+                    await store.save(
+                        db_session, key, status_code, headers, b"".join(chunks)
+                    )
+                else:
+                    await store.release(db_session, key)
+
+
+store = IdempotencyStore(
+    settings.idempotency_ttl,
+    settings.idempotency_purge_interval,
+    settings.idempotency_wait,
+    settings.idempotency_pending_ttl,
+)
@@ -0,0 +1,113 @@
+import contextlib
+import contextvars
+import time
+from typing import Iterator
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+from starlette.datastructures import MutableHeaders
+
+
+class RequestStats:
+    """
+    SQL statements and time spent by one request. Stats of nested scopes,
+    such as a request made inside track_queries(), also count towards the
+    enclosing scope.
+    """
+
+    def __init__(self, parent: "RequestStats | None" = None):
+        self.parent = parent
+        self.queries = 0
+        self.db_time = 0.0
+        self.serialize_time = 0.0
+
+    def add_query(self, duration: float, count: int = 1):
+        stats = self
+        while stats is not None:
+            stats.queries += count
+            stats.db_time += duration
+            stats = stats.parent
+
+    def add_serialize(self, duration: float):
+        stats = self
+        while stats is not None:
+            stats.serialize_time += duration
+            stats = stats.parent
+
+    def server_timing(self, total: float) -> str:
+        return (
+            f'db;dur={self.db_time * 1000:.2f};desc="{self.queries} queries", '
+            f"serialize;dur={self.serialize_time * 1000:.2f}, "
+            f"total;dur={total * 1000:.2f}"
+        )
+
+
+_current_stats: contextvars.ContextVar[RequestStats | None] = contextvars.ContextVar(
+    "request_stats", default=None
+)
+
+
+def instrument_engine(engine: AsyncEngine):
+    """
+    attributes every statement run on the engine to the current request
+    """
+
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, many):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine.sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, many):
+        start = conn.info["query_start"].pop()
+        if (stats := _current_stats.get()) is not None:
+            # an executemany runs the statement once per row
+            count = len(parameters) if many else 1
+            stats.add_query(time.perf_counter() - start, count)
+
+
+@contextlib.contextmanager
+def track_queries() -> Iterator[RequestStats]:
+    stats = RequestStats(parent=_current_stats.get())
+    token = _current_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _current_stats.reset(token)
+
+
+@contextlib.contextmanager
+def time_serialization():
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if (stats := _current_stats.get()) is not None:
+            stats.add_serialize(time.perf_counter() - start)
+
+
+class ServerTimingMiddleware:
+    """
+    reports the request's db and serialization time in a Server-Timing header
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        start = time.perf_counter()
+
+        with track_queries() as stats:
+
+            async def send_with_timing(message):
+                if message["type"] == "http.response.start":
+                    headers = MutableHeaders(scope=message)
+                    headers.append(
+                        "Server-Timing",
+                        stats.server_timing(time.perf_counter() - start),
+                    )
+                await send(message)
+
+            await self.app(scope, receive, send_with_timing)
@@ -1,13 +1,21 @@
+import asyncio
 import logging
 import sys
 from contextlib import asynccontextmanager
 
 import uvicorn
-from fastapi import FastAPI
+from fastapi import FastAPI, Response
 from fastapi.middleware.cors import CORSMiddleware
 
 from app.config import settings
+from app.crud import lenses
+from app.crud.history import writer as history_writer
 from app.database import sessionmanager
+from app import metrics
+from app.idempotency import IdempotencyMiddleware, store as idempotency_store
+from app.instrumentation import ServerTimingMiddleware
+from app.maintenance import ensure_partitions_on_startup, snapshot_periodically
+from app.notifications import change_feed, listener as catalog_listener
 from app.routers.inventory import router as inventory_router
 
 
@@ -20,14 +28,34 @@ async def lifespan(app: FastAPI):
     Function that handles startup and shutdown events.
     To understand more, read https://fastapi.tiangolo.com/advanced/events/
     """
+    await sessionmanager.check_capacity(settings.workers)
+    await ensure_partitions_on_startup(sessionmanager)
+    if settings.db_warm_up:
+        await sessionmanager.warm_up(lenses.warm_up)
+    await history_writer.start(sessionmanager.session)
+    await catalog_listener.start(settings.database_url)
+    change_feed.start(sessionmanager.session)
+    idempotency_store.start(sessionmanager.session)
+    if settings.snapshot_interval is not None:
+        snapshots = asyncio.create_task(snapshot_periodically(sessionmanager))
     yield
+    # in-flight requests have been drained by the server by now, see app.server
+    if settings.snapshot_interval is not None:
+        snapshots.cancel()
+    await idempotency_store.stop()
+    await change_feed.stop()
+    await catalog_listener.stop()
+    await history_writer.stop()
     if sessionmanager._engine is not None:
         # Close the DB connection
         await sessionmanager.close()
+    metrics.mark_process_dead()
 
 
 app = FastAPI(lifespan=lifespan)
 app.include_router(inventory_router)
+# inside CORS, so replayed responses get its headers too
+app.add_middleware(IdempotencyMiddleware)
 
 origins = [
     "http://localhost:5173",
@@ -39,10 +67,30 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
-    expose_headers=["X-Total-Count"],
+    expose_headers=[
+        "X-Total-Count",
+        "X-Next-Cursor",
+        "X-Prev-Cursor",
+        "X-Primary-Until",
+        "Server-Timing",
+        "ETag",
+        "Idempotent-Replayed",
+    ],
 )
+app.add_middleware(ServerTimingMiddleware)
+app.add_middleware(metrics.MetricsMiddleware)
 
 
 @app.get("/")
 async def root():
     return {"message": "Hello World"}
+
+
+@app.get("/status/database")
+async def database_status():
+    return sessionmanager.pool_status()
+
+
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics():
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE_LATEST)
@@ -0,0 +1,302 @@
+"""
+partition maintenance for lenses_history, which is range partitioned by calendar
+month (UTC) on update_timestamp, and the catalog snapshots as_of reads start
+from. meant to run daily, e.g. from cron:
+
+    python -m app.maintenance --ahead 3 --retention 24 --archive-dir /backups
+
+the app also takes snapshots itself, every settings.snapshot_interval
+"""
+
+import argparse
+import asyncio
+import gzip
+import logging
+import os
+import re
+from datetime import date, datetime, timedelta, timezone
+
+from app.config import settings
+from app.database import DatabaseSessionManager, sessionmanager
+from app.models import Lenses, LensesSnapshots
+from sqlalchemy import delete, func, insert, select, text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+logger = logging.getLogger(__name__)
+
+PARENT = "lenses_history"
+DEFAULT_PARTITION = "lenses_history_default"
+_PARTITION_NAME = re.compile(r"^lenses_history_y(\d{4})m(\d{2})$")
+
+
+def _month_start(day: date) -> date:
+    return day.replace(day=1)
+
+
+def _add_months(month: date, months: int) -> date:
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    return f"{PARENT}_y{month.year:04d}m{month.month:02d}"
+
+
+def _bound(month: date) -> str:
+    return f"{month.isoformat()} 00:00:00+00"
+
+
+async def _lock(connection: AsyncConnection):
+    # serializes concurrent runs, e.g. several workers starting at once
+    await connection.execute(
+        text("SELECT pg_advisory_xact_lock(hashtext('lenses_history_partitions'))")
+    )
+
+
+async def list_partitions(connection: AsyncConnection) -> list[date]:
+    """
+    months of the monthly partitions currently attached, oldest first
+    """
+    names = await connection.scalars(
+        text("""
+            SELECT c.relname
+            FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = CAST(:parent AS regclass)
+            """),
+        {"parent": PARENT},
+    )
+
+    return sorted(
+        date(int(match[1]), int(match[2]), 1)
+        for name in names
+        if (match := _PARTITION_NAME.match(name))
+    )
+
+
+async def create_partition(connection: AsyncConnection, month: date):
+    """
+    creates the partition for the month, moving over any of its rows that
+    already landed in the default partition
+    """
+    name = partition_name(month)
+    start, end = _bound(month), _bound(_add_months(month, 1))
+
+    await connection.execute(
+        text(
+            f"CREATE TABLE {name} "
+            f"(LIKE {PARENT} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"
+        )
+    )
+    await connection.execute(
+        text(f"""
+            WITH moved AS (
+                DELETE FROM {DEFAULT_PARTITION}
+                WHERE update_timestamp >= :start AND update_timestamp < :end
+                RETURNING *
+            )
+            INSERT INTO {name} SELECT * FROM moved
+            """),
+        {
+            "start": datetime.fromisoformat(start),
+            "end": datetime.fromisoformat(end),
+        },
+    )
+    await connection.execute(
+        text(
+            f"ALTER TABLE {PARENT} ATTACH PARTITION {name} "
+            f"FOR VALUES FROM ('{start}') TO ('{end}')"
+        )
+    )
+
+
+async def ensure_partitions(
+    connection: AsyncConnection, ahead: int, today: date | None = None
+) -> list[str]:
+    """
+    creates the partitions of the current month and the next `ahead` months
+    """
+    await _lock(connection)
+
+    current = _month_start(today or datetime.now(timezone.utc).date())
+    existing = set(await list_partitions(connection))
+
+    created = []
+    for month in (_add_months(current, i) for i in range(ahead + 1)):
+        if month not in existing:
+            await create_partition(connection, month)
+            created.append(partition_name(month))
+
+    return created
+
+
+async def _export(connection: AsyncConnection, name: str, path: str):
+    raw_connection = await connection.get_raw_connection()
+
+    with gzip.open(path, "wb") as archive:
+
+        async def write(data: bytes):
+            archive.write(data)
+
+        await raw_connection.driver_connection.copy_from_table(
+            name, output=write, format="csv", header=True
+        )
+
+
+async def archive_partitions(
+    connection: AsyncConnection,
+    retention: int,
+    archive_dir: str | None = None,
+    today: date | None = None,
+) -> list[str]:
+    """
+    detaches the partitions older than `retention` months. with an archive_dir
+    each one is exported there as gzipped CSV and dropped, otherwise the
+    detached table is left in place
+    """
+    await _lock(connection)
+
+    cutoff = _add_months(
+        _month_start(today or datetime.now(timezone.utc).date()), -retention
+    )
+
+    archived = []
+    for month in await list_partitions(connection):
+        if month >= cutoff:
+            break
+
+        name = partition_name(month)
+        await connection.execute(text(f"ALTER TABLE {PARENT} DETACH PARTITION {name}"))
+        if archive_dir is not None:
+            os.makedirs(archive_dir, exist_ok=True)
+            await _export(connection, name, os.path.join(archive_dir, f"{name}.csv.gz"))
+            await connection.execute(text(f"DROP TABLE {name}"))
+        archived.append(name)
+
+    # snapshots can't be replayed forward without the history after them
+    await prune_snapshots(connection, datetime.fromisoformat(_bound(cutoff)))
+
+    return archived
+
+
+async def prune_snapshots(connection: AsyncConnection, cutoff):
+    """
+    drops the snapshots taken before cutoff, except the latest of them, which
+    as_of reads of the time after the cutoff start from
+    """
+    last_before_cutoff = (
+        select(func.max(LensesSnapshots.taken_at))
+        .where(LensesSnapshots.taken_at < cutoff)
+        .scalar_subquery()
+    )
+    await connection.execute(
+        delete(LensesSnapshots).where(LensesSnapshots.taken_at < last_before_cutoff)
+    )
+
+
+async def take_snapshot(
+    connection: AsyncConnection, interval: float | None = None
+) -> bool:
+    """
+    copies the catalog into lenses_snapshots. with an interval, only when the
+    latest snapshot is older than that. snapshots older than
+    settings.snapshot_retention are pruned. returns whether one was taken
+    """
+    await connection.execute(
+        text("SELECT pg_advisory_xact_lock(hashtext('lenses_snapshots'))")
+    )
+
+    if interval is not None:
+        recent = await connection.scalar(
+            select(func.max(LensesSnapshots.taken_at)).where(
+                LensesSnapshots.taken_at > func.now() - timedelta(seconds=interval)
+            )
+        )
+        if recent is not None:
+            return False
+
+    columns = [column for column in Lenses.__table__.c if column.computed is None]
+    await connection.execute(
+        insert(LensesSnapshots).from_select(
+            ["taken_at", *(column.name for column in columns)],
+            select(func.now(), *columns),
+        )
+    )
+    if settings.snapshot_retention is not None:
+        await prune_snapshots(
+            connection, func.now() - timedelta(seconds=settings.snapshot_retention)
+        )
+    return True
+
+
+async def snapshot_periodically(manager: DatabaseSessionManager):
+    while True:
+        try:
+            async with manager.connect() as connection:
+                if await take_snapshot(connection, settings.snapshot_interval):
+                    logger.info("Took a catalog snapshot")
+        except (OSError, SQLAlchemyError) as e:
+            logger.warning("Could not take a catalog snapshot: %s", e)
+
+        await asyncio.sleep(settings.snapshot_check_interval)
+
+
+async def ensure_partitions_on_startup(manager: DatabaseSessionManager):
+    try:
+        async with manager.connect() as connection:
+            await ensure_partitions(connection, settings.history_partitions_ahead)
+    except (OSError, SQLAlchemyError) as e:
+        logger.warning("Could not create the history partitions: %s", e)
+
+
+async def main(
+    ahead: int, retention: int | None, archive_dir: str | None, snapshot: bool
+):
+    try:
+        async with sessionmanager.connect() as connection:
+            for name in await ensure_partitions(connection, ahead):
+                logger.info("Created partition %s", name)
+
+        if snapshot:
+            async with sessionmanager.connect() as connection:
+                await take_snapshot(connection)
+                logger.info("Took a catalog snapshot")
+
+        if retention is not None:
+            async with sessionmanager.connect() as connection:
+                for name in await archive_partitions(
+                    connection, retention, archive_dir
+                ):
+                    logger.info("Archived partition %s", name)
+    finally:
+        await sessionmanager.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain lenses_history partitions")
+    parser.add_argument(
+        "--ahead",
+        type=int,
+        default=settings.history_partitions_ahead,
+        help="months to create partitions for in advance",
+    )
+    parser.add_argument(
+        "--retention",
+        type=int,
+        default=settings.history_retention_months,
+        help="months of history to keep attached, all of it if not given",
+    )
+    parser.add_argument(
+        "--archive-dir",
+        default=settings.history_archive_dir,
+        help="where detached partitions are exported to before being dropped",
+    )
+    parser.add_argument(
+        "--snapshot",
+        action="store_true",
+        help="also take a catalog snapshot",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main(args.ahead, args.retention, args.archive_dir, args.snapshot))
@@ -0,0 +1,188 @@
+"""
+Prometheus metrics. With several workers, point PROMETHEUS_MULTIPROC_DIR at an
+empty directory before the app is imported so every worker writes its samples
+there and /metrics aggregates them.
+"""
+
+import os
+import time
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+INSTRUMENTED_PREFIX = "/api/inventory"
+
+REQUEST_LATENCY = Histogram(
+    "inventory_request_duration_seconds",
+    "Latency of inventory API requests",
+    ["method", "route", "status"],
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    "inventory_requests_in_flight",
+    "Inventory API requests being handled",
+    multiprocess_mode="livesum",
+)
+STREAMS_OPEN = Gauge(
+    "inventory_streams_open",
+    "Inventory API event streams held open",
+    multiprocess_mode="livesum",
+)
+DB_POOL_CHECKED_OUT = Gauge(
+    "inventory_db_pool_checked_out",
+    "Connections checked out of the pool",
+    ["pool"],
+    multiprocess_mode="livesum",
+)
+DB_POOL_OVERFLOW = Gauge(
+    "inventory_db_pool_overflow",
+    "Checked out connections beyond pool_size",
+    ["pool"],
+    multiprocess_mode="livesum",
+)
+DB_POOL_WAIT = Histogram(
+    "inventory_db_pool_wait_seconds",
+    "Time spent waiting for a connection from the pool",
+    ["pool"],
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0),
+)
+RESPONSE_CACHE_REQUESTS = Counter(
+    "inventory_response_cache_requests",
+    "Lookups in the list response cache",
+    ["result"],
+)
+RESPONSE_CACHE_BYTES = Gauge(
+    "inventory_response_cache_bytes",
+    "Size of the response bodies in the list response cache",
+    multiprocess_mode="livesum",
+)
+HISTORY_ROWS_WRITTEN = Counter(
+    "inventory_history_rows_written",
+    "Rows written to lenses_history",
+    ["update_type"],
+)
+
+
+class InstrumentedQueuePool(AsyncAdaptedQueuePool):
+    """
+    records how long each checkout waits for a free connection, labelled
+    by the engine's pool_logging_name
+    """
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            DB_POOL_WAIT.labels(self.logging_name or "default").observe(
+                time.perf_counter() - start
+            )
+
+
+def instrument_pool(engine: AsyncEngine, name: str):
+    """
+    keeps the pool gauges of the engine up to date on every checkout and checkin
+    """
+    checked_out = DB_POOL_CHECKED_OUT.labels(name)
+    overflow = DB_POOL_OVERFLOW.labels(name)
+
+    def report(pool, connections: int):
+        checked_out.set(connections)
+        if isinstance(pool, QueuePool):
+            overflow.set(max(0, connections - pool.size()))
+
+    @event.listens_for(engine.sync_engine, "checkout")
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        pool = engine.sync_engine.pool
+        report(pool, pool.checkedout())
+
+    @event.listens_for(engine.sync_engine, "checkin")
+    def on_checkin(dbapi_connection, connection_record):
+        # fires before the connection is back in the pool
+        pool = engine.sync_engine.pool
+        report(pool, pool.checkedout() - 1)
+
+
+def record_history_rows(update_type: str, rows: int):
+    if rows:
+        HISTORY_ROWS_WRITTEN.labels(update_type).inc(rows)
+
+
+def record_response_cache(hit: bool):
+    RESPONSE_CACHE_REQUESTS.labels("hit" if hit else "miss").inc()
+
+
+def render() -> bytes:
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+
+    return generate_latest(REGISTRY)
+
+
+def mark_process_dead():
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        multiprocess.mark_process_dead(os.getpid())
+
+
+def _is_stream(headers) -> bool:
+    return any(
+        name == b"content-type" and value.startswith(b"text/event-stream")
+        for name, value in headers
+    )
+
+
+class MetricsMiddleware:
+    """
+    records latency and in-flight requests of the inventory API, by route
+    template rather than raw path so product ids don't blow up the label set.
+    event streams stay open as long as their client does, so they are counted
+    as open streams instead
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith(INSTRUMENTED_PREFIX):
+            return await self.app(scope, receive, send)
+
+        start = time.perf_counter()
+        status = 500
+        streaming = False
+
+        async def send_with_status(message):
+            nonlocal status, streaming
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if _is_stream(message.get("headers", [])):
+                    streaming = True
+                    REQUESTS_IN_FLIGHT.dec()
+                    STREAMS_OPEN.inc()
+            await send(message)
+
+        REQUESTS_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            if streaming:
+                STREAMS_OPEN.dec()
+            else:
+                REQUESTS_IN_FLIGHT.dec()
+                route = scope.get("route")
+                REQUEST_LATENCY.labels(
+                    scope["method"],
+                    route.path_format if route is not None else "unmatched",
+                    status,
+                ).observe(time.perf_counter() - start)
@@ -2,7 +2,23 @@ from enum import Enum
 from datetime import datetime
 from decimal import Decimal
 
-from sqlalchemy import TIMESTAMP, ForeignKey, func, Numeric
+from sqlalchemy import (
+    DDL,
+    TIMESTAMP,
+    BigInteger,
+    Computed,
+    Double,
+    ForeignKey,
+    Index,
+    LargeBinary,
+    SmallInteger,
+    String,
+    event,
+    func,
+    Numeric,
+    text,
+)
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import Mapped, mapped_column
 
 from . import Base
@@ -27,6 +43,39 @@ class UpdateType(Enum):
 
 class Lenses(Base):
     __tablename__ = "lenses"
+    # partial indexes over the live catalog, every read filters out soft deletes
+    __table_args__ = (
+        Index("ix_lenses_active_id", "id", postgresql_where=text("deleted_at IS NULL")),
+        Index(
+            "ix_lenses_active_lens_type",
+            "lens_type",
+            "id",
+            postgresql_where=text("deleted_at IS NULL"),
+        ),
+        Index(
+            "ix_lenses_active_sphere_cylinder",
+            "sphere",
+            "cylinder",
+            postgresql_where=text("deleted_at IS NULL"),
+        ),
+        Index(
+            "ix_lenses_active_cylinder",
+            "cylinder",
+            postgresql_where=text("deleted_at IS NULL"),
+        ),
+        Index(
+            "ix_lenses_active_quantity",
+            "quantity",
+            postgresql_where=text("deleted_at IS NULL"),
+        ),
+        # the reorder report, largest shortage first
+        Index(
+            "ix_lenses_reorder",
+            text("shortage DESC"),
+            "id",
+            postgresql_where=text("deleted_at IS NULL AND shortage > 0"),
+        ),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True, index=True)
     lens_type: Mapped[str]
@@ -48,20 +97,215 @@ class Lenses(Base):
         server_onupdate=func.now(),
     )
     deleted_at: Mapped[datetime | None] = mapped_column(TIMESTAMP(timezone=True))
+    # stock status, kept by postgres. NULL for lenses without a storage limit
+    shortage: Mapped[int | None] = mapped_column(
+        Computed("storage_limit - quantity", persisted=True)
+    )
+    fill_ratio: Mapped[float | None] = mapped_column(
+        Double,
+        Computed(
+            "CAST(quantity AS double precision) / NULLIF(storage_limit, 0)",
+            persisted=True,
+        ),
+    )
 
 
 class LensesHistory(Base):
     __tablename__ = "lenses_history"
+    # partitioned by month, see app.maintenance. rows outside every monthly
+    # partition land in lenses_history_default
+    __table_args__ = (
+        Index(
+            "ix_lenses_history_lens_id_update_timestamp", "lens_id", "update_timestamp"
+        ),
+        # the global feed, newest first
+        Index("ix_lenses_history_update_timestamp_id", "update_timestamp", "id"),
+        {"postgresql_partition_by": "RANGE (update_timestamp)"},
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True, index=True)
     lens_id: Mapped[int] = mapped_column(ForeignKey("lenses.id"))
     update_field: Mapped[UpdateField]
     old_value: Mapped[str | None]
     new_value: Mapped[str | None]
+    # the partition key has to be part of the primary key
     update_timestamp: Mapped[datetime] = mapped_column(
         TIMESTAMP(timezone=True),
+        primary_key=True,
         server_default=func.now(),
     )
     update_type: Mapped[UpdateType]
     update_notes: Mapped[str | None]
     update_source: Mapped[str | None]
+
+
+class LensesSnapshots(Base):
+    """
+    copies of the whole catalog taken periodically by app.maintenance, the
+    starting point when reconstructing it as of an earlier time
+    """
+
+    __tablename__ = "lenses_snapshots"
+
+    taken_at: Mapped[datetime] = mapped_column(
+        TIMESTAMP(timezone=True), primary_key=True
+    )
+    id: Mapped[int] = mapped_column(primary_key=True)
+    lens_type: Mapped[str]
+    sphere: Mapped[Decimal] = mapped_column(Numeric(4, 2))
+    cylinder: Mapped[Decimal] = mapped_column(Numeric(4, 2))
+    unit_price: Mapped[Decimal] = mapped_column(Numeric(6, 2))
+    quantity: Mapped[int]
+    storage_limit: Mapped[int | None]
+    comment: Mapped[str | None]
+    created_at: Mapped[datetime] = mapped_column(TIMESTAMP(timezone=True))
+    updated_at: Mapped[datetime] = mapped_column(TIMESTAMP(timezone=True))
+    deleted_at: Mapped[datetime | None] = mapped_column(TIMESTAMP(timezone=True))
+
+
+class LensStockMatrix(Base):
+    """
+    stock of the live catalog per lens_type, sphere and cylinder, kept up to
+    date by the triggers below on every write to lenses
+    """
+
+    __tablename__ = "lens_stock_matrix"
+
+    lens_type: Mapped[str] = mapped_column(primary_key=True)
+    sphere: Mapped[Decimal] = mapped_column(Numeric(4, 2), primary_key=True)
+    cylinder: Mapped[Decimal] = mapped_column(Numeric(4, 2), primary_key=True)
+    lenses: Mapped[int]
+    quantity: Mapped[int]
+    # fill is limited_quantity / storage_limit, over the lenses that have a limit
+    storage_limit: Mapped[int]
+    limited_quantity: Mapped[int]
+
+
+class CatalogVersion(Base):
+    """
+    single row counter bumped by every write to the catalog, list ETags are
+    derived from it
+    """
+
+    __tablename__ = "catalog_version"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    version: Mapped[int] = mapped_column(BigInteger)
+
+
+class IdempotencyKey(Base):
+    """
+    the first response to a request sent with an Idempotency-Key, replayed to
+    its retries, see app.idempotency. the response is NULL while the request
+    is still running
+    """
+
+    __tablename__ = "idempotency_keys"
+    __table_args__ = (Index("ix_idempotency_keys_created_at", "created_at"),)
+
+    key: Mapped[str] = mapped_column(String(255), primary_key=True)
+    # hash of the method, path, query and body the key was first used with
+    fingerprint: Mapped[bytes] = mapped_column(LargeBinary)
+    status_code: Mapped[int | None] = mapped_column(SmallInteger)
+    headers: Mapped[dict | None] = mapped_column(JSONB)
+    body: Mapped[bytes | None] = mapped_column(LargeBinary)
+    created_at: Mapped[datetime] = mapped_column(
+        TIMESTAMP(timezone=True), server_default=func.now()
+    )
+
+
+def _stock_changes(rows: str, sign: str) -> str:
+    return f"""
+        SELECT
+            lens_type,
+            sphere,
+            cylinder,
+            {sign}1 AS lenses,
+            {sign}quantity AS quantity,
+            {sign}coalesce(storage_limit, 0) AS storage_limit,
+            CASE WHEN storage_limit IS NOT NULL THEN {sign}quantity ELSE 0 END
+                AS limited_quantity
+        FROM {rows}
+        WHERE deleted_at IS NULL
+    """
+
+
+def _apply_stock_changes(changes: str) -> str:
+    # cells are locked in key order so concurrent writes can't deadlock, and
+    # rows whose changes cancel out (e.g. a comment edit) don't lock them at all
+    return f"""
+        INSERT INTO lens_stock_matrix AS m (
+            lens_type, sphere, cylinder,
+            lenses, quantity, storage_limit, limited_quantity
+        )
+        SELECT
+            lens_type, sphere, cylinder,
+            sum(lenses), sum(quantity), sum(storage_limit), sum(limited_quantity)
+        FROM ({changes}) AS changes
+        GROUP BY lens_type, sphere, cylinder
+        HAVING sum(lenses) <> 0
+            OR sum(quantity) <> 0
+            OR sum(storage_limit) <> 0
+            OR sum(limited_quantity) <> 0
+        ORDER BY lens_type, sphere, cylinder
+        ON CONFLICT (lens_type, sphere, cylinder) DO UPDATE SET
+            lenses = m.lenses + excluded.lenses,
+            quantity = m.quantity + excluded.quantity,
+            storage_limit = m.storage_limit + excluded.storage_limit,
+            limited_quantity = m.limited_quantity + excluded.limited_quantity;
+    """
+
+
+_PRUNE_STOCK_CELLS = """
+    DELETE FROM lens_stock_matrix m
+    USING old_rows o
+    WHERE m.lens_type = o.lens_type
+        AND m.sphere = o.sphere
+        AND m.cylinder = o.cylinder
+        AND m.lenses <= 0;
+"""
+
+_INSERTED = _stock_changes("new_rows", "")
+_DELETED = _stock_changes("old_rows", "-")
+
+STOCK_MATRIX_FUNCTION = f"""
+CREATE OR REPLACE FUNCTION lens_stock_matrix_apply() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        {_apply_stock_changes(_INSERTED)}
+    ELSIF TG_OP = 'UPDATE' THEN
+        {_apply_stock_changes(f"{_INSERTED} UNION ALL {_DELETED}")}
+        {_PRUNE_STOCK_CELLS}
+    ELSE
+        {_apply_stock_changes(_DELETED)}
+        {_PRUNE_STOCK_CELLS}
+    END IF;
+    RETURN NULL;
+END
+$$
+"""
+
+# statement level, so writes of many lenses have to be a single statement to
+# cost one upsert per touched cell. an executemany fires them once per row,
+# see crud.lenses.create_or_replace_lenses
+STOCK_MATRIX_TRIGGERS = [
+    "CREATE TRIGGER lens_stock_matrix_insert AFTER INSERT ON lenses "
+    "REFERENCING NEW TABLE AS new_rows "
+    "FOR EACH STATEMENT EXECUTE FUNCTION lens_stock_matrix_apply()",
+    "CREATE TRIGGER lens_stock_matrix_update AFTER UPDATE ON lenses "
+    "REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows "
+    "FOR EACH STATEMENT EXECUTE FUNCTION lens_stock_matrix_apply()",
+    "CREATE TRIGGER lens_stock_matrix_delete AFTER DELETE ON lenses "
+    "REFERENCING OLD TABLE AS old_rows "
+    "FOR EACH STATEMENT EXECUTE FUNCTION lens_stock_matrix_apply()",
+]
+
+for statement in [STOCK_MATRIX_FUNCTION, *STOCK_MATRIX_TRIGGERS]:
+    event.listen(Lenses.__table__, "after_create", DDL(statement))
+
+event.listen(
+    LensesHistory.__table__,
+    "after_create",
+    DDL("CREATE TABLE lenses_history_default PARTITION OF lenses_history DEFAULT"),
+)
@@ -0,0 +1,363 @@
+"""
+keeps each worker's view of the catalog version current through LISTEN/NOTIFY.
+every bump of the version, made once the writes it covers have committed,
+is notified on CATALOG_CHANNEL. while the listening connection is down the
+generation is unknown and nothing may be served on the strength of it.
+
+the same notifications drive the change feed: one listener per worker, which
+reads the new history rows once and fans them out to every SSE client
+"""
+
+import asyncio
+import contextlib
+import logging
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import AsyncContextManager, AsyncIterator, Callable
+
+import asyncpg
+import orjson
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import settings
+from app.crud import lenses
+from app.crud.catalog import CATALOG_CHANNEL
+
+logger = logging.getLogger(__name__)
+
+
+_VERSION = "SELECT version FROM catalog_version"
+
+
+class CatalogListener:
+    def __init__(self, retry_interval: float = 1.0, check_interval: float = 30.0):
+        self.retry_interval = retry_interval
+        self.check_interval = check_interval
+        self.generation: int | None = None
+        self._notified_version = 0
+        self._callbacks: list[Callable[[], None]] = []
+        self._task: asyncio.Task | None = None
+
+    def on_change(self, callback: Callable[[], None]):
+        """
+        called on every notification, and after (re)connecting for whatever
+        was missed while the connection was down
+        """
+        self._callbacks.append(callback)
+
+    def _changed(self):
+        for callback in self._callbacks:
+            callback()
+
+    async def start(self, database_url: str):
+        dsn = (
+            make_url(database_url)
+            .set(drivername="postgresql")
+            .render_as_string(hide_password=False)
+        )
+        self._task = asyncio.create_task(self._run(dsn))
+
+    async def stop(self):
+        if self._task is None:
+            return
+
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def _notified(self, connection, pid: int, channel: str, payload: str):
+        self._notified_version = max(self._notified_version, int(payload))
+        if self.generation is not None:
+            self.generation = max(self.generation, self._notified_version)
+        self._changed()
+
+    async def _run(self, dsn: str):
+        while True:
+            connection = None
+            try:
+                connection = await asyncpg.connect(dsn)
+                lost = asyncio.Event()
+                connection.add_termination_listener(lambda _: lost.set())
+
+                # listening first, so no bump falls between the read and the LISTEN
+                self._notified_version = 0
+                await connection.add_listener(CATALOG_CHANNEL, self._notified)
+                version = await connection.fetchval(
+                    _VERSION, timeout=self.check_interval
+                )
+                self.generation = max(version or 0, self._notified_version)
+                self._changed()
+                while not await self._lost(lost):
+                    await self._check(connection)
+                logger.warning("Lost the catalog notification connection")
+            except (
+                OSError,
+                asyncio.TimeoutError,
+                asyncpg.PostgresError,
+                asyncpg.InterfaceError,
+            ) as e:
+                logger.warning("Could not listen for catalog changes: %s", e)
+            finally:
+                self.generation = None
+                if connection is not None:
+                    connection.terminate()
+
+            await asyncio.sleep(self.retry_interval)
+
+    async def _lost(self, lost: asyncio.Event) -> bool:
+        try:
+            await asyncio.wait_for(lost.wait(), self.check_interval)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    async def _check(self, connection):
+        """
+        a half open connection is never reported lost, it fails to answer
+        instead. the version read also catches up on missed notifications
+        """
+        version = await connection.fetchval(_VERSION, timeout=self.check_interval)
+        if version is not None and version > self.generation:
+            self.generation = version
+            self._changed()
+
+
+@dataclass
+class Change:
+    """
+    the fields one transaction changed on a lens. identified by its newest
+    history row, which clients resume from
+    """
+
+    id: int
+    history_ids: frozenset[int]
+    data: bytes
+
+
+def _changes(rows) -> list[Change]:
+    groups: dict[tuple, list] = {}
+    for row in rows:
+        key = (row.lens_id, row.update_timestamp, row.update_type)
+        groups.setdefault(key, []).append(row)
+
+    changes = [
+        Change(
+            max(row.id for row in group),
+            frozenset(row.id for row in group),
+            orjson.dumps(
+                {
+                    "lens_id": lens_id,
+                    "update_type": update_type,
+                    "update_timestamp": update_timestamp,
+                    "changes": {row.update_field.value: row.new_value for row in group},
+                    "update_notes": group[-1].update_notes,
+                    "update_source": group[-1].update_source,
+                },
+                option=orjson.OPT_UTC_Z,
+            ),
+        )
+        for (lens_id, update_timestamp, update_type), group in groups.items()
+    ]
+    return sorted(changes, key=lambda change: change.id)
+
+
+class ChangeFeed:
+    """
+    polls lenses_history when woken by the listener and hands the changes to
+    every subscriber. a subscriber that falls queue_size changes behind, or a
+    poll that finds more than replay_limit rows, gets None instead: the
+    client has to resume from the history or refetch. once the feed is closed
+    every subscriber gets None too, and resumes on another worker
+    """
+
+    def __init__(
+        self,
+        queue_size: int = 1000,
+        replay_limit: int = 10_000,
+        margin: float = 10.0,
+    ):
+        self.queue_size = queue_size
+        self.replay_limit = replay_limit
+        self.margin = timedelta(seconds=margin)
+        self._session_factory: Callable[[], AsyncContextManager[AsyncSession]]
+        self._subscribers: set[asyncio.Queue[Change | None]] = set()
+        self._wake = asyncio.Event()
+        # the newest update_timestamp read, and the rows read within the
+        # margin before it
+        self._since = datetime.now(timezone.utc)
+        self._seen: dict[int, datetime] = {}
+        self.closed = False
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._task: asyncio.Task | None = None
+
+    def start(self, session_factory: Callable[[], AsyncContextManager[AsyncSession]]):
+        self._session_factory = session_factory
+        self._since = datetime.now(timezone.utc)
+        self.closed = False
+        self._loop = asyncio.get_running_loop()
+        self._task = asyncio.create_task(self._run())
+
+    def close(self):
+        """
+        ends every stream, and the ones opened from now on, so they don't hold
+        up a graceful shutdown. safe to call from a signal handler
+        """
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._close)
+
+    def _close(self):
+        self.closed = True
+        for queue in list(self._subscribers):
+            self._cut_off(queue)
+
+    async def stop(self):
+        self._close()
+
+        if self._task is None:
+            return
+
+        self._task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._task
+        self._task = None
+
+    def wake(self):
+        self._wake.set()
+
+    def subscribe(self) -> asyncio.Queue[Change | None]:
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self._subscribers.add(queue)
+        if self.closed:
+            self._cut_off(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue[Change | None]):
+        self._subscribers.discard(queue)
+
+    async def replay(self, last_id: int) -> list[Change] | None:
+        """
+        the changes after history row last_id, None if there are too many
+        """
+        async with self._session_factory() as db_session:
+            rows = await lenses.get_history_after(
+                db_session, last_id, self.replay_limit + 1
+            )
+
+        if len(rows) > self.replay_limit:
+            return None
+        return _changes(rows)
+
+    async def _run(self):
+        while True:
+            await self._wake.wait()
+            self._wake.clear()
+            try:
+                await self._poll()
+            except (OSError, SQLAlchemyError) as e:
+                logger.warning("Could not read the change feed: %s", e)
+
+    async def _poll(self):
+        # rows of transactions that committed late can be older than the
+        # newest row seen, so a margin before it is polled too. rows already
+        # read are left out by id, only new ones come back
+        async with self._session_factory() as db_session:
+            rows = await lenses.get_history_since(
+                db_session,
+                self._since - self.margin,
+                self._seen.keys(),
+                self.replay_limit + 1,
+            )
+
+        for row in rows:
+            self._seen[row.id] = row.update_timestamp
+            self._since = max(self._since, row.update_timestamp)
+        self._seen = {
+            id: timestamp
+            for id, timestamp in self._seen.items()
+            if timestamp >= self._since - self.margin
+        }
+
+        if len(rows) > self.replay_limit:
+            # the rows read are skipped, the rest are read right away
+            logger.warning("Change feed fell behind, resetting its subscribers")
+            for queue in list(self._subscribers):
+                self._cut_off(queue)
+            self.wake()
+            return
+
+        changes = _changes(rows)
+        for queue in list(self._subscribers):
+            for change in changes:
+                try:
+                    queue.put_nowait(change)
+                except asyncio.QueueFull:
+                    self._cut_off(queue)
+                    break
+
+    def _cut_off(self, queue: asyncio.Queue[Change | None]):
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(None)
+        self.unsubscribe(queue)
+
+
+def _event(change: Change) -> bytes:
+    return b"id: %d\nevent: change\ndata: %s\n\n" % (change.id, change.data)
+
+
+RESET_EVENT = b"event: reset\ndata: {}\n\n"
+
+
+async def stream_changes(
+    feed: ChangeFeed, last_event_id: int | None, keepalive: float
+) -> AsyncIterator[bytes]:
+    """
+    server-sent events for the changes after last_event_id, then as they
+    happen. a reset event means the client missed changes and must refetch,
+    a stream that just ends is resumed from the last event
+    """
+    # subscribed before replaying, so nothing falls in between
+    queue = feed.subscribe()
+    try:
+        yield b"retry: 1000\n\n"
+
+        replayed: set[int] = set()
+        if last_event_id is not None:
+            changes = await feed.replay(last_event_id)
+            if changes is None:
+                yield RESET_EVENT
+                return
+            for change in changes:
+                replayed |= change.history_ids
+                yield _event(change)
+
+        while True:
+            try:
+                change = await asyncio.wait_for(queue.get(), keepalive)
+            except asyncio.TimeoutError:
+                yield b": keepalive\n\n"
+                continue
+
+            if change is None:
+                if not feed.closed:
+                    yield RESET_EVENT
+                return
+            if change.history_ids <= replayed:
+                continue
+            yield _event(change)
+    finally:
+        feed.unsubscribe(queue)
+
+
+listener = CatalogListener(check_interval=settings.catalog_check_interval)
+change_feed = ChangeFeed(
+    settings.change_feed_queue_size,
+    settings.change_feed_replay_limit,
+    settings.change_feed_margin,
+)
+listener.on_change(change_feed.wake)
@@ -1,15 +1,60 @@
-from typing import Annotated, Any
+from datetime import datetime
+from typing import Annotated, Any, Literal
 
+from app.config import settings
 from app.crud import lenses
-from app.dependencies.core import DBSessionDep
+from app.dependencies.core import (
+    CachedListDep,
+    CatalogETagDep,
+    DBReadSessionDep,
+    DBSessionDep,
+    ReadSessionFactoryDep,
+    cache_list,
+    catalog_version_etag,
+    pin_to_primary,
+)
 from app.dependencies.exceptions import (
+    InsufficientStock,
     MalformedInput,
+    PreconditionFailed,
     ProductAlreadyExists,
     ProductNotFound,
     ProductsNotFound,
+    TooManyAffected,
+    VersionConflict,
+)
+from app.schemas.lenses import (
+    LensAdjust,
+    LensBulkResult,
+    LensCreate,
+    LensHistoryRead,
+    LensMutation,
+    LensMutationResult,
+    LensRead,
+    LensReorderRead,
+    LensUpdate,
+    StockMatrixRead,
+)
+from app.serialization import (
+    dump_lenses_csv,
+    dump_lenses_ndjson,
+    history_response,
+    lenses_response,
+    REORDER_READ_FIELDS,
 )
-from app.schemas.lenses import LensCreate, LensRead, LensUpdate
-from fastapi import APIRouter, HTTPException, Query, Response
+from app.etags import etag_headers, etag_matches, lens_etag
+from app.notifications import change_feed, stream_changes
+from fastapi import (
+    APIRouter,
+    Body,
+    Depends,
+    Header,
+    HTTPException,
+    Query,
+    Request,
+    Response,
+)
+from fastapi.responses import StreamingResponse
 from pydantic.types import Json
 
 router = APIRouter(
@@ -21,45 +66,227 @@ router = APIRouter(
 
 @router.get("/lenses", response_model=list[LensRead])
 async def read_lenses(
-    db_session: DBSessionDep,
-    response: Response,
+    request: Request,
+    db_session: DBReadSessionDep,
+    cached: CachedListDep,
     sort: Annotated[Json[list[list[str]]] | None, Query()] = None,
     range: Annotated[Json[list[int]] | None, Query(min_length=2, max_length=2)] = None,
     filter: Annotated[Json | None, Query()] = None,
+    cursor: Annotated[str | None, Query()] = None,
+    limit: Annotated[int | None, Query(gt=0, le=settings.max_page_size)] = None,
+    count: Literal["exact", "estimated"] = "exact",
+    as_of: datetime | None = None,
 ):
+    if cached is not None:
+        return cached
+
+    version, etag = await catalog_version_etag(request, db_session)
+    headers = etag_headers(etag)
+
+    if cursor is not None or limit is not None:
+        # keyset pagination, page latency doesn't grow with the page depth
+        if range:
+            raise HTTPException(
+                status_code=400, detail="range cannot be combined with cursor or limit"
+            )
+
+        try:
+            products, next_cursor, prev_cursor = await lenses.get_lenses_page(
+                db_session,
+                limit or settings.default_page_size,
+                cursor,
+                sort,
+                filter,
+                as_rows=True,
+                as_of=as_of,
+            )
+        except MalformedInput as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+        if next_cursor:
+            headers["X-Next-Cursor"] = next_cursor
+        if prev_cursor:
+            headers["X-Prev-Cursor"] = prev_cursor
+
+        return cache_list(request, version, lenses_response(products, headers), headers)
+
     try:
-        products, total = await lenses.get_lenses(db_session, sort, range, filter)
+        products, total = await lenses.get_lenses(
+            db_session,
+            sort,
+            range,
+            filter,
+            estimate_count=count == "estimated",
+            as_rows=True,
+            as_of=as_of,
+        )
     except MalformedInput as e:
         raise HTTPException(status_code=400, detail=str(e))
 
     if range:
-        response.headers["X-Total-Count"] = f"{total}"
+        headers["X-Total-Count"] = f"{total}"
 
-    return products
+    return cache_list(request, version, lenses_response(products, headers), headers)
 
 
 @router.get("/lenses/all", response_model=list[LensRead])
 # TODO: update to match /products
-async def read_all_products(db_session: DBSessionDep):
+async def read_all_products(db_session: DBReadSessionDep, etag: CatalogETagDep):
     try:
-        products, total = await lenses.get_lenses(db_session, show_deleted=True)
+        products, total = await lenses.get_lenses(
+            db_session, show_deleted=True, as_rows=True
+        )
     except ProductsNotFound as e:
         return []
 
-    return products
+    return lenses_response(products, etag_headers(etag))
+
+
+@router.get("/lenses/export")
+async def export_products(
+    session_factory: ReadSessionFactoryDep,
+    sort: Annotated[Json[list[list[str]]] | None, Query()] = None,
+    filter: Annotated[Json | None, Query()] = None,
+    format: Literal["ndjson", "csv"] = "ndjson",
+    show_deleted: bool = False,
+):
+    try:
+        stmt, params = lenses.export_lenses_query(sort, filter, show_deleted)
+    except MalformedInput as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    async def chunks():
+        # the request's session is closed before the body is streamed
+        async with session_factory() as db_session:
+            if format == "csv":
+                yield dump_lenses_csv([], header=True)
+            async for rows in lenses.stream_lenses(db_session, stmt, params):
+                if format == "csv":
+                    yield dump_lenses_csv(rows)
+                else:
+                    yield dump_lenses_ndjson(rows)
+
+    return StreamingResponse(
+        chunks(),
+        media_type="text/csv" if format == "csv" else "application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="lenses.{format}"'},
+    )
+
+
+@router.get("/lenses/reorder", response_model=list[LensReorderRead])
+async def read_reorder_report(
+    db_session: DBReadSessionDep,
+    etag: CatalogETagDep,
+    rank: Literal["shortage", "cost"] = "shortage",
+    limit: Annotated[int | None, Query(gt=0, le=settings.max_page_size)] = None,
+    filter: Annotated[Json | None, Query()] = None,
+):
+    try:
+        products = await lenses.get_reorder_report(db_session, rank, limit, filter)
+    except MalformedInput as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return lenses_response(products, etag_headers(etag), REORDER_READ_FIELDS)
+
+
+@router.get("/lenses/matrix", response_model=list[StockMatrixRead])
+async def read_stock_matrix(
+    db_session: DBReadSessionDep,
+    etag: CatalogETagDep,
+    response: Response,
+    lens_type: str | None = None,
+):
+    response.headers.update(etag_headers(etag))
+    return await lenses.get_stock_matrix(db_session, lens_type)
 
 
 @router.get("/lenses/{product_id}", response_model=LensRead)
-async def read_product(db_session: DBSessionDep, product_id: int):
+async def read_product(
+    db_session: DBReadSessionDep,
+    product_id: int,
+    response: Response,
+    as_of: datetime | None = None,
+    if_none_match: Annotated[str | None, Header()] = None,
+):
     try:
-        product = await lenses.get_lens(db_session, product_id)
+        product = await lenses.get_lens(db_session, product_id, as_of)
     except ProductNotFound as e:
         raise HTTPException(status_code=404, detail=str(e))
 
+    etag = lens_etag(product)
+    if etag_matches(if_none_match, etag):
+        raise HTTPException(status_code=304, headers=etag_headers(etag))
+
+    response.headers.update(etag_headers(etag))
     return product
 
 
-@router.post("/lenses", response_model=LensRead)
+async def _history_page(db_session, etag, limit, cursor, sort, filter, lens_id=None):
+    try:
+        history, next_cursor, prev_cursor = await lenses.get_history_page(
+            db_session,
+            limit or settings.default_page_size,
+            cursor,
+            sort,
+            filter,
+            lens_id,
+        )
+    except MalformedInput as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except ProductNotFound as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+    headers = etag_headers(etag)
+    if next_cursor:
+        headers["X-Next-Cursor"] = next_cursor
+    if prev_cursor:
+        headers["X-Prev-Cursor"] = prev_cursor
+
+    return history_response(history, headers)
+
+
+@router.get("/lenses/{product_id}/history", response_model=list[LensHistoryRead])
+async def read_product_history(
+    db_session: DBReadSessionDep,
+    etag: CatalogETagDep,
+    product_id: int,
+    sort: Annotated[Json[list[list[str]]] | None, Query()] = None,
+    filter: Annotated[Json | None, Query()] = None,
+    cursor: Annotated[str | None, Query()] = None,
+    limit: Annotated[int | None, Query(gt=0, le=settings.max_page_size)] = None,
+):
+    return await _history_page(
+        db_session, etag, limit, cursor, sort, filter, product_id
+    )
+
+
+@router.get("/changes")
+async def stream_lens_changes(
+    last_event_id: Annotated[int | None, Header()] = None,
+):
+    """
+    server-sent events of lens changes, resumed after Last-Event-ID
+    """
+    return StreamingResponse(
+        stream_changes(change_feed, last_event_id, settings.change_feed_keepalive),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.get("/history", response_model=list[LensHistoryRead])
+async def read_history(
+    db_session: DBReadSessionDep,
+    etag: CatalogETagDep,
+    sort: Annotated[Json[list[list[str]]] | None, Query()] = None,
+    filter: Annotated[Json | None, Query()] = None,
+    cursor: Annotated[str | None, Query()] = None,
+    limit: Annotated[int | None, Query(gt=0, le=settings.max_page_size)] = None,
+):
+    return await _history_page(db_session, etag, limit, cursor, sort, filter)
+
+
+@router.post("/lenses", response_model=LensRead, dependencies=[Depends(pin_to_primary)])
 async def create_product(db_session: DBSessionDep, product: LensCreate):
     try:
         product = await lenses.create_or_replace_lens(db_session, product)
@@ -69,19 +296,78 @@ async def create_product(db_session: DBSessionDep, product: LensCreate):
     return product
 
 
-@router.put("/lenses/{product_id}", response_model=LensRead)
+@router.post(
+    "/lenses/bulk",
+    response_model=list[LensBulkResult],
+    dependencies=[Depends(pin_to_primary)],
+)
+async def create_products(
+    db_session: DBSessionDep,
+    products: Annotated[list[LensCreate], Body(max_length=settings.bulk_max_rows)],
+):
+    return await lenses.create_or_replace_lenses(db_session, products)
+
+
+@router.post(
+    "/lenses/mutate",
+    response_model=LensMutationResult,
+    dependencies=[Depends(pin_to_primary)],
+)
+async def mutate_products(db_session: DBSessionDep, mutation: LensMutation):
+    try:
+        return await lenses.mutate_lenses(db_session, mutation)
+    except MalformedInput as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except TooManyAffected as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+
+@router.put(
+    "/lenses/{product_id}",
+    response_model=LensRead,
+    dependencies=[Depends(pin_to_primary)],
+)
 async def update_product(
-    db_session: DBSessionDep, product_id: int, update_data: LensUpdate
+    db_session: DBSessionDep,
+    product_id: int,
+    update_data: LensUpdate,
+    response: Response,
+    if_match: Annotated[str | None, Header()] = None,
 ):
     try:
-        product = await lenses.update_lens(db_session, product_id, update_data)
+        product = await lenses.update_lens(
+            db_session, product_id, update_data, if_match
+        )
     except ProductNotFound as e:
         raise HTTPException(status_code=400, detail=str(e))
+    except PreconditionFailed as e:
+        raise HTTPException(status_code=412, detail=str(e))
+    except VersionConflict as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+    response.headers["ETag"] = lens_etag(product)
+    return product
+
+
+@router.post(
+    "/lenses/{product_id}/adjust",
+    response_model=LensRead,
+    dependencies=[Depends(pin_to_primary)],
+)
+async def adjust_product(
+    db_session: DBSessionDep, product_id: int, adjustment: LensAdjust
+):
+    try:
+        product = await lenses.adjust_lens_quantity(db_session, product_id, adjustment)
+    except ProductNotFound as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except InsufficientStock as e:
+        raise HTTPException(status_code=409, detail=str(e))
 
     return product
 
 
-@router.delete("/lenses/{product_id}")
+@router.delete("/lenses/{product_id}", dependencies=[Depends(pin_to_primary)])
 async def delete_product(db_session: DBSessionDep, product_id: int):
     try:
         message = await lenses.delete_lens(db_session, product_id)
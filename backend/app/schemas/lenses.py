@@ -1,9 +1,11 @@
 from datetime import datetime
 from decimal import Decimal
+from typing import Literal
 from zoneinfo import ZoneInfo
 
 from app.config import settings
-from pydantic import BaseModel, ConfigDict, field_serializer
+from app.models import UpdateField, UpdateType
+from pydantic import BaseModel, ConfigDict, Field, field_serializer
 
 
 class LensRead(BaseModel):
@@ -23,6 +25,35 @@ class LensRead(BaseModel):
     updated_at: datetime
 
 
+class LensReorderRead(LensRead):
+    shortage: int
+    fill_ratio: float | None = None
+    reorder_cost: float
+
+
+class LensHistoryRead(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
+    lens_id: int
+    update_field: UpdateField
+    old_value: str | None = None
+    new_value: str | None = None
+    update_timestamp: datetime
+    update_type: UpdateType
+    update_notes: str | None = None
+    update_source: str | None = None
+
+
+class StockMatrixRead(BaseModel):
+    lens_type: str
+    spheres: list[float]
+    cylinders: list[float]
+    # one row per sphere, one column per cylinder
+    quantity: list[list[int]]
+    fill: list[list[float | None]]
+
+
 class LensCreate(BaseModel):
     # TODO: allow update_source
     model_config = ConfigDict(from_attributes=True, extra="forbid")
@@ -39,6 +70,12 @@ class LensCreate(BaseModel):
     comment: str | None = None
 
 
+class LensBulkResult(BaseModel):
+    id: int
+    status: Literal["created", "replaced", "error"]
+    detail: str | None = None
+
+
 class LensUpdate(BaseModel):
     model_config = ConfigDict(from_attributes=True, extra="forbid")
 
@@ -49,6 +86,50 @@ class LensUpdate(BaseModel):
     quantity: int | None = None
     storage_limit: int | None = None
     comment: str | None = None
+    # the version the client read. when given, the update only applies while
+    # the lens is still at it
     updated_at: datetime | None = None
     update_notes: str | None = None
     update_source: str | None = None
+
+
+class LensAdjust(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+
+    delta: int
+    allow_negative: bool = False
+    update_notes: str | None = None
+    update_source: str | None = None
+
+
+class LensBulkValues(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+
+    unit_price: Decimal | None = None
+    quantity: int | None = None
+    storage_limit: int | None = None
+    comment: str | None = None
+
+
+class LensMutation(BaseModel):
+    """
+    an operation on every lens the filter matches. "set" takes values,
+    "scale_price" changes unit_price by percent
+    """
+
+    model_config = ConfigDict(extra="forbid")
+
+    filter: list = Field(min_length=1)
+    operation: Literal["delete", "set", "scale_price"]
+    values: LensBulkValues | None = None
+    percent: Decimal | None = Field(default=None, gt=-100)
+    dry_run: bool = False
+    # refused, and nothing changed, if more lenses match
+    max_affected: int = Field(default=settings.bulk_max_rows, gt=0)
+    update_notes: str | None = None
+    update_source: str | None = None
+
+
+class LensMutationResult(BaseModel):
+    affected: int
+    dry_run: bool
@@ -0,0 +1,72 @@
+import csv
+import io
+from datetime import datetime
+from decimal import Decimal
+
+import orjson
+from app.instrumentation import time_serialization
+from app.schemas import LensHistoryRead, LensRead, LensReorderRead
+from fastapi import Response
+
+LENS_READ_FIELDS = list(LensRead.model_fields)
+HISTORY_READ_FIELDS = list(LensHistoryRead.model_fields)
+REORDER_READ_FIELDS = list(LensReorderRead.model_fields)
+
+
+def dump_lenses(rows, fields: list[str] = LENS_READ_FIELDS) -> bytes:
+    """
+    Encodes rows whose leading columns are LENS_READ_FIELDS to the same bytes
+    FastAPI renders for a list[LensRead], without validating every row.
+    Numeric columns come back as Decimal and LensRead declares them as float.
+    """
+    return orjson.dumps(
+        [dict(zip(fields, row)) for row in rows],
+        default=float,
+        option=orjson.OPT_UTC_Z,
+    )
+
+
+def lenses_response(
+    rows,
+    headers: dict[str, str] | None = None,
+    fields: list[str] = LENS_READ_FIELDS,
+) -> Response:
+    with time_serialization():
+        content = dump_lenses(rows, fields)
+
+    return Response(content, media_type="application/json", headers=headers)
+
+
+def history_response(rows, headers: dict[str, str] | None = None) -> Response:
+    return lenses_response(rows, headers, HISTORY_READ_FIELDS)
+
+
+def dump_lenses_ndjson(rows) -> bytes:
+    return b"".join(
+        orjson.dumps(
+            dict(zip(LENS_READ_FIELDS, row)),
+            default=float,
+            option=orjson.OPT_UTC_Z | orjson.OPT_APPEND_NEWLINE,
+        )
+        for row in rows
+    )
+
+
+def _csv_value(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, datetime):
+        return orjson.dumps(value, option=orjson.OPT_UTC_Z)[1:-1].decode()
+    return value
+
+
+def dump_lenses_csv(rows, header: bool = False) -> bytes:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    if header:
+        writer.writerow(LENS_READ_FIELDS)
+    for row in rows:
+        writer.writerow([_csv_value(value) for value in row[: len(LENS_READ_FIELDS)]])
+
+    return buffer.getvalue().encode()
@@ -0,0 +1,62 @@
+"""
+production entry point, instead of `fastapi dev`:
+
+    python -m app.server
+
+runs settings.workers uvicorn workers on uvloop and httptools. on SIGTERM the
+workers stop accepting connections, end the change feed streams and give the
+other in-flight requests settings.server_graceful_timeout seconds to finish
+before the lifespan shutdown closes the pools
+"""
+
+import os
+import sys
+import tempfile
+from types import FrameType
+
+import uvicorn
+from uvicorn.main import STARTUP_FAILURE
+from uvicorn.supervisors import Multiprocess
+
+from app.config import settings
+
+
+class Server(uvicorn.Server):
+    def handle_exit(self, sig: int, frame: FrameType | None):
+        # imported with the app by now. streams never finish on their own,
+        # they'd hold the shutdown for the whole graceful timeout
+        from app.notifications import change_feed
+
+        change_feed.close()
+        super().handle_exit(sig, frame)
+
+
+def main():
+    if settings.workers > 1 and "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        # the workers inherit it, see app.metrics
+        os.environ["PROMETHEUS_MULTIPROC_DIR"] = tempfile.mkdtemp(
+            prefix="inventory-metrics-"
+        )
+
+    config = uvicorn.Config(
+        "app.main:app",
+        host=settings.server_host,
+        port=settings.server_port,
+        workers=settings.workers,
+        loop=settings.server_loop,
+        http=settings.server_http,
+        timeout_graceful_shutdown=settings.server_graceful_timeout,
+        log_level=settings.log_level,
+    )
+    # what uvicorn.run does, with the server above
+    server = Server(config)
+    if config.workers > 1:
+        Multiprocess(config, target=server.run, sockets=[config.bind_socket()]).run()
+    else:
+        server.run()
+        if not server.started:
+            sys.exit(STARTUP_FAILURE)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,16 @@
+import contextlib
+
 import pytest
 import pytest_asyncio
-from app.database import Base, DatabaseSessionManager, get_db_session
+from app.crud import lenses
+from app.database import (
+    Base,
+    DatabaseSessionManager,
+    get_db_session,
+    get_session_factory,
+)
+from app.dependencies.core import get_db_read_session, get_read_session_factory
+from app.instrumentation import track_queries
 from app.main import app as main_app
 from httpx import ASGITransport, AsyncClient
 from pytest_postgresql import factories
@@ -40,6 +50,17 @@ def override_get_db_session(test_db_session):
         yield test_db_session
 
     main_app.dependency_overrides[get_db_session] = _override
+    main_app.dependency_overrides[get_db_read_session] = _override
+
+
+@pytest.fixture(scope="session", autouse=True)
+def override_get_session_factory(test_sessionmanager):
+    main_app.dependency_overrides[get_session_factory] = (
+        lambda: test_sessionmanager.session
+    )
+    main_app.dependency_overrides[get_read_session_factory] = (
+        lambda: test_sessionmanager.session
+    )
 
 
 @pytest.fixture(autouse=True)
@@ -47,3 +68,24 @@ async def cleanup_db(test_db_session):
     for table in reversed(Base.metadata.sorted_tables):
         await test_db_session.execute(table.delete())
     await test_db_session.commit()
+    lenses.count_cache.invalidate()
+
+
+@pytest.fixture
+def max_queries():
+    """
+    fails the test when the wrapped block runs more SQL statements than allowed:
+
+        with max_queries(2):
+            await client.get("/api/inventory/lenses")
+    """
+
+    @contextlib.contextmanager
+    def _max_queries(limit: int):
+        with track_queries() as stats:
+            yield stats
+        assert (
+            stats.queries <= limit
+        ), f"{stats.queries} queries run, expected at most {limit}"
+
+    return _max_queries
@@ -0,0 +1,155 @@
+import asyncio
+import signal
+
+import orjson
+import pytest
+import uvicorn
+from app import notifications
+from app.main import app as main_app
+from app.notifications import CatalogListener, ChangeFeed, stream_changes
+from app.server import Server
+from httpx import ASGITransport, AsyncClient
+
+product_data = {
+    "id": 1,
+    "lens_type": "CR39",
+    "sphere": -2.00,
+    "cylinder": -0.75,
+    "unit_price": 45.00,
+    "quantity": 5,
+    "storage_limit": 100,
+}
+
+
+@pytest.fixture
+async def change_feed(test_sessionmanager):
+    feed = ChangeFeed(queue_size=10, replay_limit=10, margin=10.0)
+    listener = CatalogListener()
+    listener.on_change(feed.wake)
+    feed.start(test_sessionmanager.session)
+    await listener.start(
+        test_sessionmanager._engine.url.render_as_string(hide_password=False)
+    )
+
+    yield feed
+
+    await listener.stop()
+    await feed.stop()
+
+
+def _parse(event: bytes) -> dict:
+    fields = dict(line.split(": ", 1) for line in event.decode().strip().split("\n"))
+    if "data" in fields:
+        fields["data"] = orjson.loads(fields["data"])
+    return fields
+
+
+async def _next(events) -> dict:
+    return _parse(await asyncio.wait_for(events.__anext__(), 5))
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_stream_changes(change_feed):
+    events = stream_changes(change_feed, None, keepalive=0.2)
+    assert await events.__anext__() == b"retry: 1000\n\n"
+
+    async with AsyncClient(
+        transport=ASGITransport(app=main_app), base_url="http://test"
+    ) as client:
+        # idle streams get comments, so proxies keep them open
+        assert await asyncio.wait_for(events.__anext__(), 5) == b": keepalive\n\n"
+        await client.post("/api/inventory/lenses", json=product_data)
+        await client.post("/api/inventory/lenses/1/adjust", json={"delta": 2})
+
+    changes = []
+    while len(changes) < 2:
+        event = await _next(events)
+        if event.get("event") == "change":
+            changes.append(event)
+    await events.aclose()
+
+    created, adjusted = (change["data"] for change in changes)
+    assert int(changes[0]["id"]) < int(changes[1]["id"])
+    assert created["lens_id"] == 1
+    assert created["update_type"] == "create"
+    assert created["changes"]["quantity"] == "5"
+    assert adjusted["update_type"] == "update"
+    assert adjusted["changes"] == {"quantity": "7"}
+    assert change_feed._subscribers == set()
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_stream_changes_resume(change_feed):
+    async with AsyncClient(
+        transport=ASGITransport(app=main_app), base_url="http://test"
+    ) as client:
+        await client.post("/api/inventory/lenses", json=product_data)
+        await client.post("/api/inventory/lenses/1/adjust", json={"delta": 2})
+
+    events = stream_changes(change_feed, 0, keepalive=5)
+    await events.__anext__()
+    created, adjusted = await _next(events), await _next(events)
+    await events.aclose()
+    assert created["data"]["update_type"] == "create"
+    assert adjusted["data"]["update_type"] == "update"
+
+    events = stream_changes(change_feed, int(created["id"]), keepalive=5)
+    await events.__anext__()
+    assert await _next(events) == adjusted
+    await events.aclose()
+
+    # too far behind to replay, the client has to refetch
+    change_feed.replay_limit = 1
+    events = stream_changes(change_feed, 0, keepalive=5)
+    await events.__anext__()
+    assert (await _next(events))["event"] == "reset"
+    with pytest.raises(StopAsyncIteration):
+        await events.__anext__()
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_change_feed_recovers_from_falling_behind(change_feed):
+    # one create writes a history row per field, more than the feed polls
+    change_feed.replay_limit = 5
+    queue = change_feed.subscribe()
+
+    async with AsyncClient(
+        transport=ASGITransport(app=main_app), base_url="http://test"
+    ) as client:
+        await client.post("/api/inventory/lenses", json=product_data)
+        assert await asyncio.wait_for(queue.get(), 5) is None
+
+        queue = change_feed.subscribe()
+        await client.post("/api/inventory/lenses/1/adjust", json={"delta": 2})
+
+        while True:
+            change = await asyncio.wait_for(queue.get(), 5)
+            data = orjson.loads(change.data)
+            if data["update_type"] == "update":
+                break
+    change_feed.unsubscribe(queue)
+
+    assert data["changes"] == {"quantity": "7"}
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_shutdown_ends_streams(change_feed, monkeypatch):
+    events = stream_changes(change_feed, None, keepalive=5)
+    assert await events.__anext__() == b"retry: 1000\n\n"
+    pending = asyncio.ensure_future(events.__anext__())
+    await asyncio.sleep(0.1)
+
+    monkeypatch.setattr(notifications, "change_feed", change_feed)
+    server = Server(uvicorn.Config(main_app))
+    server.handle_exit(signal.SIGTERM, None)
+
+    # no reset, clients resume from their last event on another worker
+    with pytest.raises(StopAsyncIteration):
+        await asyncio.wait_for(pending, 5)
+    assert server.should_exit
+
+    # streams opened while shutting down end right away
+    events = stream_changes(change_feed, None, keepalive=5)
+    assert await events.__anext__() == b"retry: 1000\n\n"
+    with pytest.raises(StopAsyncIteration):
+        await asyncio.wait_for(events.__anext__(), 5)
@@ -0,0 +1,171 @@
+import logging
+import time
+
+import pytest
+from app.config import Settings, settings
+from app.crud import lenses
+from app.database import DatabaseSessionManager, engine_kwargs_from_settings
+from app.dependencies.core import PRIMARY_PIN_COOKIE, _pinned_to_primary
+from app.main import app as main_app
+from fastapi import Request
+from httpx import ASGITransport, AsyncClient
+from sqlalchemy import text
+
+
+def test_engine_kwargs_from_settings():
+    settings = Settings(
+        database_url="postgresql+asyncpg://user@localhost/db",
+        db_pool_size=20,
+        db_pool_pre_ping=True,
+        db_statement_cache_size=0,
+        db_server_settings={"application_name": "inventory"},
+    )
+
+    kwargs = engine_kwargs_from_settings(settings)
+
+    assert kwargs["pool_size"] == 20
+    assert kwargs["pool_pre_ping"] is True
+    assert kwargs["connect_args"]["statement_cache_size"] == 0
+    assert kwargs["connect_args"]["server_settings"] == {
+        "application_name": "inventory"
+    }
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_pool_status(test_sessionmanager):
+    async with test_sessionmanager.connect():
+        status = test_sessionmanager.pool_status()
+
+        assert status["checked_out"] == 1
+
+    assert test_sessionmanager.pool_status()["checked_out"] == 0
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_check_capacity(test_sessionmanager, caplog):
+    with caplog.at_level(logging.WARNING, logger="app.database"):
+        await test_sessionmanager.check_capacity(workers=1)
+        assert not caplog.records
+
+        await test_sessionmanager.check_capacity(workers=10_000)
+        assert "connections" in caplog.text
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_replica_sessions(test_sessionmanager):
+    url = test_sessionmanager._engine.url
+    sessionmanager = DatabaseSessionManager(url, replica_hosts=[url, url])
+
+    try:
+        async with sessionmanager.session() as session:
+            assert session.bind is sessionmanager._engine
+
+        replicas = []
+        for _ in range(3):
+            async with sessionmanager.session(readonly=True) as session:
+                assert await session.scalar(text("SELECT 1")) == 1
+                replicas.append(session.bind)
+
+        assert replicas == [
+            sessionmanager._replica_engines[0],
+            sessionmanager._replica_engines[1],
+            sessionmanager._replica_engines[0],
+        ]
+        assert len(sessionmanager.pool_status()["replicas"]) == 2
+    finally:
+        await sessionmanager.close()
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_warm_up(test_sessionmanager):
+    url = test_sessionmanager._engine.url
+    sessionmanager = DatabaseSessionManager(url, {"pool_size": 3}, [url])
+    prepared = []
+
+    async def prepare(session):
+        await lenses.warm_up(session)
+        prepared.append(session)
+
+    try:
+        await sessionmanager.warm_up(prepare)
+
+        status = sessionmanager.pool_status()
+        assert len(prepared) == 6
+        assert status["checked_in"] == 3
+        assert status["replicas"][0]["checked_in"] == 3
+    finally:
+        await sessionmanager.close()
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_writes_pin_client_to_primary(monkeypatch):
+    monkeypatch.setattr(settings, "database_replica_urls", ["postgresql://replica"])
+
+    product_data = {
+        "id": 1,
+        "lens_type": "CR39",
+        "sphere": -2.00,
+        "cylinder": -0.75,
+        "unit_price": 45.00,
+    }
+
+    async with AsyncClient(
+        transport=ASGITransport(app=main_app), base_url="http://test"
+    ) as client:
+        get_resp = await client.get("/api/inventory/lenses")
+        assert "X-Primary-Until" not in get_resp.headers
+
+        post_resp = await client.post("/api/inventory/lenses", json=product_data)
+        until = float(post_resp.headers["X-Primary-Until"])
+
+        assert until > time.time()
+        assert (
+            post_resp.cookies[PRIMARY_PIN_COOKIE]
+            == post_resp.headers["X-Primary-Until"]
+        )
+
+
+def test_pinned_to_primary():
+    def request(headers):
+        return Request({"type": "http", "headers": headers})
+
+    assert not _pinned_to_primary(request([]))
+    assert not _pinned_to_primary(request([(b"x-primary-until", b"garbage")]))
+    assert not _pinned_to_primary(
+        request([(b"x-primary-until", str(time.time() - 1).encode())])
+    )
+    assert _pinned_to_primary(
+        request([(b"x-primary-until", str(time.time() + 5).encode())])
+    )
+    assert _pinned_to_primary(
+        request([(b"cookie", f"{PRIMARY_PIN_COOKIE}={time.time() + 5}".encode())])
+    )
+    # never further out than pin_to_primary sets it
+    assert not _pinned_to_primary(
+        request([(b"x-primary-until", str(time.time() + 3600).encode())])
+    )
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_pinned_reads_skip_the_count_cache(test_sessionmanager):
+    async with AsyncClient(
+        transport=ASGITransport(app=main_app), base_url="http://test"
+    ) as client:
+        await client.post(
+            "/api/inventory/lenses",
+            json={
+                "id": 1,
+                "lens_type": "CR39",
+                "sphere": -2.00,
+                "cylinder": -0.75,
+                "unit_price": 45.00,
+            },
+        )
+
+    # a total counted on a replica that hadn't caught up with the write
+    lenses.count_cache.set(lenses.count_cache.key(None, False), 0)
+
+    async with test_sessionmanager.session() as db_session:
+        assert await lenses.count_lenses(db_session) == 0
+        db_session.info["pinned_to_primary"] = True
+        assert await lenses.count_lenses(db_session) == 1
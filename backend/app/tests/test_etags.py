@@ -0,0 +1,111 @@
+import asyncio
+
+import pytest
+from app.crud.catalog import bump_catalog_version, bumper, get_catalog_version
+from app.main import app as main_app
+from httpx import ASGITransport, AsyncClient
+
+product_data = {
+    "id": 1,
+    "lens_type": "CR39",
+    "sphere": -2.00,
+    "cylinder": -0.75,
+    "unit_price": 45.00,
+    "quantity": 5,
+    "storage_limit": 100,
+}
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_list_etag(max_queries):
+    async with AsyncClient(
+        transport=ASGITransport(app=main_app), base_url="http://test"
+    ) as client:
+        await client.post("/api/inventory/lenses", json=product_data)
+
+        first = await client.get("/api/inventory/lenses")
+        etag = first.headers["ETag"]
+
+        # only the catalog version is read
+        with max_queries(1):
+            unchanged = await client.get(
+                "/api/inventory/lenses", headers={"If-None-Match": etag}
+            )
+        other_query = await client.get(
+            "/api/inventory/lenses",
+            params={"limit": 10},
+            headers={"If-None-Match": etag},
+        )
+
+        await client.post("/api/inventory/lenses/1/adjust", json={"delta": 1})
+        changed = await client.get(
+            "/api/inventory/lenses", headers={"If-None-Match": f'W/{etag}, "other"'}
+        )
+
+    assert first.headers["Cache-Control"] == "no-cache"
+    assert unchanged.status_code == 304
+    assert unchanged.headers["ETag"] == etag
+    assert unchanged.content == b""
+    assert other_query.status_code == 200
+    assert changed.status_code == 200
+    assert changed.headers["ETag"] != etag
+    assert changed.json()[0]["quantity"] == 6
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_lens_etag():
+    async with AsyncClient(
+        transport=ASGITransport(app=main_app), base_url="http://test"
+    ) as client:
+        await client.post("/api/inventory/lenses", json=product_data)
+
+        first = await client.get("/api/inventory/lenses/1")
+        etag = first.headers["ETag"]
+        unchanged = await client.get(
+            "/api/inventory/lenses/1", headers={"If-None-Match": etag}
+        )
+
+        updated = await client.put(
+            "/api/inventory/lenses/1",
+            json={"quantity": 7},
+            headers={"If-Match": etag},
+        )
+        # the lens changed since etag was read
+        conflict = await client.put(
+            "/api/inventory/lenses/1",
+            json={"quantity": 8},
+            headers={"If-Match": etag},
+        )
+        weak = await client.put(
+            "/api/inventory/lenses/1",
+            json={"quantity": 8},
+            headers={"If-Match": f"W/{updated.headers['ETag']}"},
+        )
+        changed = await client.get(
+            "/api/inventory/lenses/1", headers={"If-None-Match": etag}
+        )
+
+    assert unchanged.status_code == 304
+    assert updated.status_code == 200
+    assert updated.headers["ETag"] != etag
+    assert conflict.status_code == 412
+    assert weak.status_code == 412
+    assert changed.status_code == 200
+    assert changed.headers["ETag"] == updated.headers["ETag"]
+    assert changed.json()["quantity"] == 7
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_concurrent_bumps_are_shared(test_db_session):
+    before = await get_catalog_version(test_db_session)
+    await asyncio.gather(*[bump_catalog_version(test_db_session) for _ in range(10)])
+    assert await get_catalog_version(test_db_session) == before + 1
+
+    # writers committing during a bump get the next one
+    running = asyncio.ensure_future(bump_catalog_version(test_db_session))
+    while bumper._running is None:
+        await asyncio.sleep(0)
+    await asyncio.gather(
+        running, *[bump_catalog_version(test_db_session) for _ in range(10)]
+    )
+    assert await get_catalog_version(test_db_session) == before + 3
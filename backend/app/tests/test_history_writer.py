@@ -0,0 +1,159 @@
+import asyncio
+import contextlib
+import os
+
+import pytest
+from app.crud.history import HistoryWriter, history_row
+from app.main import app as main_app
+from app.models import LensesHistory, UpdateField, UpdateType
+from httpx import ASGITransport, AsyncClient
+from sqlalchemy import select
+
+product_data = {
+    "id": 1,
+    "lens_type": "CR39",
+    "sphere": -2.00,
+    "cylinder": -0.75,
+    "unit_price": 45.00,
+    "quantity": 5,
+    "storage_limit": 100,
+}
+
+
+async def _create_lens():
+    async with AsyncClient(
+        transport=ASGITransport(app=main_app), base_url="http://test"
+    ) as client:
+        await client.post("/api/inventory/lenses", json=product_data)
+
+
+async def _quantity_history(db_session):
+    return (
+        await db_session.scalars(
+            select(LensesHistory)
+            .where(LensesHistory.update_type == UpdateType.UPDATE)
+            .order_by(LensesHistory.id)
+        )
+    ).all()
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_queued_history_is_flushed_in_batches(
+    test_sessionmanager, test_db_session, tmp_path
+):
+    await _create_lens()
+
+    writer = HistoryWriter(queued=True, batch_size=2, spool_dir=str(tmp_path))
+    await writer.start(test_sessionmanager.session)
+    writer.after_commit(
+        [
+            history_row(1, UpdateField.QUANTITY, str(n), str(n + 1), UpdateType.UPDATE)
+            for n in range(5)
+        ]
+    )
+    await writer.stop()
+
+    history = await _quantity_history(test_db_session)
+    assert [h.new_value for h in history] == ["1", "2", "3", "4", "5"]
+    assert all(h.update_timestamp is not None for h in history)
+    assert os.listdir(tmp_path) == []
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_stop_flushes_the_batch_being_collected(
+    test_sessionmanager, test_db_session, tmp_path
+):
+    await _create_lens()
+
+    writer = HistoryWriter(queued=True, flush_interval=5, spool_dir=str(tmp_path))
+    await writer.start(test_sessionmanager.session)
+    writer.after_commit(
+        [
+            history_row(1, UpdateField.QUANTITY, str(n), str(n + 1), UpdateType.UPDATE)
+            for n in range(3)
+        ]
+    )
+    # _run has taken the rows off the queue and waits for more
+    await asyncio.sleep(0.1)
+    await writer.stop()
+
+    history = await _quantity_history(test_db_session)
+    assert [h.new_value for h in history] == ["1", "2", "3"]
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_unwritable_history_is_spooled_and_replayed(
+    test_sessionmanager, test_db_session, tmp_path
+):
+    await _create_lens()
+
+    @contextlib.asynccontextmanager
+    async def broken_session():
+        raise ConnectionError("database is down")
+        yield
+
+    writer = HistoryWriter(queued=True, spool_dir=str(tmp_path / "spool"))
+    spool_path = tmp_path / "spool" / f"{os.getpid()}.jsonl"
+    await writer.start(broken_session)
+    writer.after_commit(
+        [history_row(1, UpdateField.QUANTITY, "5", "4", UpdateType.UPDATE, "sold")]
+    )
+    await writer.stop()
+
+    assert len(spool_path.read_text().splitlines()) == 1
+    assert await _quantity_history(test_db_session) == []
+
+    await writer.start(test_sessionmanager.session)
+    await writer.stop()
+
+    history = await _quantity_history(test_db_session)
+    assert [(h.new_value, h.update_notes) for h in history] == [("4", "sold")]
+    assert os.listdir(tmp_path / "spool") == []
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_only_orphaned_spools_are_replayed(
+    test_sessionmanager, test_db_session, tmp_path
+):
+    await _create_lens()
+
+    row = (
+        '{"lens_id": 1, "update_field": "QUANTITY", "old_value": "5", '
+        '"new_value": "%s", "update_type": "UPDATE", "update_notes": null, '
+        '"update_source": null, "update_timestamp": "2026-01-01T00:00:00+00:00"}\n'
+    )
+    # pid 1 is alive and may still be appending, a pid beyond pid_max is gone
+    (tmp_path / "1.jsonl").write_text(row % "live")
+    (tmp_path / "99999999.jsonl").write_text(row % "dead")
+
+    writer = HistoryWriter(queued=True, spool_dir=str(tmp_path))
+    await writer.start(test_sessionmanager.session)
+    await writer.stop()
+
+    history = await _quantity_history(test_db_session)
+    assert [h.new_value for h in history] == ["dead"]
+    assert os.listdir(tmp_path) == ["1.jsonl"]
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_spools_claimed_by_a_crashed_replay_are_replayed(
+    test_sessionmanager, test_db_session, tmp_path
+):
+    await _create_lens()
+
+    row = (
+        '{"lens_id": 1, "update_field": "QUANTITY", "old_value": "5", '
+        '"new_value": "%s", "update_type": "UPDATE", "update_notes": null, '
+        '"update_source": null, "update_timestamp": "2026-01-01T00:00:00+00:00"}\n'
+    )
+    # claimed by a replay that died half way, and by one still running
+    (tmp_path / "99999999.jsonl.99999998.replaying").write_text(row % "crashed")
+    (tmp_path / "99999997.jsonl.1.replaying").write_text(row % "running")
+
+    writer = HistoryWriter(queued=True, spool_dir=str(tmp_path))
+    await writer.start(test_sessionmanager.session)
+    await writer.stop()
+
+    history = await _quantity_history(test_db_session)
+    assert [h.new_value for h in history] == ["crashed"]
+    assert os.listdir(tmp_path) == ["99999997.jsonl.1.replaying"]
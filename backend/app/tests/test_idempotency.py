@@ -0,0 +1,171 @@
+import asyncio
+from datetime import timedelta
+
+import pytest
+from app.database import DatabaseSessionManager, get_db_session
+from app.idempotency import store
+from app.main import app as main_app
+from app.models import IdempotencyKey
+from httpx import ASGITransport, AsyncClient
+from sqlalchemy import update
+
+product_data = {
+    "id": 1,
+    "lens_type": "CR39",
+    "sphere": -2.00,
+    "cylinder": -0.75,
+    "unit_price": 45.00,
+    "quantity": 5,
+    "storage_limit": 100,
+}
+
+
+@pytest.fixture
+async def idempotency(test_sessionmanager):
+    store.start(test_sessionmanager.session)
+    yield store
+    await store.stop()
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_retried_create(idempotency):
+    async with AsyncClient(
+        transport=ASGITransport(app=main_app), base_url="http://test"
+    ) as client:
+        headers = {"Idempotency-Key": "scan-1"}
+        first = await client.post(
+            "/api/inventory/lenses", json=product_data, headers=headers
+        )
+        retry = await client.post(
+            "/api/inventory/lenses", json=product_data, headers=headers
+        )
+        other = await client.post(
+            "/api/inventory/lenses",
+            json={**product_data, "id": 2},
+            headers=headers,
+        )
+        without_key = await client.post("/api/inventory/lenses", json=product_data)
+        history = await client.get("/api/inventory/lenses/1/history")
+
+    assert first.status_code == 200
+    assert "Idempotent-Replayed" not in first.headers
+    assert retry.status_code == 200
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert retry.content == first.content
+    assert other.status_code == 422
+    # without a key the retry still runs, and fails
+    assert without_key.status_code == 400
+    assert {row["update_type"] for row in history.json()} == {"create"}
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_retried_update(idempotency):
+    async with AsyncClient(
+        transport=ASGITransport(app=main_app), base_url="http://test"
+    ) as client:
+        await client.post("/api/inventory/lenses", json=product_data)
+
+        headers = {"Idempotency-Key": "scan-2"}
+        update = {"quantity": 9, "update_notes": "Recount"}
+        # concurrent duplicates wait for the first one and get its response
+        responses = await asyncio.gather(
+            *(
+                client.put("/api/inventory/lenses/1", json=update, headers=headers)
+                for _ in range(3)
+            )
+        )
+        history = await client.get("/api/inventory/lenses/1/history")
+
+    assert [response.status_code for response in responses] == [200] * 3
+    assert len({response.content for response in responses}) == 1
+    assert len({response.headers["ETag"] for response in responses}) == 1
+    assert sum("Idempotent-Replayed" in response.headers for response in responses) == 2
+    assert [row["update_type"] for row in history.json()].count("update") == 1
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_keyed_requests_share_the_pool(test_sessionmanager, monkeypatch):
+    # the middleware and the routes draw on the same small pool
+    sessionmanager = DatabaseSessionManager(
+        test_sessionmanager._engine.url.render_as_string(hide_password=False),
+        {"pool_size": 2, "max_overflow": 0, "pool_timeout": 5},
+    )
+
+    async def _db_session():
+        async with sessionmanager.session() as session:
+            yield session
+
+    monkeypatch.setitem(main_app.dependency_overrides, get_db_session, _db_session)
+    store.start(sessionmanager.session)
+    try:
+        async with AsyncClient(
+            transport=ASGITransport(app=main_app), base_url="http://test"
+        ) as client:
+            # four lenses, each sent twice
+            responses = await asyncio.gather(
+                *(
+                    client.post(
+                        "/api/inventory/lenses",
+                        json={**product_data, "id": i % 4 + 1},
+                        headers={"Idempotency-Key": f"pool-{i % 4}"},
+                    )
+                    for i in range(8)
+                )
+            )
+    finally:
+        await store.stop()
+        await sessionmanager.close()
+
+    assert [response.status_code for response in responses] == [200] * 8
+    assert sum("Idempotent-Replayed" in response.headers for response in responses) == 4
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_abandoned_claim(idempotency, test_sessionmanager, monkeypatch):
+    monkeypatch.setattr(store, "wait", 0.2)
+    async with AsyncClient(
+        transport=ASGITransport(app=main_app), base_url="http://test"
+    ) as client:
+        headers = {"Idempotency-Key": "scan-4"}
+        first = await client.post(
+            "/api/inventory/lenses", json=product_data, headers=headers
+        )
+        # claimed by a request that never stored its response
+        async with test_sessionmanager.session() as db_session:
+            await db_session.execute(
+                update(IdempotencyKey)
+                .where(IdempotencyKey.key == "scan-4")
+                .values(status_code=None, body=None, headers=None)
+            )
+            await db_session.commit()
+        running = await client.post(
+            "/api/inventory/lenses", json=product_data, headers=headers
+        )
+
+        monkeypatch.setattr(store, "pending_ttl", timedelta(0))
+        taken_over = await client.post(
+            "/api/inventory/lenses", json=product_data, headers=headers
+        )
+
+    assert first.status_code == 200
+    assert running.status_code == 409
+    # runs again, the lens exists by now
+    assert taken_over.status_code == 400
+    assert "Idempotent-Replayed" not in taken_over.headers
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_purge_idempotency_keys(idempotency, test_sessionmanager, monkeypatch):
+    async with AsyncClient(
+        transport=ASGITransport(app=main_app), base_url="http://test"
+    ) as client:
+        await client.post(
+            "/api/inventory/lenses",
+            json=product_data,
+            headers={"Idempotency-Key": "scan-3"},
+        )
+
+    async with test_sessionmanager.session() as db_session:
+        assert await store.purge(db_session) == 0
+        monkeypatch.setattr(store, "ttl", timedelta(0))
+        assert await store.purge(db_session) == 1
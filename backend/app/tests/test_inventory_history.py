@@ -1,3 +1,24 @@
+import json
+from datetime import datetime, timedelta
+
+import pytest
+from app import maintenance
+from app.config import settings
+from app.main import app as main_app
+from app.models import LensesHistory
+from httpx import ASGITransport, AsyncClient
+from sqlalchemy import delete
+
+product_data = {
+    "id": 1,
+    "lens_type": "CR39",
+    "sphere": -2.00,
+    "cylinder": -0.75,
+    "unit_price": 45.00,
+    "quantity": 5,
+    "storage_limit": 100,
+}
+
 # import pytest
 # from app.main import app as main_app
 # from app.models import LensesHistory, UpdateField, UpdateType
@@ -157,3 +178,237 @@
 #             case UpdateField.DELETED_AT:
 #                 assert history.old_value is not None
 #                 assert history.new_value is None
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_read_lens_history_pages():
+    async with AsyncClient(
+        transport=ASGITransport(app=main_app), base_url="http://test"
+    ) as client:
+        await client.post("/api/inventory/lenses", json=product_data)
+        await client.post("/api/inventory/lenses", json={**product_data, "id": 2})
+        for quantity in (6, 7, 8):
+            await client.put(
+                "/api/inventory/lenses/1",
+                json={"quantity": quantity, "update_source": "scanner"},
+            )
+
+        first = await client.get("/api/inventory/lenses/1/history", params={"limit": 4})
+        second = await client.get(
+            "/api/inventory/lenses/1/history",
+            params={"limit": 6, "cursor": first.headers["X-Next-Cursor"]},
+        )
+        back = await client.get(
+            "/api/inventory/lenses/1/history",
+            params={"limit": 4, "cursor": second.headers["X-Prev-Cursor"]},
+        )
+
+    assert first.status_code == 200
+    page = first.json()
+    # newest first
+    assert [(h["update_type"], h["new_value"]) for h in page[:3]] == [
+        ("update", "8"),
+        ("update", "7"),
+        ("update", "6"),
+    ]
+    assert page[0]["update_field"] == "quantity"
+    assert page[0]["update_source"] == "scanner"
+    assert page[3]["update_type"] == "create"
+
+    rest = second.json()
+    assert len(rest) == 6
+    assert "X-Next-Cursor" not in second.headers
+    assert all(h["lens_id"] == 1 for h in page + rest)
+    assert len({h["id"] for h in page + rest}) == 10
+    assert back.json() == page
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_history_missing_values_are_null():
+    async with AsyncClient(
+        transport=ASGITransport(app=main_app), base_url="http://test"
+    ) as client:
+        await client.post("/api/inventory/lenses", json=product_data)
+        await client.put("/api/inventory/lenses/1", json={"comment": "scratched"})
+        history = await client.get("/api/inventory/lenses/1/history")
+
+    comments = [
+        (h["old_value"], h["new_value"])
+        for h in history.json()
+        if h["update_field"] == "comment"
+    ]
+    # the same as history written in SQL, never the string "None"
+    assert comments == [(None, "scratched"), (None, None)]
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_read_history_filter():
+    async with AsyncClient(
+        transport=ASGITransport(app=main_app), base_url="http://test"
+    ) as client:
+        await client.post("/api/inventory/lenses", json=product_data)
+        await client.post("/api/inventory/lenses", json={**product_data, "id": 2})
+        await client.put("/api/inventory/lenses/2", json={"quantity": 9})
+        await client.put("/api/inventory/lenses/2", json={"comment": "restocked"})
+
+        updates = await client.get(
+            "/api/inventory/history",
+            params={
+                "filter": json.dumps(
+                    [
+                        {"field": "update_type", "operator": "eq", "value": "update"},
+                        {
+                            "field": "update_field",
+                            "operator": "in",
+                            "value": ["quantity", "unit_price"],
+                        },
+                    ]
+                )
+            },
+        )
+        created_since = await client.get(
+            "/api/inventory/history",
+            params={
+                "filter": json.dumps(
+                    [
+                        {
+                            "field": "update_timestamp",
+                            "operator": "gte",
+                            "value": "2000-01-01T00:00:00Z",
+                        },
+                        {"field": "q", "operator": "eq", "value": "restock"},
+                    ]
+                )
+            },
+        )
+        oldest_first = await client.get(
+            "/api/inventory/history",
+            params={"sort": json.dumps([["id", "ASC"]]), "limit": 3},
+        )
+
+    assert [(h["lens_id"], h["new_value"]) for h in updates.json()] == [(2, "9")]
+    assert [h["new_value"] for h in created_since.json()] == ["restocked"]
+    assert [h["lens_id"] for h in oldest_first.json()] == [1, 1, 1]
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_read_history_errors():
+    async with AsyncClient(
+        transport=ASGITransport(app=main_app), base_url="http://test"
+    ) as client:
+        await client.post("/api/inventory/lenses", json=product_data)
+
+        missing = await client.get("/api/inventory/lenses/404/history")
+        bad_field = await client.get(
+            "/api/inventory/history",
+            params={
+                "filter": json.dumps(
+                    [{"field": "lens_type", "operator": "eq", "value": "CR39"}]
+                )
+            },
+        )
+        bad_value = await client.get(
+            "/api/inventory/history",
+            params={
+                "filter": json.dumps(
+                    [{"field": "update_type", "operator": "eq", "value": "moved"}]
+                )
+            },
+        )
+        bad_cursor = await client.get(
+            "/api/inventory/lenses/1/history", params={"cursor": "garbage"}
+        )
+
+    assert missing.status_code == 404
+    assert bad_field.status_code == 400
+    assert bad_value.status_code == 400
+    assert bad_cursor.status_code == 400
+
+
+async def _timestamps(client, product_id: int) -> list[datetime]:
+    history = await client.get(
+        f"/api/inventory/lenses/{product_id}/history",
+        params={"sort": json.dumps([["id", "ASC"]])},
+    )
+    return sorted(
+        {datetime.fromisoformat(h["update_timestamp"]) for h in history.json()}
+    )
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_read_lenses_as_of():
+    async with AsyncClient(
+        transport=ASGITransport(app=main_app), base_url="http://test"
+    ) as client:
+        await client.post("/api/inventory/lenses", json=product_data)
+        await client.put("/api/inventory/lenses/1", json={"quantity": 7})
+        await client.post("/api/inventory/lenses", json={**product_data, "id": 2})
+        await client.delete("/api/inventory/lenses/1")
+        created, updated, deleted = await _timestamps(client, 1)
+
+        async def as_of(timestamp: datetime, path: str = "/api/inventory/lenses"):
+            return await client.get(path, params={"as_of": timestamp.isoformat()})
+
+        before = await as_of(created - timedelta(seconds=1))
+        at_creation = await as_of(created)
+        at_update = await as_of(updated)
+        after_delete = await as_of(deleted)
+        lens_before = await as_of(
+            created - timedelta(seconds=1), "/api/inventory/lenses/1"
+        )
+        lens_at_update = await as_of(updated, "/api/inventory/lenses/1")
+        lens_after_delete = await as_of(deleted, "/api/inventory/lenses/1")
+        other_after_delete = await as_of(deleted, "/api/inventory/lenses/2")
+
+    assert before.json() == []
+    assert [(lens["id"], lens["quantity"]) for lens in at_creation.json()] == [(1, 5)]
+    assert [(lens["id"], lens["quantity"]) for lens in at_update.json()] == [(1, 7)]
+    assert [lens["id"] for lens in after_delete.json()] == [2]
+
+    assert lens_before.status_code == 404
+    assert lens_at_update.json()["quantity"] == 7
+    assert lens_at_update.json()["storage_limit"] == 100
+    assert lens_after_delete.status_code == 404
+    assert other_after_delete.json()["id"] == 2
+    assert other_after_delete.json()["quantity"] == 5
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_read_lenses_as_of_snapshot(
+    test_sessionmanager, test_db_session, monkeypatch
+):
+    monkeypatch.setattr(settings, "snapshot_replay_margin", 0)
+
+    async with AsyncClient(
+        transport=ASGITransport(app=main_app), base_url="http://test"
+    ) as client:
+        await client.post("/api/inventory/lenses", json=product_data)
+        await client.put("/api/inventory/lenses/1", json={"quantity": 6})
+
+        async with test_sessionmanager.connect() as connection:
+            assert await maintenance.take_snapshot(connection)
+            # a recent snapshot is there, so this one is skipped
+            assert not await maintenance.take_snapshot(connection, 3600)
+
+        # only the snapshot knows about the lens now
+        await test_db_session.execute(delete(LensesHistory))
+        await test_db_session.commit()
+
+        await client.put("/api/inventory/lenses/1", json={"quantity": 7})
+        (updated,) = await _timestamps(client, 1)
+
+        before_update = await client.get(
+            "/api/inventory/lenses",
+            params={"as_of": (updated - timedelta(microseconds=1)).isoformat()},
+        )
+        at_update = await client.get(
+            "/api/inventory/lenses", params={"as_of": updated.isoformat()}
+        )
+        lens_before_update = await client.get(
+            "/api/inventory/lenses/1",
+            params={"as_of": (updated - timedelta(microseconds=1)).isoformat()},
+        )
+
+    assert [lens["quantity"] for lens in before_update.json()] == [6]
+    assert lens_before_update.json()["quantity"] == 6
+    assert [lens["quantity"] for lens in at_update.json()] == [7]
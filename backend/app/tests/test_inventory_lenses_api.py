@@ -1,8 +1,15 @@
+import base64
+import csv
 import datetime
+import io
+import json
 
 import pytest
+from app.config import settings
 from app.main import app as main_app
+from app.models import LensesHistory, UpdateField, UpdateType
 from httpx import ASGITransport, AsyncClient
+from sqlalchemy import select
 
 # TODO: add tests for sort, range, and filter query parameters
 
@@ -251,6 +258,125 @@ async def test_update_lens_not_exist():
         assert put_resp.status_code == 400
 
 
+@pytest.mark.asyncio(loop_scope="session")
+async def test_update_lens_compare_and_swap():
+    product_data = {
+        "id": 1,
+        "lens_type": "CR39",
+        "sphere": -2.00,
+        "cylinder": -0.75,
+        "unit_price": 45.00,
+        "quantity": 5,
+        "storage_limit": 100,
+    }
+
+    async with AsyncClient(
+        transport=ASGITransport(app=main_app), base_url="http://test"
+    ) as client:
+        created = (await client.post("/api/inventory/lenses", json=product_data)).json()
+
+        put_resp = await client.put(
+            "/api/inventory/lenses/1",
+            json={
+                "quantity": 10,
+                "unit_price": 45.00,
+                "updated_at": created["updated_at"],
+                "update_notes": "Recount",
+            },
+        )
+        # a second editor still holding the old version
+        stale_resp = await client.put(
+            "/api/inventory/lenses/1",
+            json={"quantity": 3, "updated_at": created["updated_at"]},
+        )
+        missing_resp = await client.put(
+            "/api/inventory/lenses/2",
+            json={"quantity": 3, "updated_at": created["updated_at"]},
+        )
+        history_resp = await client.get("/api/inventory/lenses/1/history")
+
+    assert put_resp.status_code == 200
+    assert put_resp.json()["quantity"] == 10
+    assert put_resp.json()["updated_at"] > created["updated_at"]
+    assert put_resp.headers["ETag"]
+    assert stale_resp.status_code == 409
+    assert missing_resp.status_code == 400
+
+    # only the fields that changed get history
+    updates = [row for row in history_resp.json() if row["update_type"] == "update"]
+    assert [
+        (row["update_field"], row["old_value"], row["new_value"], row["update_notes"])
+        for row in updates
+    ] == [("quantity", "5", "10", "Recount")]
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_update_lens_null_version():
+    product_data = {
+        "id": 1,
+        "lens_type": "CR39",
+        "sphere": -2.00,
+        "cylinder": -0.75,
+        "unit_price": 45.00,
+        "quantity": 5,
+        "storage_limit": 100,
+    }
+
+    async with AsyncClient(
+        transport=ASGITransport(app=main_app), base_url="http://test"
+    ) as client:
+        await client.post("/api/inventory/lenses", json=product_data)
+
+        # a null version is an unconditional write, not a field to diff
+        put_resp = await client.put(
+            "/api/inventory/lenses/1", json={"quantity": 9, "updated_at": None}
+        )
+
+    assert put_resp.status_code == 200
+    assert put_resp.json()["quantity"] == 9
+    assert put_resp.json()["updated_at"] is not None
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_update_lens_history_numeric_text():
+    product_data = {
+        "id": 1,
+        "lens_type": "CR39",
+        "sphere": -2,
+        "cylinder": -0.5,
+        "unit_price": 45.0,
+        "quantity": 5,
+    }
+
+    async with AsyncClient(
+        transport=ASGITransport(app=main_app), base_url="http://test"
+    ) as client:
+        await client.post("/api/inventory/lenses", json=product_data)
+
+        # written in python, then in SQL by the compare-and-swap
+        put_resp = await client.put(
+            "/api/inventory/lenses/1", json={"unit_price": 50, "sphere": 0}
+        )
+        await client.put(
+            "/api/inventory/lenses/1",
+            json={"unit_price": 55.5, "updated_at": put_resp.json()["updated_at"]},
+        )
+        history = (await client.get("/api/inventory/lenses/1/history")).json()
+
+    values = sorted(
+        (row["update_type"], row["update_field"], row["old_value"], row["new_value"])
+        for row in history
+        if row["update_field"] in ("sphere", "unit_price")
+    )
+    assert values == [
+        ("create", "sphere", None, "-2.00"),
+        ("create", "unit_price", None, "45.00"),
+        ("update", "sphere", "-2.00", "0.00"),
+        ("update", "unit_price", "45.00", "50.00"),
+        ("update", "unit_price", "50.00", "55.50"),
+    ]
+
+
 @pytest.mark.asyncio(loop_scope="session")
 async def test_delete_lens():
     product_data = {
@@ -379,3 +505,502 @@ async def test_can_see_deleted_lenses_with_all_endpoint():
         assert len(ret) == 1
         assert compare_returned_json(ret[0], product_data)
         assert ret[0]["deleted_at"] is not None
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_get_lenses_cursor_pagination():
+    products = [
+        {
+            "id": i,
+            "lens_type": "CR39" if i % 2 else "Trivex",
+            "sphere": -0.25 * (i % 3),
+            "cylinder": -0.50,
+            "unit_price": 40.00 + i,
+            "quantity": i,
+            "storage_limit": None if i % 4 == 0 else 100,
+        }
+        for i in range(1, 8)
+    ]
+
+    async with AsyncClient(
+        transport=ASGITransport(app=main_app), base_url="http://test"
+    ) as client:
+        for product in products:
+            await client.post("/api/inventory/lenses", json=product)
+
+        for sort in (
+            [["id", "asc"]],
+            [["sphere", "desc"]],
+            [["storage_limit", "asc"], ["lens_type", "desc"]],
+        ):
+            expected = [
+                lens["id"]
+                for lens in (
+                    await client.get(
+                        "/api/inventory/lenses", params={"sort": json.dumps(sort)}
+                    )
+                ).json()
+            ]
+
+            # walk forwards
+            seen = []
+            params = {"sort": json.dumps(sort), "limit": 3}
+            pages = []
+            while True:
+                resp = await client.get("/api/inventory/lenses", params=params)
+                assert resp.status_code == 200
+                pages.append(resp)
+                seen.extend(lens["id"] for lens in resp.json())
+                if "X-Next-Cursor" not in resp.headers:
+                    break
+                params["cursor"] = resp.headers["X-Next-Cursor"]
+
+            assert seen == expected
+            assert "X-Prev-Cursor" not in pages[0].headers
+
+            # and back again from the last page
+            params["cursor"] = pages[-1].headers["X-Prev-Cursor"]
+            resp = await client.get("/api/inventory/lenses", params=params)
+            assert resp.json() == pages[-2].json()
+
+        for bad_sort in (
+            [["quantity"]],
+            [["quantity", "asc", "id"]],
+            [["quantity", "sideways"]],
+            [["nope", "asc"]],
+        ):
+            resp = await client.get(
+                "/api/inventory/lenses", params={"sort": json.dumps(bad_sort)}
+            )
+            assert resp.status_code == 400
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_get_lenses_cursor_malformed():
+    async with AsyncClient(
+        transport=ASGITransport(app=main_app), base_url="http://test"
+    ) as client:
+        resp = await client.get(
+            "/api/inventory/lenses", params={"limit": 2, "cursor": "not-a-cursor"}
+        )
+        assert resp.status_code == 400
+
+        resp = await client.get(
+            "/api/inventory/lenses", params={"limit": 2, "range": "[0, 2]"}
+        )
+        assert resp.status_code == 400
+
+        for i in range(1, 4):
+            await client.post(
+                "/api/inventory/lenses",
+                json={
+                    "id": i,
+                    "lens_type": "CR39",
+                    "sphere": -i,
+                    "cylinder": -0.75,
+                    "unit_price": 45.00,
+                },
+            )
+        sort = json.dumps([["created_at", "ASC"]])
+        resp = await client.get(
+            "/api/inventory/lenses", params={"limit": 2, "sort": sort}
+        )
+        cursor = resp.headers["X-Next-Cursor"]
+        payload = json.loads(
+            base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        )
+
+        # well formed JSON, but not the values of the sort keys
+        for values in (5, [5, 1], ["not a timestamp", 1]):
+            crafted = base64.urlsafe_b64encode(
+                json.dumps({**payload, "v": values}).encode()
+            ).decode()
+            resp = await client.get(
+                "/api/inventory/lenses",
+                params={"limit": 2, "sort": sort, "cursor": crafted},
+            )
+            assert resp.status_code == 400
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_get_lenses_total_count():
+    product_data = {
+        "id": 1,
+        "lens_type": "CR39",
+        "sphere": -2.00,
+        "cylinder": -0.75,
+        "unit_price": 45.00,
+        "quantity": 5,
+    }
+    params = {
+        "range": "[0, 10]",
+        "filter": json.dumps(
+            [{"field": "lens_type", "operator": "eq", "value": "CR39"}]
+        ),
+    }
+
+    async with AsyncClient(
+        transport=ASGITransport(app=main_app), base_url="http://test"
+    ) as client:
+        await client.post("/api/inventory/lenses", json=product_data)
+
+        get_resp = await client.get("/api/inventory/lenses", params=params)
+        assert get_resp.headers["X-Total-Count"] == "1"
+
+        # cached totals are dropped on writes
+        await client.post("/api/inventory/lenses", json={**product_data, "id": 2})
+
+        get_resp = await client.get("/api/inventory/lenses", params=params)
+        assert get_resp.headers["X-Total-Count"] == "2"
+
+        await client.delete("/api/inventory/lenses/1")
+
+        get_resp = await client.get("/api/inventory/lenses", params=params)
+        assert get_resp.headers["X-Total-Count"] == "1"
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_get_lenses_estimated_count(monkeypatch):
+    monkeypatch.setattr(settings, "estimated_count_threshold", 0)
+
+    async with AsyncClient(
+        transport=ASGITransport(app=main_app), base_url="http://test"
+    ) as client:
+        get_resp = await client.get(
+            "/api/inventory/lenses", params={"range": "[0, 10]", "count": "estimated"}
+        )
+
+        assert get_resp.status_code == 200
+        assert int(get_resp.headers["X-Total-Count"]) >= 0
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_bulk_create_lenses(test_db_session):
+    product_data = {
+        "lens_type": "CR39",
+        "sphere": -2.00,
+        "cylinder": -0.75,
+        "unit_price": 45.00,
+        "quantity": 5,
+        "storage_limit": 100,
+    }
+
+    async with AsyncClient(
+        transport=ASGITransport(app=main_app), base_url="http://test"
+    ) as client:
+        await client.post("/api/inventory/lenses", json={**product_data, "id": 1})
+        await client.post("/api/inventory/lenses", json={**product_data, "id": 2})
+        await client.delete("/api/inventory/lenses/2")
+
+        post_resp = await client.post(
+            "/api/inventory/lenses/bulk",
+            json=[
+                {**product_data, "id": 1},
+                {**product_data, "id": 2, "lens_type": "Trivex"},
+                {**product_data, "id": 3},
+                {**product_data, "id": 3},
+                {**product_data, "id": 4, "comment": "Bulk"},
+            ],
+        )
+
+        assert post_resp.status_code == 200
+        assert [(r["id"], r["status"]) for r in post_resp.json()] == [
+            (1, "error"),
+            (2, "replaced"),
+            (3, "created"),
+            (3, "error"),
+            (4, "created"),
+        ]
+
+        get_resp = await client.get("/api/inventory/lenses")
+        ret = get_resp.json()
+
+        assert [lens["id"] for lens in ret] == [1, 2, 3, 4]
+        assert ret[1]["lens_type"] == "Trivex"
+        assert compare_returned_json(
+            ret[3], {**product_data, "id": 4, "comment": "Bulk"}
+        )
+
+    history = (
+        await test_db_session.scalars(
+            select(LensesHistory).where(LensesHistory.lens_id.in_([2, 3, 4]))
+        )
+    ).all()
+
+    # create for 2, 3 and 4, plus the replacement of 2 and the delete before it
+    assert len(history) == 7 * 3 + 8 + 1
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_adjust_lens_quantity(test_db_session):
+    product_data = {
+        "id": 1,
+        "lens_type": "CR39",
+        "sphere": -2.00,
+        "cylinder": -0.75,
+        "unit_price": 45.00,
+        "quantity": 5,
+        "storage_limit": 100,
+    }
+
+    async with AsyncClient(
+        transport=ASGITransport(app=main_app), base_url="http://test"
+    ) as client:
+        await client.post("/api/inventory/lenses", json=product_data)
+
+        post_resp = await client.post(
+            "/api/inventory/lenses/1/adjust",
+            json={"delta": 3, "update_source": "scanner"},
+        )
+        assert post_resp.status_code == 200
+        assert post_resp.json()["quantity"] == 8
+
+        post_resp = await client.post(
+            "/api/inventory/lenses/1/adjust", json={"delta": -9}
+        )
+        assert post_resp.status_code == 409
+
+        post_resp = await client.post(
+            "/api/inventory/lenses/1/adjust", json={"delta": -9, "allow_negative": True}
+        )
+        assert post_resp.status_code == 200
+        assert post_resp.json()["quantity"] == -1
+
+        post_resp = await client.post(
+            "/api/inventory/lenses/2/adjust", json={"delta": 1}
+        )
+        assert post_resp.status_code == 404
+
+        get_resp = await client.get("/api/inventory/lenses/1")
+        assert get_resp.json()["quantity"] == -1
+
+    history = (
+        await test_db_session.scalars(
+            select(LensesHistory)
+            .where(LensesHistory.update_type == UpdateType.UPDATE)
+            .order_by(LensesHistory.id)
+        )
+    ).all()
+
+    assert [(h.update_field, h.old_value, h.new_value) for h in history] == [
+        (UpdateField.QUANTITY, "5", "8"),
+        (UpdateField.QUANTITY, "8", "-1"),
+    ]
+    assert history[0].update_source == "scanner"
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_get_lenses_filter():
+    products = [
+        {
+            "id": 1,
+            "lens_type": "CR39",
+            "sphere": -2.00,
+            "cylinder": -0.75,
+            "unit_price": 45.00,
+            "quantity": 5,
+            "comment": "Front shelf",
+        },
+        {
+            "id": 2,
+            "lens_type": "Polycarbonate",
+            "sphere": -1.50,
+            "cylinder": -1.25,
+            "unit_price": 60.00,
+            "quantity": 7,
+        },
+        {
+            "id": 3,
+            "lens_type": "Trivex",
+            "sphere": 0.00,
+            "cylinder": -0.75,
+            "unit_price": 80.00,
+            "quantity": 0,
+        },
+    ]
+
+    async def filtered_ids(client, filter):
+        get_resp = await client.get(
+            "/api/inventory/lenses", params={"filter": json.dumps(filter)}
+        )
+        assert get_resp.status_code == 200
+        return [lens["id"] for lens in get_resp.json()]
+
+    async with AsyncClient(
+        transport=ASGITransport(app=main_app), base_url="http://test"
+    ) as client:
+        for product in products:
+            await client.post("/api/inventory/lenses", json=product)
+
+        in_filter = [{"field": "lens_type", "operator": "in", "value": ["CR39"]}]
+        assert await filtered_ids(client, in_filter) == [1]
+
+        # same shape, different values
+        in_filter[0]["value"] = ["Trivex", "Polycarbonate"]
+        assert await filtered_ids(client, in_filter) == [2, 3]
+
+        nin_filter = [{"field": "lens_type", "operator": "nin", "value": ["CR39"]}]
+        assert await filtered_ids(client, nin_filter) == [2, 3]
+
+        nested_filter = [
+            {
+                "operator": "or",
+                "value": [
+                    {
+                        "operator": "and",
+                        "value": [
+                            {"field": "sphere", "operator": "lt", "value": -1.0},
+                            {"field": "unit_price", "operator": "gte", "value": 60},
+                        ],
+                    },
+                    {"field": "quantity", "operator": "eq", "value": 0},
+                ],
+            }
+        ]
+        assert await filtered_ids(client, nested_filter) == [2, 3]
+
+        q_filter = [{"field": "q", "operator": "eq", "value": "shelf"}]
+        assert await filtered_ids(client, q_filter) == [1]
+
+        between_filter = [
+            {"field": "sphere", "operator": "between", "value": [-1.5, 0]},
+            {"field": "lens_type", "operator": "startswith", "value": "Tri"},
+        ]
+        assert await filtered_ids(client, between_filter) == [3]
+
+        column_filter = [
+            {"field": "sphere", "operator": "gt", "value": {"field": "cylinder"}}
+        ]
+        assert await filtered_ids(client, column_filter) == [3]
+
+        # numbers sent as strings bind as the column's type
+        string_filter = [{"field": "quantity", "operator": "eq", "value": "0"}]
+        assert await filtered_ids(client, string_filter) == [3]
+
+        for bad_filter in (
+            [{"field": "nope", "operator": "eq", "value": 1}],
+            [{"field": "quantity", "operator": "nope", "value": 1}],
+            [{"field": "quantity", "operator": "in", "value": 1}],
+            [{"field": "quantity", "value": 1}],
+            [{"field": "quantity", "operator": "in", "value": {"field": "sphere"}}],
+            [{"field": "quantity", "operator": "lt", "value": {"field": "nope"}}],
+            [{"field": "lens_type", "operator": "lt", "value": {"field": "quantity"}}],
+            [{"field": "updated_at", "operator": "eq", "value": {"field": "sphere"}}],
+            [{"field": "quantity", "operator": "eq", "value": "abc"}],
+            [{"field": "quantity", "operator": "gt", "value": 1.5}],
+            [{"field": "unit_price", "operator": "in", "value": [10, "x"]}],
+            [{"field": "updated_at", "operator": "lt", "value": 5}],
+            [{"field": "lens_type", "operator": "eq", "value": 5}],
+        ):
+            get_resp = await client.get(
+                "/api/inventory/lenses", params={"filter": json.dumps(bad_filter)}
+            )
+            assert get_resp.status_code == 400
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_export_lenses(monkeypatch):
+    # several batches from the server side cursor
+    monkeypatch.setattr(settings, "export_batch_size", 2)
+
+    products = [
+        {
+            "id": i,
+            "lens_type": "CR39" if i % 2 else "Trivex",
+            "sphere": -0.25 * i,
+            "cylinder": -0.50,
+            "unit_price": 40.00 + i,
+            "quantity": i,
+            "comment": "Line, with comma" if i == 1 else None,
+        }
+        for i in range(1, 6)
+    ]
+
+    async with AsyncClient(
+        transport=ASGITransport(app=main_app), base_url="http://test"
+    ) as client:
+        for product in products:
+            await client.post("/api/inventory/lenses", json=product)
+        await client.delete("/api/inventory/lenses/5")
+
+        get_resp = await client.get(
+            "/api/inventory/lenses/export",
+            params={
+                "sort": json.dumps([["sphere", "asc"]]),
+                "filter": json.dumps(
+                    [{"field": "lens_type", "operator": "eq", "value": "CR39"}]
+                ),
+            },
+        )
+
+        assert get_resp.status_code == 200
+        assert get_resp.headers["content-type"] == "application/x-ndjson"
+
+        ret = [json.loads(line) for line in get_resp.text.splitlines()]
+        assert [lens["id"] for lens in ret] == [3, 1]
+        assert compare_returned_json(ret[1], {**products[0], "storage_limit": None})
+
+        get_resp = await client.get(
+            "/api/inventory/lenses/export",
+            params={"format": "csv", "show_deleted": True},
+        )
+
+        assert get_resp.status_code == 200
+        rows = list(csv.DictReader(io.StringIO(get_resp.text)))
+        assert [row["id"] for row in rows] == ["1", "2", "3", "4", "5"]
+        assert rows[0]["comment"] == "Line, with comma"
+        assert rows[0]["sphere"] == "-0.25"
+
+        get_resp = await client.get(
+            "/api/inventory/lenses/export",
+            params={"filter": json.dumps([{"field": "nope", "operator": "eq"}])},
+        )
+        assert get_resp.status_code == 400
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_get_reorder_report():
+    lens = {
+        "lens_type": "CR39",
+        "sphere": -2.00,
+        "cylinder": -0.75,
+        "unit_price": 10.00,
+        "quantity": 5,
+        "storage_limit": 10,
+    }
+
+    async with AsyncClient(
+        transport=ASGITransport(app=main_app), base_url="http://test"
+    ) as client:
+        await client.post(
+            "/api/inventory/lenses/bulk",
+            json=[
+                {**lens, "id": 1},
+                {**lens, "id": 2, "quantity": 2, "unit_price": 5.00},
+                {**lens, "id": 3, "quantity": 10},
+                {**lens, "id": 4, "storage_limit": None},
+                {**lens, "id": 5, "quantity": 0, "lens_type": "Trivex"},
+            ],
+        )
+        await client.delete("/api/inventory/lenses/5")
+
+        by_shortage = await client.get("/api/inventory/lenses/reorder")
+        by_cost = await client.get(
+            "/api/inventory/lenses/reorder", params={"rank": "cost", "limit": 1}
+        )
+        filtered = await client.get(
+            "/api/inventory/lenses/reorder",
+            params={
+                "filter": json.dumps(
+                    [{"field": "fill_ratio", "operator": "gte", "value": 0.5}]
+                )
+            },
+        )
+
+    assert by_shortage.status_code == 200
+    assert [
+        (lens["id"], lens["shortage"], lens["fill_ratio"], lens["reorder_cost"])
+        for lens in by_shortage.json()
+    ] == [(2, 8, 0.2, 40.0), (1, 5, 0.5, 50.0)]
+    assert [lens["id"] for lens in by_cost.json()] == [1]
+    assert [lens["id"] for lens in filtered.json()] == [1]
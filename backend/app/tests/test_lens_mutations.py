@@ -0,0 +1,136 @@
+import pytest
+from app.main import app as main_app
+from httpx import ASGITransport, AsyncClient
+
+
+def _lens(id: int, lens_type: str, unit_price: float) -> dict:
+    return {
+        "id": id,
+        "lens_type": lens_type,
+        "sphere": -id / 4,
+        "cylinder": -0.75,
+        "unit_price": unit_price,
+        "quantity": 5,
+        "storage_limit": 100,
+    }
+
+
+CR39 = [{"field": "lens_type", "operator": "eq", "value": "CR39"}]
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_mutate_lenses():
+    async with AsyncClient(
+        transport=ASGITransport(app=main_app), base_url="http://test"
+    ) as client:
+        await client.post(
+            "/api/inventory/lenses/bulk",
+            json=[
+                _lens(1, "CR39", 40.00),
+                _lens(2, "CR39", 45.50),
+                _lens(3, "PC", 60.00),
+            ],
+        )
+
+        dry_run = await client.post(
+            "/api/inventory/lenses/mutate",
+            json={
+                "filter": CR39,
+                "operation": "scale_price",
+                "percent": 10,
+                "dry_run": True,
+            },
+        )
+        too_many = await client.post(
+            "/api/inventory/lenses/mutate",
+            json={
+                "filter": CR39,
+                "operation": "scale_price",
+                "percent": 10,
+                "max_affected": 1,
+            },
+        )
+        unchanged = (await client.get("/api/inventory/lenses")).json()
+
+        scaled = await client.post(
+            "/api/inventory/lenses/mutate",
+            json={
+                "filter": CR39,
+                "operation": "scale_price",
+                "percent": 10,
+                "update_notes": "Price list 2027",
+            },
+        )
+        set_resp = await client.post(
+            "/api/inventory/lenses/mutate",
+            json={
+                "filter": [{"field": "id", "operator": "in", "value": [2, 3]}],
+                "operation": "set",
+                "values": {"storage_limit": 100, "comment": "Discontinued"},
+            },
+        )
+        deleted = await client.post(
+            "/api/inventory/lenses/mutate",
+            json={"filter": CR39, "operation": "delete"},
+        )
+
+        remaining = (await client.get("/api/inventory/lenses")).json()
+        everything = (await client.get("/api/inventory/lenses/all")).json()
+        history = (await client.get("/api/inventory/history")).json()
+
+    assert dry_run.json() == {"affected": 2, "dry_run": True}
+    assert too_many.status_code == 409
+    assert too_many.json()["detail"] == "More than the limit of 1 products match"
+    assert [lens["unit_price"] for lens in unchanged] == [40.0, 45.5, 60.0]
+
+    assert scaled.json() == {"affected": 2, "dry_run": False}
+    assert set_resp.json() == {"affected": 2, "dry_run": False}
+    assert deleted.json() == {"affected": 2, "dry_run": False}
+
+    assert [lens["id"] for lens in remaining] == [3]
+    assert remaining[0]["comment"] == "Discontinued"
+    assert sorted((lens["id"], lens["unit_price"]) for lens in everything) == [
+        (1, 44.0),
+        (2, 50.05),
+        (3, 60.0),
+    ]
+
+    changes = sorted(
+        (row["lens_id"], row["update_field"], row["old_value"], row["new_value"])
+        for row in history
+        if row["update_type"] == "update"
+    )
+    # storage_limit was already 100, only the comments changed
+    assert changes == [
+        (1, "unit_price", "40.00", "44.00"),
+        (2, "comment", None, "Discontinued"),
+        (2, "unit_price", "45.50", "50.05"),
+        (3, "comment", None, "Discontinued"),
+    ]
+    assert sorted(
+        row["lens_id"] for row in history if row["update_type"] == "delete"
+    ) == [1, 2]
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_mutate_lenses_malformed():
+    async with AsyncClient(
+        transport=ASGITransport(app=main_app), base_url="http://test"
+    ) as client:
+        no_filter = await client.post(
+            "/api/inventory/lenses/mutate", json={"filter": [], "operation": "delete"}
+        )
+        no_values = await client.post(
+            "/api/inventory/lenses/mutate", json={"filter": CR39, "operation": "set"}
+        )
+        bad_field = await client.post(
+            "/api/inventory/lenses/mutate",
+            json={
+                "filter": [{"field": "nope", "operator": "eq", "value": 1}],
+                "operation": "delete",
+            },
+        )
+
+    assert no_filter.status_code == 422
+    assert no_values.status_code == 400
+    assert bad_field.status_code == 400
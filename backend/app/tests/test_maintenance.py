@@ -0,0 +1,153 @@
+import gzip
+from datetime import date, datetime, timedelta, timezone
+
+import pytest
+from app import maintenance
+from app.crud import lenses
+from app.config import settings
+from app.models import LensesHistory, LensesSnapshots
+from sqlalchemy import select, text, update
+
+JAN_20 = datetime(2020, 1, 20, 12, tzinfo=timezone.utc)
+MAY_2 = datetime(2019, 5, 2, 8, 30, tzinfo=timezone.utc)
+
+
+async def _history_at(db_session, timestamp: datetime):
+    await db_session.execute(text("""
+            INSERT INTO lenses (
+                id, lens_type, sphere, cylinder, unit_price, quantity
+            )
+            VALUES (1, 'CR39', -2.00, -0.75, 45.00, 5)
+            ON CONFLICT DO NOTHING
+            """))
+    await db_session.execute(
+        text("""
+            INSERT INTO lenses_history (
+                lens_id, update_field, old_value, new_value, update_type,
+                update_timestamp
+            )
+            VALUES (1, 'QUANTITY', '5', '4', 'UPDATE', :timestamp)
+            """),
+        {"timestamp": timestamp},
+    )
+    await db_session.commit()
+
+
+async def _partition_of(db_session, timestamp: datetime) -> str:
+    partition = await db_session.scalar(
+        text("""
+            SELECT tableoid::regclass::text FROM lenses_history
+            WHERE update_timestamp = :timestamp
+            """),
+        {"timestamp": timestamp},
+    )
+    # don't hold locks that would block the maintenance DDL
+    await db_session.commit()
+    return partition
+
+
+def _relations(plan: dict) -> set[str]:
+    names = {plan["Relation Name"]} if "Relation Name" in plan else set()
+    for child in plan.get("Plans", []):
+        names |= _relations(child)
+    return names
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_ensure_partitions(test_sessionmanager, test_db_session):
+    await _history_at(test_db_session, JAN_20)
+    assert await _partition_of(test_db_session, JAN_20) == "lenses_history_default"
+
+    async with test_sessionmanager.connect() as connection:
+        created = await maintenance.ensure_partitions(
+            connection, ahead=2, today=date(2020, 1, 15)
+        )
+    async with test_sessionmanager.connect() as connection:
+        assert (
+            await maintenance.ensure_partitions(
+                connection, ahead=2, today=date(2020, 1, 15)
+            )
+            == []
+        )
+        partitions = await maintenance.list_partitions(connection)
+
+    assert created == [
+        "lenses_history_y2020m01",
+        "lenses_history_y2020m02",
+        "lenses_history_y2020m03",
+    ]
+    assert {date(2020, 1, 1), date(2020, 2, 1), date(2020, 3, 1)} <= set(partitions)
+    # rows already in the default partition move to their month
+    assert await _partition_of(test_db_session, JAN_20) == "lenses_history_y2020m01"
+
+    plan = await lenses._explain(
+        test_db_session,
+        select(LensesHistory)
+        .where(
+            LensesHistory.update_timestamp >= datetime(2020, 2, 1, tzinfo=timezone.utc)
+        )
+        .where(
+            LensesHistory.update_timestamp < datetime(2020, 3, 1, tzinfo=timezone.utc)
+        ),
+    )
+    assert _relations(plan) == {"lenses_history_y2020m02"}
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_archive_partitions(test_sessionmanager, test_db_session, tmp_path):
+    async with test_sessionmanager.connect() as connection:
+        await maintenance.ensure_partitions(connection, ahead=1, today=date(2019, 5, 1))
+    await _history_at(test_db_session, MAY_2)
+
+    async with test_sessionmanager.connect() as connection:
+        archived = await maintenance.archive_partitions(
+            connection, retention=1, archive_dir=str(tmp_path), today=date(2019, 7, 20)
+        )
+        partitions = await maintenance.list_partitions(connection)
+
+    assert archived == ["lenses_history_y2019m05"]
+    assert date(2019, 5, 1) not in partitions
+    assert date(2019, 6, 1) in partitions
+    assert (
+        await test_db_session.scalar(
+            text("SELECT to_regclass('lenses_history_y2019m05')")
+        )
+        is None
+    )
+
+    with gzip.open(tmp_path / "lenses_history_y2019m05.csv.gz", "rt") as archive:
+        lines = archive.read().splitlines()
+    assert lines[0].startswith("id,lens_id,update_field")
+    assert len(lines) == 2 and "2019-05-02 08:30:00+00" in lines[1]
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_take_snapshot_prunes_old_snapshots(test_sessionmanager, monkeypatch):
+    monkeypatch.setattr(settings, "snapshot_retention", 10 * 24 * 60 * 60)
+    now = datetime.now(timezone.utc)
+
+    async with test_sessionmanager.connect() as connection:
+        await connection.execute(text("""
+                INSERT INTO lenses (
+                    id, lens_type, sphere, cylinder, unit_price, quantity
+                )
+                VALUES (1, 'CR39', -2.00, -0.75, 45.00, 5)
+                """))
+        for days in (30, 20, 15, 5):
+            await maintenance.take_snapshot(connection)
+            await connection.execute(
+                update(LensesSnapshots)
+                .where(LensesSnapshots.taken_at > now)
+                .values(taken_at=now - timedelta(days=days))
+            )
+
+        assert await maintenance.take_snapshot(connection)
+        taken = await connection.scalars(
+            select(LensesSnapshots.taken_at).order_by(LensesSnapshots.taken_at)
+        )
+
+    # the one from 15 days ago still covers the start of the retention window
+    assert [now - t for t in taken.all()][:2] == [
+        timedelta(days=15),
+        timedelta(days=5),
+    ]
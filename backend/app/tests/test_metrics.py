@@ -0,0 +1,101 @@
+import pytest
+from app import metrics
+from app.main import app as main_app
+from httpx import ASGITransport, AsyncClient
+from prometheus_client.parser import text_string_to_metric_families
+
+product_data = {
+    "id": 1,
+    "lens_type": "CR39",
+    "sphere": -2.00,
+    "cylinder": -0.75,
+    "unit_price": 45.00,
+    "quantity": 5,
+    "storage_limit": 100,
+}
+
+
+def _samples(text: str) -> dict:
+    return {
+        (sample.name, tuple(sorted(sample.labels.items()))): sample.value
+        for family in text_string_to_metric_families(text)
+        for sample in family.samples
+    }
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_metrics_endpoint():
+    async with AsyncClient(
+        transport=ASGITransport(app=main_app), base_url="http://test"
+    ) as client:
+        before = _samples((await client.get("/metrics")).text)
+
+        await client.post("/api/inventory/lenses", json=product_data)
+        await client.get("/api/inventory/lenses/1")
+        await client.get("/api/inventory/lenses/404")
+
+        metrics_resp = await client.get("/metrics")
+
+    assert metrics_resp.status_code == 200
+    assert metrics_resp.headers["Content-Type"].startswith("text/plain")
+    after = _samples(metrics_resp.text)
+
+    def delta(name, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        return after.get(key, 0) - before.get(key, 0)
+
+    route = "/api/inventory/lenses/{product_id}"
+    latency = "inventory_request_duration_seconds_count"
+    assert delta(latency, method="GET", route=route, status="200") == 1
+    assert delta(latency, method="GET", route=route, status="404") == 1
+    assert (
+        delta(latency, method="POST", route="/api/inventory/lenses", status="200") == 1
+    )
+    assert after[("inventory_requests_in_flight", ())] == 0
+
+    assert delta("inventory_history_rows_written_total", update_type="create") == 7
+
+    assert after[("inventory_db_pool_checked_out", (("pool", "primary"),))] >= 0
+    assert delta("inventory_db_pool_wait_seconds_count", pool="primary") >= 0
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_event_streams_are_not_requests():
+    seen = {}
+
+    async def stream(scope, receive, send):
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [(b"content-type", b"text/event-stream")],
+            }
+        )
+        # the client is still reading
+        seen.update(_samples(metrics.render().decode()))
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+    async def receive():
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        pass
+
+    latency = (
+        "inventory_request_duration_seconds_count",
+        (("method", "GET"), ("route", "unmatched"), ("status", "200")),
+    )
+    before = _samples(metrics.render().decode())
+
+    await metrics.MetricsMiddleware(stream)(
+        {"type": "http", "method": "GET", "path": "/api/inventory/changes"},
+        receive,
+        send,
+    )
+    after = _samples(metrics.render().decode())
+
+    assert seen[("inventory_streams_open", ())] == 1
+    assert seen[("inventory_requests_in_flight", ())] == 0
+    assert after[("inventory_streams_open", ())] == 0
+    assert after[("inventory_requests_in_flight", ())] == 0
+    assert after.get(latency, 0) == before.get(latency, 0)
@@ -0,0 +1,112 @@
+import re
+
+import pytest
+from app.main import app as main_app
+from httpx import ASGITransport, AsyncClient
+
+product_data = {
+    "id": 1,
+    "lens_type": "CR39",
+    "sphere": -2.00,
+    "cylinder": -0.75,
+    "unit_price": 45.00,
+    "quantity": 5,
+    "storage_limit": 100,
+}
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_server_timing_header():
+    async with AsyncClient(
+        transport=ASGITransport(app=main_app), base_url="http://test"
+    ) as client:
+        get_resp = await client.get("/api/inventory/lenses")
+
+    timing = get_resp.headers["Server-Timing"]
+
+    # the catalog version for the ETag, then the page
+    assert re.search(r'db;dur=[\d.]+;desc="2 queries"', timing)
+    assert re.search(r"serialize;dur=[\d.]+", timing)
+    assert re.search(r"total;dur=[\d.]+", timing)
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_read_query_budget(max_queries):
+    async with AsyncClient(
+        transport=ASGITransport(app=main_app), base_url="http://test"
+    ) as client:
+        await client.post("/api/inventory/lenses", json=product_data)
+
+        # lists read the catalog version for their ETag first
+        with max_queries(2):
+            await client.get("/api/inventory/lenses")
+
+        with max_queries(3):
+            await client.get("/api/inventory/lenses", params={"range": "[0, 10]"})
+
+        # the total is cached now
+        with max_queries(2):
+            await client.get("/api/inventory/lenses", params={"range": "[0, 10]"})
+
+        with max_queries(2):
+            await client.get("/api/inventory/lenses", params={"limit": 10})
+
+        with max_queries(1):
+            await client.get("/api/inventory/lenses/1")
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_write_query_budget(max_queries):
+    async with AsyncClient(
+        transport=ASGITransport(app=main_app), base_url="http://test"
+    ) as client:
+        # every write also bumps the catalog version
+        with max_queries(5):
+            await client.post("/api/inventory/lenses", json=product_data)
+
+        with max_queries(5):
+            await client.put("/api/inventory/lenses/1", json={"quantity": 4})
+
+        with max_queries(2):
+            await client.post("/api/inventory/lenses/1/adjust", json={"delta": 1})
+
+        # with the version it read, an update is a single compare-and-swap
+        lens = (await client.get("/api/inventory/lenses/1")).json()
+        with max_queries(2):
+            await client.put(
+                "/api/inventory/lenses/1",
+                json={"quantity": 3, "updated_at": lens["updated_at"]},
+            )
+
+        with max_queries(4):
+            await client.post(
+                "/api/inventory/lenses/bulk",
+                json=[{**product_data, "id": i} for i in range(2, 50)],
+            )
+
+        with max_queries(4):
+            await client.delete("/api/inventory/lenses/1")
+
+        with max_queries(5):
+            await client.post("/api/inventory/lenses", json=product_data)
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_bulk_query_budget(max_queries):
+    async with AsyncClient(
+        transport=ASGITransport(app=main_app), base_url="http://test"
+    ) as client:
+        for i in (1, 2):
+            await client.post("/api/inventory/lenses", json={**product_data, "id": i})
+            await client.delete(f"/api/inventory/lenses/{i}")
+
+        # the lookup, one INSERT, one UPDATE, the history and the version,
+        # however many lenses. an executemany counts once per row
+        with max_queries(5):
+            bulk = await client.post(
+                "/api/inventory/lenses/bulk",
+                json=[{**product_data, "id": i} for i in range(1, 201)],
+            )
+
+    statuses = [result["status"] for result in bulk.json()]
+    assert statuses == ["replaced"] * 2 + ["created"] * 198
@@ -0,0 +1,184 @@
+import pytest
+from app.crud import lenses
+from app.models import Lenses, LensesHistory
+from sqlalchemy import select, text
+
+LENS_COUNT = 20_000
+
+
+def _index_names(plan: dict) -> set[str]:
+    names = {plan["Index Name"]} if "Index Name" in plan else set()
+    for child in plan.get("Plans", []):
+        names |= _index_names(child)
+    return names
+
+
+def _node_types(plan: dict) -> set[str]:
+    types = {plan["Node Type"]}
+    for child in plan.get("Plans", []):
+        types |= _node_types(child)
+    return types
+
+
+@pytest.fixture
+async def catalog(test_db_session):
+    # one rare lens type, the rest spread evenly, a third soft deleted
+    await test_db_session.execute(
+        text("""
+            INSERT INTO lenses (
+                id, lens_type, sphere, cylinder, unit_price, quantity,
+                storage_limit, deleted_at
+            )
+            SELECT
+                i,
+                CASE
+                    WHEN i % 500 = 0 THEN 'High Index 1.74'
+                    ELSE (ARRAY['CR39', 'Polycarbonate', 'Trivex', 'High Index 1.67'])[i % 4 + 1]
+                END,
+                (i * 7919 % 57 - 40) / 4.0,
+                (i * 104729 % 17 - 16) / 4.0,
+                40 + i % 80,
+                i * 31 % 100,
+                100,
+                CASE WHEN i % 3 = 0 THEN now() END
+            FROM generate_series(1, :count) AS i
+            """),
+        {"count": LENS_COUNT},
+    )
+    await test_db_session.execute(
+        text("""
+            INSERT INTO lenses_history (
+                lens_id, update_field, old_value, new_value, update_type
+            )
+            SELECT i, 'QUANTITY', '0', '1', 'UPDATE'
+            FROM generate_series(1, :count) AS i, generate_series(1, 3)
+            """),
+        {"count": LENS_COUNT},
+    )
+    await test_db_session.commit()
+
+    await test_db_session.execute(text("ANALYZE lenses"))
+    await test_db_session.execute(text("ANALYZE lenses_history"))
+
+
+async def _explain_list(db_session, sort=None, filter=None):
+    stmt, params = lenses._lenses_query(filter, False)
+    stmt = stmt.order_by(*lenses._order_by(lenses._build_order(sort))).limit(25)
+    return await lenses._explain(db_session, stmt, params)
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_plan_lens_type_filter(test_db_session, catalog):
+    plan = await _explain_list(
+        test_db_session,
+        filter=[{"field": "lens_type", "operator": "eq", "value": "High Index 1.74"}],
+    )
+
+    assert "ix_lenses_active_lens_type" in _index_names(plan)
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_plan_power_range_filter(test_db_session, catalog):
+    plan = await _explain_list(
+        test_db_session,
+        filter=[
+            {"field": "sphere", "operator": "between", "value": [-0.25, 0]},
+            {"field": "cylinder", "operator": "eq", "value": -0.5},
+        ],
+    )
+
+    assert "ix_lenses_active_sphere_cylinder" in _index_names(plan)
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_plan_lens_type_set_filter(test_db_session, catalog):
+    plan = await _explain_list(
+        test_db_session,
+        filter=[
+            {
+                "field": "lens_type",
+                "operator": "in",
+                "value": ["High Index 1.74", "Other"],
+            }
+        ],
+    )
+
+    assert "ix_lenses_active_lens_type" in _index_names(plan)
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_plan_shortage(test_db_session, catalog):
+    plan = await lenses._explain(
+        test_db_session,
+        select(Lenses).where(Lenses.deleted_at.is_(None)).where(Lenses.shortage > 98),
+    )
+
+    assert "ix_lenses_reorder" in _index_names(plan)
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_plan_reorder_report(test_db_session, catalog):
+    reorder_cost = (Lenses.shortage * Lenses.unit_price).label("reorder_cost")
+    stmt, _ = lenses._lenses_query(None, False, [Lenses.id, reorder_cost])
+    stmt = stmt.where(Lenses.shortage > 0)
+    by_shortage = await lenses._explain(
+        test_db_session,
+        stmt.order_by(Lenses.shortage.desc(), Lenses.id).limit(25),
+    )
+
+    assert "ix_lenses_reorder" in _index_names(by_shortage)
+    # read in index order, nothing left to sort
+    assert "Sort" not in _node_types(by_shortage)
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_plan_deep_keyset_page(test_db_session, catalog):
+    order = lenses._build_order(None)
+    stmt, _ = lenses._lenses_query(None, False)
+    stmt = (
+        stmt.where(lenses._keyset_condition(order, [LENS_COUNT - 100]))
+        .order_by(*lenses._order_by(order))
+        .limit(25)
+    )
+    plan = await lenses._explain(test_db_session, stmt)
+
+    # walks the live id index from the cursor, no scan of the earlier rows
+    assert "ix_lenses_active_id" in _index_names(plan)
+    assert not {"Seq Scan", "Sort"} & _node_types(plan)
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_plan_lens_history(test_db_session, catalog):
+    plan = await lenses._explain(
+        test_db_session,
+        select(LensesHistory)
+        .where(LensesHistory.lens_id == 42)
+        .order_by(LensesHistory.update_timestamp.desc()),
+    )
+
+    # each partition has its own copy of the index
+    indexes = _index_names(plan)
+    assert indexes
+    assert all("lens_id_update_timestamp" in name for name in indexes)
+
+
+async def _explain_history_page(db_session, lens_id=None):
+    order = lenses._build_order(
+        [["update_timestamp", "DESC"], ["id", "DESC"]], LensesHistory
+    )
+    stmt = select(LensesHistory.id).order_by(*lenses._order_by(order)).limit(25)
+    if lens_id is not None:
+        stmt = stmt.where(LensesHistory.lens_id == lens_id)
+    return await lenses._explain(db_session, stmt)
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_plan_history_feed(test_db_session, catalog):
+    per_lens = await _explain_history_page(test_db_session, lens_id=42)
+    feed = await _explain_history_page(test_db_session)
+
+    assert all("lens_id_update_timestamp" in name for name in _index_names(per_lens))
+    # newest rows come straight off the (update_timestamp, id) index
+    assert _index_names(feed)
+    assert all("update_timestamp_id" in name for name in _index_names(feed))
+    assert "Sort" not in _node_types(feed)
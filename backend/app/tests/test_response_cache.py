@@ -0,0 +1,132 @@
+import asyncio
+import time
+
+import pytest
+from app import metrics
+from app.cache import ResponseCache
+from app.dependencies import core
+from app.main import app as main_app
+from app.notifications import CatalogListener
+from httpx import ASGITransport, AsyncClient
+from sqlalchemy import text
+
+product_data = {
+    "id": 1,
+    "lens_type": "CR39",
+    "sphere": -2.00,
+    "cylinder": -0.75,
+    "unit_price": 45.00,
+    "quantity": 5,
+    "storage_limit": 100,
+}
+
+
+@pytest.fixture
+async def listener(test_sessionmanager, monkeypatch):
+    listener = CatalogListener()
+    await listener.start(
+        test_sessionmanager._engine.url.render_as_string(hide_password=False)
+    )
+    monkeypatch.setattr(core, "catalog_listener", listener)
+    monkeypatch.setattr(core, "response_cache", ResponseCache(1024 * 1024))
+    monkeypatch.setattr(core.settings, "response_cache", True)
+
+    yield listener
+
+    await listener.stop()
+
+
+async def _notified(listener: CatalogListener, version: int):
+    for _ in range(100):
+        if listener.generation == version:
+            return
+        await asyncio.sleep(0.05)
+    raise AssertionError(f"generation {listener.generation}, expected {version}")
+
+
+def _lookups(result: str) -> float:
+    return metrics.RESPONSE_CACHE_REQUESTS.labels(result)._value.get()
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_response_cache(listener, max_queries):
+    async with AsyncClient(
+        transport=ASGITransport(app=main_app), base_url="http://test"
+    ) as client:
+        await client.post("/api/inventory/lenses", json=product_data)
+        await _notified(listener, 1)
+        hits, misses = _lookups("hit"), _lookups("miss")
+
+        first = await client.get("/api/inventory/lenses", params={"range": "[0, 9]"})
+        with max_queries(0):
+            cached = await client.get(
+                "/api/inventory/lenses", params={"range": "[0, 9]"}
+            )
+            not_modified = await client.get(
+                "/api/inventory/lenses",
+                params={"range": "[0, 9]"},
+                headers={"If-None-Match": first.headers["ETag"]},
+            )
+        # clients that just wrote skip the cache
+        pinned = await client.get(
+            "/api/inventory/lenses",
+            params={"range": "[0, 9]"},
+            headers={"X-Primary-Until": f"{time.time() + 5}"},
+        )
+
+        await client.post("/api/inventory/lenses/1/adjust", json={"delta": 1})
+        await _notified(listener, 2)
+        changed = await client.get("/api/inventory/lenses", params={"range": "[0, 9]"})
+
+    assert cached.content == first.content
+    assert cached.headers["ETag"] == first.headers["ETag"]
+    assert cached.headers["X-Total-Count"] == "1"
+    assert not_modified.status_code == 304
+    assert pinned.json() == first.json()
+    assert changed.json()[0]["quantity"] == 6
+    assert _lookups("hit") == hits + 1
+    assert _lookups("miss") == misses + 2
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_listener_checks_the_version(test_sessionmanager, test_db_session):
+    listener = CatalogListener(retry_interval=0.1, check_interval=0.1)
+    await listener.start(
+        test_sessionmanager._engine.url.render_as_string(hide_password=False)
+    )
+    async with AsyncClient(
+        transport=ASGITransport(app=main_app), base_url="http://test"
+    ) as client:
+        await client.post("/api/inventory/lenses", json=product_data)
+    await _notified(listener, 1)
+
+    # a missed notification is caught up on by the next check
+    await test_db_session.execute(text("UPDATE catalog_version SET version = 5"))
+    await test_db_session.commit()
+    await _notified(listener, 5)
+
+    # a connection that stops answering is dropped, and the generation with it
+    await test_db_session.execute(
+        text("LOCK TABLE catalog_version IN ACCESS EXCLUSIVE MODE")
+    )
+    await _notified(listener, None)
+    await test_db_session.commit()
+    await _notified(listener, 5)
+
+    await listener.stop()
+
+
+def test_response_cache_bounds():
+    cache = ResponseCache(max_bytes=10)
+    key = ResponseCache.key("/lenses", [("limit", "5")])
+
+    cache.set(1, key, b"12345", {})
+    cache.set(1, ResponseCache.key("/lenses", []), b"123456", {})
+    # the least recently used entry went to make room
+    assert cache.get(1, key) is None
+
+    cache.set(1, key, b"12345", {})
+    assert cache.get(2, key) is None
+    # older than the generation, never served
+    cache.set(1, key, b"12345", {})
+    assert cache.get(2, key) is None
@@ -0,0 +1,62 @@
+import pytest
+from app.crud import lenses
+from app.main import app as main_app
+from app.schemas import LensRead
+from app.serialization import dump_lenses
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from httpx import ASGITransport, AsyncClient
+from pydantic import TypeAdapter
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_dump_lenses_matches_response_model(test_db_session):
+    products = [
+        {
+            "id": 1,
+            "lens_type": "CR39",
+            "sphere": -2.00,
+            "cylinder": -0.75,
+            "unit_price": 45.00,
+            "quantity": 5,
+            "storage_limit": 100,
+            "comment": 'Ünïcode "quoted"\n\ttab \x1f   / \\',
+        },
+        {
+            "id": 2,
+            "lens_type": "High Index 1.74",
+            "sphere": 12.25,
+            "cylinder": 0.00,
+            "unit_price": 9999.99,
+            "quantity": 0,
+        },
+        {
+            "id": 3,
+            "lens_type": "Trivex",
+            "sphere": -0.01,
+            "cylinder": -4.50,
+            "unit_price": 0.10,
+            "quantity": -3,
+        },
+    ]
+
+    async with AsyncClient(
+        transport=ASGITransport(app=main_app), base_url="http://test"
+    ) as client:
+        for product in products:
+            await client.post("/api/inventory/lenses", json=product)
+
+        get_resp = await client.get("/api/inventory/lenses")
+
+    objects, _ = await lenses.get_lenses(test_db_session)
+    rows, _ = await lenses.get_lenses(test_db_session, as_rows=True)
+
+    # what FastAPI renders for response_model=list[LensRead]
+    adapter = TypeAdapter(list[LensRead])
+    validated = adapter.validate_python(objects, from_attributes=True)
+    expected = JSONResponse(
+        jsonable_encoder(adapter.dump_python(validated, mode="json"))
+    ).body
+
+    assert dump_lenses(rows) == expected
+    assert get_resp.content == expected
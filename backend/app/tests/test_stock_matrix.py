@@ -0,0 +1,123 @@
+import pytest
+from app.main import app as main_app
+from httpx import ASGITransport, AsyncClient
+from sqlalchemy import text
+
+
+def _lens(id: int, **values) -> dict:
+    return {
+        "id": id,
+        "lens_type": "CR39",
+        "sphere": -2.00,
+        "cylinder": -0.75,
+        "unit_price": 45.00,
+        "quantity": 5,
+        "storage_limit": 10,
+        **values,
+    }
+
+
+async def _matrix_drift(db_session) -> list:
+    """
+    cells where the summary table and a fresh aggregate over lenses disagree
+    """
+    rows = (await db_session.execute(text("""
+            WITH fresh AS (
+                SELECT
+                    lens_type, sphere, cylinder,
+                    count(*) AS lenses,
+                    sum(quantity) AS quantity,
+                    sum(coalesce(storage_limit, 0)) AS storage_limit,
+                    sum(quantity) FILTER (WHERE storage_limit IS NOT NULL)
+                        AS limited_quantity
+                FROM lenses WHERE deleted_at IS NULL
+                GROUP BY lens_type, sphere, cylinder
+            )
+            SELECT * FROM fresh
+            FULL JOIN lens_stock_matrix m USING (lens_type, sphere, cylinder)
+            WHERE fresh.lenses IS DISTINCT FROM m.lenses
+                OR fresh.quantity IS DISTINCT FROM m.quantity
+                OR fresh.storage_limit IS DISTINCT FROM m.storage_limit
+                OR coalesce(fresh.limited_quantity, 0)
+                    IS DISTINCT FROM m.limited_quantity
+            """))).all()
+    await db_session.commit()
+    return rows
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_stock_matrix_follows_writes(test_db_session):
+    async with AsyncClient(
+        transport=ASGITransport(app=main_app), base_url="http://test"
+    ) as client:
+        await client.post("/api/inventory/lenses", json=_lens(1))
+        await client.post(
+            "/api/inventory/lenses/bulk",
+            json=[
+                _lens(2, quantity=3),
+                _lens(3, sphere=-1.50, storage_limit=None),
+                _lens(4, lens_type="Poly", cylinder=0),
+            ],
+        )
+        assert await _matrix_drift(test_db_session) == []
+
+        await client.put("/api/inventory/lenses/2", json={"sphere": -1.50})
+        await client.put("/api/inventory/lenses/3", json={"comment": "display"})
+        await client.post("/api/inventory/lenses/1/adjust", json={"delta": -4})
+        await client.delete("/api/inventory/lenses/4")
+        assert await _matrix_drift(test_db_session) == []
+
+        # replacing a deleted lens counts it again
+        await client.post("/api/inventory/lenses", json=_lens(4, quantity=2))
+        assert await _matrix_drift(test_db_session) == []
+
+        # a bulk request replacing and creating lenses in one statement each
+        await client.delete("/api/inventory/lenses/2")
+        await client.post(
+            "/api/inventory/lenses/bulk",
+            json=[_lens(2, lens_type="Poly", quantity=7), _lens(5, quantity=1)],
+        )
+        assert await _matrix_drift(test_db_session) == []
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_read_stock_matrix():
+    async with AsyncClient(
+        transport=ASGITransport(app=main_app), base_url="http://test"
+    ) as client:
+        await client.post(
+            "/api/inventory/lenses/bulk",
+            json=[
+                _lens(1),
+                _lens(2, quantity=3),
+                _lens(3, sphere=-1.50, cylinder=-0.25, storage_limit=None),
+                _lens(4, lens_type="Poly", sphere=0, cylinder=0, quantity=1),
+            ],
+        )
+
+        response = await client.get("/api/inventory/lenses/matrix")
+        poly = await client.get(
+            "/api/inventory/lenses/matrix", params={"lens_type": "Poly"}
+        )
+        missing = await client.get(
+            "/api/inventory/lenses/matrix", params={"lens_type": "Glass"}
+        )
+
+    assert response.status_code == 200
+    cr39, _ = response.json()
+    assert cr39["lens_type"] == "CR39"
+    assert cr39["spheres"] == [-2.0, -1.75, -1.5]
+    assert cr39["cylinders"] == [-0.75, -0.5, -0.25]
+    assert cr39["quantity"] == [[8, 0, 0], [0, 0, 0], [0, 0, 5]]
+    assert cr39["fill"] == [[0.4, None, None], [None, None, None], [None, None, None]]
+
+    assert poly.json() == [
+        {
+            "lens_type": "Poly",
+            "spheres": [0.0],
+            "cylinders": [0.0],
+            "quantity": [[1]],
+            "fill": [[0.1]],
+        }
+    ]
+    assert missing.json() == []
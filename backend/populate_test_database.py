@@ -99,10 +99,9 @@ test_data = [
 
 async def send_requests():
     async with AsyncClient() as client:
-        for lens_data in test_data:
-            await client.post(
-                "http://localhost:8000/api/inventory/lenses", json=lens_data
-            )
+        await client.post(
+            "http://localhost:8000/api/inventory/lenses/bulk", json=test_data
+        )
 
 
 if __name__ == "__main__":